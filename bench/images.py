@@ -0,0 +1,115 @@
+import os
+import random
+import zipfile
+
+SHAPES = ("wide", "deep", "balanced", "small_files", "huge_files")
+# Directory depth of the 'deep' shape and fan-out of the 'balanced' one
+DEEP_LEVELS = 64
+BALANCED_FANOUT = 16
+HUGE_FILE_COUNT = 4
+
+
+def generate_entries(shape, entries, seed=0):
+    """
+    Yields the members of a synthetic image as (path, size) pairs.
+    The same arguments always give the same entries.
+
+    - wide: a few directories with thousands of files each
+    - deep: chains of DEEP_LEVELS nested directories with a file on every level
+    - balanced: a tree with BALANCED_FANOUT directories per level, files in the leaves
+    - small_files: like balanced, but every file is only a few bytes
+    - huge_files: HUGE_FILE_COUNT files of about entries KiB in total
+
+    :param shape: One of SHAPES
+    :type shape: str
+    :param entries: Number of files to generate
+    :type entries: int
+    :param seed: Seed of the sizes and name suffixes
+    :type seed: int
+    :raises ValueError: If the shape is unknown
+    :rtype: Iterator[tuple[str, int]]
+    """
+    rng = random.Random(seed)
+    if shape == "wide":
+        per_dir = max(1, entries // 4)
+        for i in range(entries):
+            yield f"dir{i // per_dir}/file{i:07d}.txt", rng.randint(64, 2048)
+    elif shape == "deep":
+        for i in range(entries):
+            chain, level = divmod(i, DEEP_LEVELS)
+            parents = "/".join(f"level{j}" for j in range(level))
+            prefix = f"chain{chain}/{parents}/" if parents else f"chain{chain}/"
+            yield f"{prefix}file{level}.txt", rng.randint(64, 2048)
+    elif shape in ("balanced", "small_files"):
+        levels = 1
+        while BALANCED_FANOUT ** levels * BALANCED_FANOUT < entries:
+            levels += 1
+        for i in range(entries):
+            parts = []
+            leaf = i // BALANCED_FANOUT
+            for _ in range(levels):
+                leaf, digit = divmod(leaf, BALANCED_FANOUT)
+                parts.append(f"d{digit:x}")
+            size = rng.randint(1, 32) if shape == "small_files" else rng.randint(64, 4096)
+            suffix = rng.choice(("txt", "log", "py", "md"))
+            yield "/".join(reversed(parts)) + f"/file{i % BALANCED_FANOUT}.{suffix}", size
+    elif shape == "huge_files":
+        size = max(1, entries * 1024 // HUGE_FILE_COUNT)
+        for i in range(HUGE_FILE_COUNT):
+            yield f"data/blob{i}.bin", size
+    else:
+        raise ValueError(f"Unknown shape: {shape}")
+
+
+def _content(path, size):
+    line = f"{path} synthetic content\n".encode("utf-8")
+    return (line * (size // len(line) + 1))[:size]
+
+
+def build_image(zip_path, shape, entries, seed=0, compression=zipfile.ZIP_DEFLATED):
+    """
+    Writes a synthetic zip image. Large members are streamed in chunks.
+
+    :param zip_path: Path of the archive to create
+    :type zip_path: str
+    :param shape: One of SHAPES
+    :type shape: str
+    :param entries: Number of files (see generate_entries)
+    :type entries: int
+    :param seed: Seed passed to generate_entries
+    :type seed: int
+    :param compression: zipfile compression method
+    :type compression: int
+    :return: zip_path
+    :rtype: str
+    """
+    chunk_size = 1 << 20
+    tmp_path = zip_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, "w", compression, allowZip64=True) as zf:
+        for path, size in generate_entries(shape, entries, seed):
+            if size <= chunk_size:
+                zf.writestr(path, _content(path, size))
+                continue
+            chunk = _content(path, chunk_size)
+            info = zipfile.ZipInfo(path)
+            info.compress_type = compression
+            with zf.open(info, "w", force_zip64=True) as f:
+                for _ in range(size // chunk_size):
+                    f.write(chunk)
+                f.write(chunk[: size % chunk_size])
+    os.replace(tmp_path, zip_path)
+    return zip_path
+
+
+def cached_image(workdir, shape, entries, seed=0):
+    """
+    Returns the path of a synthetic image in workdir, building it first
+    if it does not exist yet.
+
+    :rtype: str
+    """
+    os.makedirs(workdir, exist_ok=True)
+    zip_path = os.path.join(workdir, f"{shape}-{entries}-{seed}.zip")
+    if not os.path.exists(zip_path):
+        build_image(zip_path, shape, entries, seed)
+    return zip_path
@@ -0,0 +1,395 @@
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from bench.images import SHAPES, cached_image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SCALES = (1000, 10000, 100000, 1000000)
+# Metrics where a larger value is better; everything else is a cost
+HIGHER_IS_BETTER = ("commands_per_s",)
+# Modules only some commands need; 'import var28' must not load them
+STARTUP_FORBIDDEN = (
+    "argparse", "concurrent.futures", "json", "multiprocessing", "toml",
+    "urllib", "xml.etree.ElementTree", "xml.sax", "zipfile",
+)
+
+
+def _shell(image, workdir, lazy, log_name="log.xml"):
+    from var28 import ShellEmulator
+
+    config = {
+        "user": {"name": "bench", "computer": "bench", "parametr": ""},
+        "paths": {
+            "vfs": image,
+            "log": os.path.join(workdir, log_name),
+            "start_script": os.path.join(workdir, "missing.sh"),
+        },
+        "vfs": {"lazy": lazy},
+    }
+    return ShellEmulator(config)
+
+
+def _first_dir(shell):
+    node = shell.fs.root
+    for child in node.sorted_children():
+        if child.is_dir:
+            return child.name
+    return "."
+
+
+def _latency(shell, command, repeat):
+    out = io.StringIO()
+    samples = []
+    with redirect_stdout(out):
+        for _ in range(repeat):
+            started = time.perf_counter()
+            shell.execute(command)
+            samples.append(time.perf_counter() - started)
+            out.seek(0)
+            out.truncate()
+    samples.sort()
+    return {
+        "median_us": round(statistics.median(samples) * 1e6, 2),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1e6, 2),
+    }
+
+
+def _log_cost(workdir, records):
+    from session_log import open_session_log
+
+    result = {}
+    for log_format in ("xml", "csv"):
+        path = os.path.join(workdir, f"bench-log.{log_format}")
+        logger = open_session_log(path)
+        started = time.perf_counter()
+        for i in range(records):
+            logger.write("bench", "2024-01-01 00:00:00", f"ls dir{i % 10}")
+        written = time.perf_counter()
+        logger.flush()
+        flushed = time.perf_counter()
+        logger.close()
+        result[log_format] = {
+            "records": records,
+            "us_per_record": round((written - started) / records * 1e6, 3),
+            "flush_us": round((flushed - written) * 1e6, 2),
+            "bytes": os.path.getsize(path),
+        }
+    return result
+
+
+def run_case(image, shape, entries, lazy, repeat=20, batch_commands=10000):
+    """
+    Measures one image in the current process. Meant to run in a fresh
+    interpreter (see run_suite), so peak RSS belongs to this case alone.
+
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory(prefix="vfs-bench-") as workdir:
+        result = {"shape": shape, "entries": entries, "lazy": lazy}
+
+        # The image is loaded on first use; touch it so startup covers the load
+        started = time.perf_counter()
+        shell = _shell(image, workdir, lazy)
+        shell.image
+        result["startup_s"] = round(time.perf_counter() - started, 6)
+        result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        shell.close()
+
+        tracemalloc.start()
+        shell = _shell(image, workdir, lazy)
+        shell.image
+        result["startup_traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        directory = _first_dir(shell)
+        commands = ("ls", f"ls {directory}", f"cd {directory}", "cd ..", "pwd", "tree -L 2", "tree")
+        result["commands"] = {
+            command: _latency(shell, command, 3 if command == "tree" else repeat)
+            for command in commands
+        }
+        shell.close()
+
+        shell = _shell(image, workdir, lazy)
+        script = [c for _ in range(batch_commands // 4) for c in ("ls", f"cd {directory}", "pwd", "cd ..")]
+        stdout = sys.stdout
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            try:
+                started = time.perf_counter()
+                shell.run_batch(script)
+                elapsed = time.perf_counter() - started
+            finally:
+                sys.stdout = stdout
+        result["batch"] = {
+            "commands": len(script),
+            "seconds": round(elapsed, 6),
+            "commands_per_s": round(len(script) / elapsed, 1),
+        }
+        result["log"] = _log_cost(workdir, batch_commands)
+        return result
+
+
+def run_suite(shapes, scales, workdir, lazy_modes=(False, True), seed=0, repeat=20):
+    """
+    Runs every shape x scale x loading mode in its own interpreter.
+
+    :return: The results document (see main)
+    :rtype: dict
+    """
+    results = []
+    for shape in shapes:
+        for entries in scales:
+            image = cached_image(workdir, shape, entries, seed)
+            for lazy in lazy_modes:
+                fd, case_out = tempfile.mkstemp(suffix=".json")
+                os.close(fd)
+                try:
+                    subprocess.run(
+                        [sys.executable, "-m", "bench.run", "case", image, shape, str(entries),
+                         "--out", case_out, "--repeat", str(repeat)] + (["--lazy"] if lazy else []),
+                        cwd=REPO_ROOT, check=True,
+                    )
+                    with open(case_out) as f:
+                        results.append(json.load(f))
+                finally:
+                    os.remove(case_out)
+                print(f"{shape} {entries} lazy={lazy}: done", file=sys.stderr)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def _startup_env():
+    # Measure with bytecode caching on, as after a normal install
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def _first_prompt(config_path, workdir):
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_ROOT, "var28.py"), config_path],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=workdir,
+        env=_startup_env(),
+    )
+    output = b""
+    try:
+        while b"$ " not in output:
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                raise RuntimeError("the shell exited before showing a prompt")
+            output += chunk
+        return time.perf_counter() - started
+    finally:
+        process.stdin.close()
+        process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+def run_startup(repeat=20, image=None, start_script=None):
+    """
+    Measures how fast a new shell comes up, each sample in a cold
+    interpreter: a bare interpreter, 'import var28', and the time until
+    var28.py shows its first prompt. Also lists the modules from
+    STARTUP_FORBIDDEN that 'import var28' loads (it should load none).
+
+    The log and history go to a temporary directory, the repository's
+    own log.xml is not touched. Bytecode caching is on even if
+    PYTHONDONTWRITEBYTECODE is set.
+
+    :param image: VFS image, test.zip by default
+    :type image: str, optional
+    :param start_script: Start script to run before the prompt, none by default
+    :type start_script: str, optional
+    :rtype: dict
+    """
+    with tempfile.TemporaryDirectory(prefix="vfs-bench-startup-") as workdir:
+        config_path = os.path.join(workdir, "config.toml")
+        paths = {
+            "vfs": os.path.abspath(image or os.path.join(REPO_ROOT, "test.zip")),
+            "log": os.path.join(workdir, "log.xml"),
+            "start_script": os.path.abspath(start_script) if start_script else os.path.join(workdir, "missing.sh"),
+        }
+        with open(config_path, "w") as f:
+            f.write('[user]\nname = "bench"\ncomputer = "bench"\nparametr = ""\n\n[paths]\n')
+            f.write("".join(f"{key} = {json.dumps(value)}\n" for key, value in paths.items()))
+            f.write(f'\n[history]\nfile = {json.dumps(os.path.join(workdir, "history"))}\n')
+
+        def interpreter(code):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True, env=_startup_env())
+            return time.perf_counter() - started
+
+        samples = {"interpreter": [], "import": [], "first_prompt": []}
+        # One untimed run of each writes the bytecode and config caches
+        interpreter("import var28")
+        _first_prompt(config_path, workdir)
+        for _ in range(repeat):
+            samples["interpreter"].append(interpreter("pass"))
+            samples["import"].append(interpreter("import var28"))
+            samples["first_prompt"].append(_first_prompt(config_path, workdir))
+        loaded = subprocess.run(
+            [sys.executable, "-c", "import sys, var28; print(' '.join(sys.modules))"],
+            cwd=REPO_ROOT, check=True, capture_output=True, text=True,
+        ).stdout.split()
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+        },
+        "startup": {
+            f"{name}_ms": {
+                "median": round(statistics.median(values) * 1000, 2),
+                "min": round(min(values) * 1000, 2),
+            }
+            for name, values in samples.items()
+        },
+        "forbidden_imports": sorted(name for name in STARTUP_FORBIDDEN if name in loaded),
+    }
+
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}{key}.")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix.rstrip("."), value
+
+
+def compare(base, new, threshold=0.1):
+    """
+    Compares two results documents case by case.
+
+    :param threshold: Relative change reported as a regression
+    :type threshold: float
+    :return: (metric, base value, new value, relative change) of every regression
+    :rtype: list[tuple[str, float, float, float]]
+    """
+    def key(result):
+        return result["shape"], result["entries"], result["lazy"]
+
+    base_cases = {key(result): result for result in base["results"]}
+    regressions = []
+    for result in new["results"]:
+        old = base_cases.get(key(result))
+        if old is None:
+            continue
+        old_metrics = dict(_flatten(old))
+        for metric, value in _flatten(result):
+            if metric == "entries" or metric.endswith((".records", ".commands")):
+                continue
+            before = old_metrics.get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            if metric.endswith(HIGHER_IS_BETTER):
+                change = -change
+            if change > threshold:
+                name = f"{result['shape']}/{result['entries']}/{'lazy' if result['lazy'] else 'eager'}/{metric}"
+                regressions.append((name, before, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="ShellEmulator benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the suite and write results as JSON")
+    run_parser.add_argument("--shapes", default=",".join(SHAPES))
+    run_parser.add_argument("--scales", default="1000,10000",
+                            help=f"comma separated entry counts, e.g. {','.join(map(str, DEFAULT_SCALES))}")
+    run_parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "vfs-bench-images"),
+                            help="where generated images are kept between runs")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--repeat", type=int, default=20)
+    run_parser.add_argument("--mode", choices=("eager", "lazy", "both"), default="both")
+    run_parser.add_argument("--out", default="-", help="results file ('-' for stdout)")
+
+    case_parser = subparsers.add_parser("case", help="measure a single image (used by run)")
+    case_parser.add_argument("image")
+    case_parser.add_argument("shape")
+    case_parser.add_argument("entries", type=int)
+    case_parser.add_argument("--lazy", action="store_true")
+    case_parser.add_argument("--repeat", type=int, default=20)
+    case_parser.add_argument("--out", required=True)
+
+    startup_parser = subparsers.add_parser("startup", help="measure the time to the first prompt")
+    startup_parser.add_argument("--repeat", type=int, default=20)
+    startup_parser.add_argument("--image", help="VFS image (test.zip by default)")
+    startup_parser.add_argument("--start-script", help="start script to run (none by default)")
+    startup_parser.add_argument("--budget-ms", type=float, default=50.0,
+                                help="fail if the median time to the first prompt is above this")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == "case":
+        result = run_case(args.image, args.shape, args.entries, args.lazy, args.repeat)
+        with open(args.out, "w") as f:
+            json.dump(result, f)
+        return 0
+    if args.command == "startup":
+        document = run_startup(args.repeat, args.image, args.start_script)
+        print(json.dumps(document, indent=2))
+        if document["forbidden_imports"]:
+            print(f"REGRESSION import var28 loads {', '.join(document['forbidden_imports'])}", file=sys.stderr)
+        first_prompt = document["startup"]["first_prompt_ms"]["median"]
+        if first_prompt > args.budget_ms:
+            print(f"REGRESSION first prompt after {first_prompt} ms (budget {args.budget_ms} ms)", file=sys.stderr)
+            return 1
+        return 1 if document["forbidden_imports"] else 0
+    if args.command == "run":
+        modes = {"eager": (False,), "lazy": (True,), "both": (False, True)}[args.mode]
+        document = run_suite(
+            args.shapes.split(","),
+            [int(scale) for scale in args.scales.split(",")],
+            args.workdir,
+            modes,
+            args.seed,
+            args.repeat,
+        )
+        text = json.dumps(document, indent=2)
+        if args.out == "-":
+            print(text)
+        else:
+            with open(args.out, "w") as f:
+                f.write(text + "\n")
+        return 0
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = compare(base, new, args.threshold)
+    for name, before, after, change in regressions:
+        print(f"REGRESSION {name}: {before} -> {after} ({change:+.0%})")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# Built-in commands: name -> handler(shell, args), filled by @command
+COMMANDS = {}
+
+# Exit status of a line that names no known command, as in sh
+COMMAND_NOT_FOUND = 127
+
+
+def command(name):
+    """
+    Decorator registering a handler for a shell command.
+
+    The handler is called as handler(shell, args) where args is the list of
+    tokens after the command name. It may return a non-zero exit status.
+
+    :param name: Name of the command
+    :type name: str
+    """
+
+    def decorator(handler):
+        COMMANDS[name] = handler
+        return handler
+
+    return decorator
+
+
+def tokenize(line):
+    """
+    Splits a command line into tokens. Quotes and backslash escapes are
+    handled like in sh; lines without them take a fast path.
+
+    :param line: The command line
+    :type line: str
+    :raises ValueError: If a quote is not closed
+    :rtype: list[str]
+    """
+    if '"' in line or "'" in line or "\\" in line:
+        import shlex
+
+        return shlex.split(line)
+    return line.split()
+
+
+def split_redirect(line):
+    """
+    Splits a trailing output redirection off a command line, like sh with
+    or without a space after the operator ('> FILE', '>>FILE'). Quoted
+    or escaped '>' characters are not operators.
+
+    :param line: The command line
+    :type line: str
+    :raises ValueError: If a quote is not closed
+    :return: The command without the redirection, and the operator and
+        target (None if the line has no trailing redirection)
+    :rtype: tuple[str, tuple[str, str] or None]
+    """
+    if ">" not in line:
+        return line, None
+    quote = None
+    escaped = False
+    pos = before = -1
+    for i, ch in enumerate(line):
+        if escaped:
+            escaped = False
+        elif ch == "\\" and quote != "'":
+            escaped = True
+        elif quote is not None:
+            if ch == quote:
+                quote = None
+        elif ch in "'\"":
+            quote = ch
+        elif ch == ">":
+            before, pos = pos, i
+    if pos < 0:
+        return line, None
+    start = pos - 1 if before == pos - 1 else pos
+    target = tokenize(line[pos + 1:])
+    if len(target) != 1 or not line[:start].strip():
+        return line, None
+    return line[:start], (line[start:pos + 1], target[0])
+
+
+def parse_flags(args, spec):
+    """
+    Parses short flags in getopt style (e.g. spec "L:d" for '-L 2 -d').
+
+    :param args: Command arguments
+    :type args: list[str]
+    :param spec: getopt short option specification
+    :type spec: str
+    :raises ValueError: On unknown flags or missing values
+    :return: Flags as a {'-L': '2', '-d': ''} dict and the other arguments
+    :rtype: tuple[dict, list[str]]
+    """
+    import getopt
+
+    try:
+        flags, rest = getopt.gnu_getopt(args, spec)
+    except getopt.GetoptError as e:
+        raise ValueError(e.msg) from None
+    return dict(flags), rest
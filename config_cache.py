@@ -0,0 +1,47 @@
+import marshal
+import os
+
+
+def _cache_path(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, "__pycache__", name + ".marshal")
+
+
+def load_toml(path):
+    """
+    Loads a TOML file through a marshal cache in __pycache__ next to it.
+
+    The cache is keyed by the size and modification time of the file, so an
+    edited config is parsed again. While the cache is valid the toml module
+    is not even imported, which is most of the cost of loading a config.
+    Configs marshal cannot store (e.g. with dates) are simply not cached.
+
+    :param path: Path to the TOML file
+    :type path: str
+    :rtype: dict
+    """
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cache_path = _cache_path(path)
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, config = marshal.load(f)
+        if tuple(cached_key) == key:
+            return config
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    import toml
+
+    with open(path, "r") as f:
+        config = toml.load(f)
+    try:
+        data = marshal.dumps((key, config))
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError):
+        # Not cacheable or a read-only location: parse it every time
+        pass
+    return config
@@ -0,0 +1,150 @@
+import io
+import os
+import re
+from codecs import getincrementaldecoder
+
+from lazyzip import LazyZipStore
+
+CHUNK_SIZE = 64 * 1024
+# Recursive grep over less data than this is not worth starting worker processes
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+
+def copy_text(stream, out, chunk_size=CHUNK_SIZE):
+    """
+    Copies a binary stream to a text stream chunk by chunk,
+    decoding it as UTF-8 (invalid bytes are replaced).
+
+    :param stream: Binary stream, e.g. an opened archive member
+    :param out: Text stream, e.g. sys.stdout
+    :return: True if the data did not end with a newline
+    :rtype: bool
+    """
+    decoder = getincrementaldecoder("utf-8")("replace")
+    last = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        text = decoder.decode(chunk, final=not chunk)
+        if text:
+            out.write(text)
+            last = text
+        if not chunk:
+            return bool(last) and not last.endswith("\n")
+
+
+def text_lines(stream):
+    """
+    Iterates over the lines of a binary stream decoded as UTF-8,
+    reading it in buffered chunks.
+
+    :rtype: Iterator[str]
+    """
+    return io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+
+
+def word_count(stream, chunk_size=CHUNK_SIZE):
+    """
+    Counts lines, words and bytes like wc, reading the stream in chunks.
+
+    :rtype: tuple[int, int, int]
+    """
+    lines = words = size = 0
+    in_word = False
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return lines, words, size
+        size += len(chunk)
+        lines += chunk.count(b"\n")
+        words += len(chunk.split())
+        # A word split across two chunks was counted twice
+        if in_word and not chunk[:1].isspace():
+            words -= 1
+        in_word = not chunk[-1:].isspace()
+
+
+def grep_lines(lines, regex):
+    """
+    Yields (line number, line) for the lines matching a compiled regex.
+    Line endings are stripped.
+
+    :rtype: Iterator[tuple[int, str]]
+    """
+    search = regex.search
+    for number, line in enumerate(lines, 1):
+        if search(line):
+            yield number, line.rstrip("\r\n")
+
+
+_worker_stores = {}
+
+
+def grep_member(zip_path, path, pattern, flags):
+    """
+    Greps one archive member; the worker function of grep_members.
+    Each worker process reads through its own LazyZipStore (without a
+    cache: the member is streamed) and keeps it open between calls.
+
+    :return: Matches as (line number, line) pairs
+    :rtype: list[tuple[int, str]]
+    """
+    store = _worker_stores.get(zip_path)
+    if store is None:
+        store = _worker_stores[zip_path] = LazyZipStore(zip_path, cache_size=0)
+    return _grep_store(store, path, re.compile(pattern, flags))
+
+
+def grep_members(store, paths, pattern, flags=0, workers=None):
+    """
+    Greps many members of the archive of a store, in parallel worker
+    processes when there is enough data for it (zip decompression is CPU
+    bound). Members already in the store's cache are read from it in this
+    process, only the others are handed to the workers.
+    Results come back in the order of paths regardless of which worker
+    finishes first.
+
+    :param store: The store of the archive
+    :type store: lazyzip.LazyZipStore
+    :param paths: Member paths (starting with '/')
+    :type paths: list[str]
+    :param pattern: Regular expression
+    :type pattern: str
+    :param flags: re flags
+    :type flags: int
+    :param workers: Number of worker processes, None for one per CPU,
+        1 to grep in this process
+    :type workers: int, optional
+    :rtype: Iterator[tuple[str, list[tuple[int, str]]]]
+    """
+    regex = re.compile(pattern, flags)
+    workers = workers or os.cpu_count() or 1
+    uncached = [path for path in paths if not store.in_cache(path)]
+    total_size = sum(store.size(path) for path in uncached)
+    if workers == 1 or len(uncached) < 2 or total_size < PARALLEL_MIN_BYTES:
+        for path in paths:
+            yield path, _grep_store(store, path, regex)
+        return
+    # Only imported here: it brings in multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    pooled = set(uncached)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(uncached) // (4 * workers))
+        results = executor.map(
+            grep_member,
+            [store.zip_path] * len(uncached),
+            uncached,
+            [pattern] * len(uncached),
+            [flags] * len(uncached),
+            chunksize=chunksize,
+        )
+        for path in paths:
+            if path in pooled:
+                yield path, next(results)
+            else:
+                yield path, _grep_store(store, path, regex)
+
+
+def _grep_store(store, path, regex):
+    with store.open(path) as stream:
+        return list(grep_lines(text_lines(stream), regex))
@@ -0,0 +1,204 @@
+import fnmatch
+import heapq
+import math
+import re
+from array import array
+from bisect import bisect_left
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+# Units of -size as in GNU find; no suffix means 512 byte blocks
+SIZE_UNITS = {"c": 1, "w": 2, "b": 512, "k": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(spec):
+    """
+    Parses a find -size argument such as '+10k', '-1M' or '3'.
+
+    :raises ValueError: If the argument is malformed
+    :return: Comparison (-1 less, 0 equal, 1 greater), amount and unit in bytes
+    :rtype: tuple[int, int, int]
+    """
+    match = re.fullmatch(r"([+-]?)(\d+)([cwbkMG]?)", spec)
+    if match is None:
+        raise ValueError(f"invalid -size argument: '{spec}'")
+    sign, amount, unit = match.groups()
+    return {"+": 1, "-": -1, "": 0}[sign], int(amount), SIZE_UNITS[unit or "b"]
+
+
+class FindIndex:
+    """
+    Indexes of all paths of an image for the 'find' command.
+
+    - paths: every file and directory (directories end with '/') in sorted
+      order, so the subtree of a directory is one contiguous range
+    - by_name: basename -> ascending positions in paths
+    - by_ext: extension (e.g. '.txt') -> ascending positions in paths
+
+    Queries narrow the range of the start directory with bisect and take
+    candidates from the name indexes when the -name pattern allows it.
+    """
+
+    def __init__(self, members):
+        """
+        :param members: (normalized path, size) of every archive member
+        :type members: Iterable[tuple[str, int]]
+        """
+        sizes = {}
+        dirs = {"/"}
+        for path, size in members:
+            sizes[path] = size
+            parent = path.rstrip("/")
+            while parent:
+                parent = parent[: parent.rfind("/")]
+                if parent + "/" in dirs:
+                    break
+                dirs.add(parent + "/")
+        self.paths = sorted(dirs.union(sizes))
+        self.sizes = array("Q", (sizes.get(path, 0) for path in self.paths))
+        self.by_name = {}
+        self.by_ext = {}
+        for i, path in enumerate(self.paths):
+            name = self.basename(path)
+            self.by_name.setdefault(name, []).append(i)
+            dot = name.rfind(".")
+            if dot >= 0:
+                self.by_ext.setdefault(name[dot:], []).append(i)
+
+    @staticmethod
+    def basename(path):
+        """
+        Last component of a path; '' for the root.
+
+        :rtype: str
+        """
+        return path.rstrip("/").rpartition("/")[2]
+
+    def subtree(self, path):
+        """
+        Range of positions of a path and, for a directory, everything below it.
+
+        :param path: File path, or directory path ending with '/'
+        :type path: str
+        :rtype: tuple[int, int]
+        """
+        lo = bisect_left(self.paths, path)
+        if not path.endswith("/"):
+            return lo, lo + (lo < len(self.paths) and self.paths[lo] == path)
+        if path == "/":
+            return lo, len(self.paths)
+        # '0' is the character right after '/'
+        return lo, bisect_left(self.paths, path[:-1] + "0", lo)
+
+    def _name_candidates(self, pattern, lo, hi):
+        if not _GLOB_CHARS.search(pattern):
+            lists = [self.by_name.get(pattern, [])]
+        elif (
+            pattern.startswith("*.")
+            and not _GLOB_CHARS.search(pattern[1:])
+            and "." not in pattern[2:]
+        ):
+            lists = [self.by_ext.get(pattern[1:], [])]
+        else:
+            match = re.compile(fnmatch.translate(pattern)).match
+            lists = [positions for name, positions in self.by_name.items() if match(name)]
+        ranges = []
+        for positions in lists:
+            start = bisect_left(positions, lo)
+            end = bisect_left(positions, hi, start)
+            if start < end:
+                ranges.append(positions[start:end])
+        if len(ranges) == 1:
+            return ranges[0]
+        return heapq.merge(*ranges)
+
+    def query(self, start, name=None, path=None, kind=None, maxdepth=None, size=None, shown=None):
+        """
+        Yields the paths below a directory matching all given predicates,
+        in sorted order, as they are found.
+
+        :param start: Directory to search, ending with '/', or a single file
+        :type start: str
+        :param name: Glob matched against the basename (-name)
+        :type name: str, optional
+        :param path: Glob matched against the path as find prints it, i.e.
+            starting with shown, without the trailing '/' of directories (-path)
+        :type path: str, optional
+        :param kind: 'f' for files, 'd' for directories (-type)
+        :type kind: str, optional
+        :param maxdepth: Maximum depth below start (-maxdepth)
+        :type maxdepth: int, optional
+        :param size: Result of parse_size (-size)
+        :type size: tuple[int, int, int], optional
+        :param shown: start as the user gave it (e.g. '.' or 'docs'),
+            the absolute path by default
+        :type shown: str, optional
+        :rtype: Iterator[str]
+        """
+        lo, hi = self.subtree(start)
+        if shown is None:
+            shown = start.rstrip("/") or "/"
+        shown_prefix = shown if shown.endswith("/") else shown + "/"
+        if path is not None:
+            # Paths matching the glob share its literal prefix; below start
+            # it stands for the same absolute prefix
+            prefix = _GLOB_CHARS.split(path, 1)[0]
+            if prefix.startswith(shown_prefix) and start.endswith("/"):
+                prefix = start + prefix[len(shown_prefix):]
+                lo = max(lo, bisect_left(self.paths, prefix, lo, hi))
+                end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                hi = min(hi, bisect_left(self.paths, end, lo, hi))
+            path_match = re.compile(fnmatch.translate(path)).match
+        base_depth = self.depth(start)
+        if name is not None:
+            candidates = self._name_candidates(name, lo, hi)
+        elif maxdepth is not None:
+            candidates = self._shallow(lo, hi, base_depth + maxdepth)
+        else:
+            candidates = range(lo, hi)
+        paths = self.paths
+        for i in candidates:
+            entry = paths[i]
+            if kind is not None and (kind == "d") != entry.endswith("/"):
+                continue
+            if maxdepth is not None and self.depth(entry) - base_depth > maxdepth:
+                continue
+            if path is not None:
+                relative = entry[len(start):].rstrip("/")
+                if not path_match(shown_prefix + relative if relative else shown):
+                    continue
+            if size is not None:
+                comparison, amount, unit = size
+                units = math.ceil(self.sizes[i] / unit)
+                if (units > amount) - (units < amount) != comparison:
+                    continue
+            yield entry
+
+    def _shallow(self, lo, hi, max_depth):
+        """
+        Positions in lo..hi of the paths at most max_depth deep, skipping
+        the subtree of every directory at that depth with one bisect.
+        """
+        paths = self.paths
+        i = lo
+        while i < hi:
+            entry = paths[i]
+            depth = self.depth(entry)
+            if depth > max_depth:
+                # Range narrowed into a deep subtree: skip to its end
+                entry = "/".join(entry.split("/")[:max_depth + 1]) + "/"
+            else:
+                yield i
+                i += 1
+                if depth < max_depth or not entry.endswith("/"):
+                    continue
+            # '0' is the character right after '/'
+            i = bisect_left(paths, entry[:-1] + "0", i, hi)
+
+    @staticmethod
+    def depth(path):
+        """
+        Number of directories above a path; 0 for the root.
+
+        :rtype: int
+        """
+        return path.rstrip("/").count("/")
@@ -0,0 +1,485 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from commit_cache import cache_path
+from visualize_commits import (
+    build_dependency_graph,
+    get_cached_commit_changes,
+    get_commit_changes,
+    get_commits,
+    load_config_from_xml,
+    save_graph,
+)
+
+SHAPES = ("linear", "merges", "parallel")
+DEFAULT_SCALES = (1000, 100000, 1000000)
+# Commits of a feature branch in the 'merges' shape and lines of the 'parallel' one
+FEATURE_LENGTH = 5
+PARALLEL_BRANCHES = 4
+# Folders per level of the generated paths
+FANOUT = 8
+# Time of the first commit (2024-01-01 00:00:00 UTC) and between two commits
+START_TIMESTAMP = 1704067200
+COMMIT_INTERVAL = 60
+SINCE_DATE = "2023-12-31"
+STAGES = (
+    "load_config",
+    "get_commits",
+    "get_commit_changes",
+    "commit_cache_cold",
+    "commit_cache_warm",
+    "build_graph",
+    "save_graph",
+)
+# Stages too fast to time in a single call: the best of several calls is kept
+REPEATED_STAGES = ("load_config",)
+# tracemalloc slows reading the repository down several times: larger cases
+# are only measured by peak RSS unless asked for
+TRACE_MAX_COMMITS = 10000
+# Counts describing a case rather than costs, not compared between runs
+CASE_KEYS = ("commits", "files_per_commit", "depth", "files", "nodes", "edges")
+
+
+def file_path(file_id: int, depth: int) -> str:
+    """
+    Path of a generated file: depth levels of folders with FANOUT folders each.
+
+    Args:
+        file_id (int): Number of the file.
+        depth (int): Number of folders above the file.
+
+    Returns:
+        str: '/'-separated path, e.g. 'd0/d1/d4/file100.txt'.
+    """
+    folders = [f"d{(file_id // FANOUT ** level) % FANOUT}" for level in range(depth, 0, -1)]
+    return "/".join(folders + [f"file{file_id}.txt"])
+
+
+def generate_commits(
+    shape: str, commits: int, files_per_commit: int = 3, depth: int = 3, files: int = 10000, seed: int = 0
+) -> Iterator[Tuple[str, List[int], List[str]]]:
+    """
+    Generate the history of a synthetic repository. Commits are numbered in
+    the order they are yielded, which is also their chronological order, and
+    the same arguments always give the same history.
+
+    - linear: a single chain of commits on main
+    - merges: a commit on main, then a feature branch of FEATURE_LENGTH commits
+      merged back into main, over and over. A merge changes every file its
+      feature branch changed.
+    - parallel: PARALLEL_BRANCHES lines of development forked from the first
+      commit and advanced in turn, joined by an octopus merge into main as
+      the last commit. The merge keeps the tree of main.
+
+    Args:
+        shape (str): One of SHAPES.
+        commits (int): Number of commits, merges included; all are reachable from main.
+        files_per_commit (int): Files changed by every commit that is not a merge.
+        depth (int): Number of folders above every file.
+        files (int): Number of different files the changes are spread over.
+        seed (int): Seed of the choice of files.
+
+    Yields:
+        Tuple[str, List[int], List[str]]: The ref the commit is made on, the
+        numbers of its parents (first parent first) and the paths it changes.
+
+    Raises:
+        ValueError: If the shape is unknown.
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown shape: {shape}")
+    rng = random.Random(seed)
+    files_per_commit = min(files_per_commit, files)
+
+    def changes() -> List[str]:
+        return sorted(file_path(file_id, depth) for file_id in rng.sample(range(files), files_per_commit))
+
+    main = "refs/heads/main"
+    if commits <= 0:
+        return
+    yield main, [], changes()
+    index = 1
+    if shape == "linear":
+        for index in range(1, commits):
+            yield main, [index - 1], changes()
+    elif shape == "merges":
+        tip = 0
+        while index < commits:
+            if commits - index < FEATURE_LENGTH + 2:
+                yield main, [tip], changes()
+                tip = index
+                index += 1
+                continue
+            yield main, [tip], changes()
+            tip = index
+            feature = set()
+            for parent in range(index, index + FEATURE_LENGTH):
+                paths = changes()
+                feature.update(paths)
+                yield "refs/heads/feature", [parent], paths
+            index += FEATURE_LENGTH + 1
+            yield main, [tip, index - 1], sorted(feature)
+            tip = index
+            index += 1
+    else:
+        tips = [0] * PARALLEL_BRANCHES
+        for index in range(1, commits - 1):
+            line = index % PARALLEL_BRANCHES
+            yield main if line == 0 else f"refs/heads/line{line}", [tips[line]], changes()
+            tips[line] = index
+        if commits > 1:
+            # dict keeps the order: main's tip stays the first parent
+            yield main, list(dict.fromkeys(tips)), []
+
+
+def build_repository(
+    path: str, shape: str, commits: int, files_per_commit: int = 3, depth: int = 3, files: int = 10000, seed: int = 0
+) -> str:
+    """
+    Create a bare repository with a synthetic history (see generate_commits)
+    by streaming it into 'git fast-import'.
+
+    Args:
+        path (str): Directory of the repository to create.
+        shape, commits, files_per_commit, depth, files, seed: See generate_commits.
+
+    Returns:
+        str: path
+
+    Raises:
+        RuntimeError: If git fails.
+    """
+    subprocess.run(["git", "init", "-q", "--bare", "-b", "main", path], check=True)
+    process = subprocess.Popen(["git", "-C", path, "fast-import", "--quiet"], stdin=subprocess.PIPE)
+    with io.BufferedWriter(process.stdin, 1024 * 1024) as out:
+        history = generate_commits(shape, commits, files_per_commit, depth, files, seed)
+        for index, (ref, parents, paths) in enumerate(history):
+            lines = [
+                f"commit {ref}\nmark :{index + 1}\n"
+                f"committer bench <bench@example.com> {START_TIMESTAMP + index * COMMIT_INTERVAL} +0000\n"
+                f"data 0\n"
+            ]
+            if parents:
+                lines.append(f"from :{parents[0] + 1}\n")
+            lines.extend(f"merge :{parent + 1}\n" for parent in parents[1:])
+            for file in paths:
+                content = f"{index} {file}\n"
+                lines.append(f"M 100644 inline {file}\ndata {len(content)}\n{content}\n")
+            lines.append("\n")
+            out.write("".join(lines).encode("ascii"))
+    if process.wait() != 0:
+        raise RuntimeError(f"git fast-import failed with exit code {process.returncode}")
+    return path
+
+
+def cached_repository(
+    workdir: str, shape: str, commits: int, files_per_commit: int = 3, depth: int = 3, files: int = 10000, seed: int = 0
+) -> str:
+    """
+    Path of a synthetic repository in workdir, building it first if it does
+    not exist yet.
+
+    Returns:
+        str: Path to the bare repository.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    path = os.path.join(workdir, f"{shape}-{commits}-{files_per_commit}-{depth}-{files}-{seed}.git")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        build_repository(tmp_path, shape, commits, files_per_commit, depth, files, seed)
+        os.replace(tmp_path, path)
+    return path
+
+
+def _write_config(workdir: str, repo_path: str) -> str:
+    config_file = os.path.join(workdir, "config.xml")
+    with open(config_file, "w", encoding="utf-8") as f:
+        f.write(
+            "<config>\n"
+            f"    <repository_path>{repo_path}</repository_path>\n"
+            f"    <graph_output_path>{os.path.join(workdir, 'graph')}</graph_output_path>\n"
+            f"    <since_date>{SINCE_DATE}</since_date>\n"
+            "    <branch>main</branch>\n"
+            "</config>\n"
+        )
+    return config_file
+
+
+def _stages(config_file: str, data: dict) -> List[Tuple[str, Callable[[], None]]]:
+    """
+    The steps of the visualizer as (stage, function) pairs, in STAGES order.
+    Each step keeps what later ones need in data.
+    """
+    def load_config():
+        data["config"] = load_config_from_xml(config_file)
+
+    def commits():
+        config = data["config"]
+        data["commits"] = sum(1 for _ in get_commits(config["repository_path"], config["since_date"]))
+
+    def commit_changes():
+        config = data["config"]
+        data["changes"] = list(get_commit_changes(config["repository_path"], config["branch"], config["since_date"]))
+
+    def commit_cache():
+        config = data["config"]
+        cache_file = cache_path(config["graph_output_path"], config["branch"])
+        for _ in get_cached_commit_changes(config["repository_path"], config["branch"], config["since_date"], cache_file):
+            pass
+
+    def cold_cache():
+        config = data["config"]
+        cache_file = cache_path(config["graph_output_path"], config["branch"])
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        commit_cache()
+
+    def graph():
+        data["graph"] = build_dependency_graph(data["changes"])
+
+    def save():
+        with redirect_stdout(io.StringIO()):
+            save_graph(data["graph"], data["config"]["graph_output_path"])
+
+    return list(zip(STAGES, (load_config, commits, commit_changes, cold_cache, commit_cache, graph, save)))
+
+
+def run_case(repo_path: str, repeat: int = 5, trace: bool = True) -> dict:
+    """
+    Measure every stage of the visualizer on one repository in the current
+    process. Meant to run in a fresh interpreter (see run_suite), so peak
+    RSS belongs to this case alone.
+
+    The stages run once for the wall time, and once more under tracemalloc
+    for the memory each one allocates on top of what earlier stages left.
+    The peak RSS after a stage is the peak of the process so far.
+
+    Args:
+        repo_path (str): Path to the repository.
+        repeat (int): Calls of the REPEATED_STAGES to take the best time of.
+        trace (bool): Also measure the memory of every stage.
+
+    Returns:
+        dict: Times and memory by stage, and the size of the graph.
+    """
+    workdir = tempfile.mkdtemp(prefix="gitdz-bench-")
+    try:
+        config_file = _write_config(workdir, repo_path)
+        stages = {}
+        data = {}
+        for name, function in _stages(config_file, data):
+            samples = []
+            for _ in range(repeat if name in REPEATED_STAGES else 1):
+                started = time.perf_counter()
+                function()
+                samples.append(time.perf_counter() - started)
+            stages[name] = {
+                "seconds": round(min(samples), 6),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+        graph = data["graph"]
+        result = {
+            "commits": data["commits"],
+            "nodes": len(graph),
+            "edges": len(graph.sources),
+            "puml_bytes": os.path.getsize(f"{data['config']['graph_output_path']}.puml"),
+            "stages": stages,
+        }
+        data.clear()
+        if trace:
+            tracemalloc.start()
+            try:
+                for name, function in _stages(config_file, data):
+                    tracemalloc.reset_peak()
+                    before = tracemalloc.get_traced_memory()[0]
+                    function()
+                    stages[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1] - before
+            finally:
+                tracemalloc.stop()
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_suite(
+    shapes: List[str],
+    scales: List[int],
+    workdir: str,
+    files_per_commit: int = 3,
+    depth: int = 3,
+    files: int = 10000,
+    seed: int = 0,
+    repeat: int = 5,
+    trace_max_commits: Optional[int] = TRACE_MAX_COMMITS,
+) -> dict:
+    """
+    Run every shape x scale in its own interpreter. Only cases of at most
+    trace_max_commits commits (all if None) get the tracemalloc pass.
+
+    Returns:
+        dict: The results document (see main).
+    """
+    results = []
+    for shape in shapes:
+        for commits in scales:
+            repo_path = cached_repository(workdir, shape, commits, files_per_commit, depth, files, seed)
+            trace = trace_max_commits is None or commits <= trace_max_commits
+            fd, case_out = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            try:
+                subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "case", repo_path,
+                     "--out", case_out, "--repeat", str(repeat)] + ([] if trace else ["--no-trace"]),
+                    check=True,
+                )
+                with open(case_out) as f:
+                    result = json.load(f)
+            finally:
+                os.remove(case_out)
+            results.append({
+                "shape": shape,
+                "files_per_commit": files_per_commit,
+                "depth": depth,
+                "files": files,
+                **result,
+            })
+            print(f"{shape} {commits}: done", file=sys.stderr)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": subprocess.run(["git", "--version"], capture_output=True, text=True).stdout.strip(),
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def _flatten(value, prefix: str = "") -> Iterator[Tuple[str, float]]:
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}{key}.")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix.rstrip("."), value
+
+
+def compare(base: dict, new: dict, threshold: float = 0.1) -> List[Tuple[str, float, float, float]]:
+    """
+    Compare two results documents case by case. Every metric is a cost, so
+    an increase by more than threshold is a regression.
+
+    Args:
+        base (dict): The earlier results.
+        new (dict): The results to check.
+        threshold (float): Relative change reported as a regression.
+
+    Returns:
+        List[Tuple[str, float, float, float]]: (metric, base value, new value,
+        relative change) of every regression.
+    """
+    def key(result: dict) -> Tuple:
+        return tuple(result[name] for name in ("shape", "commits", "files_per_commit", "depth", "files"))
+
+    base_cases: Dict[Tuple, dict] = {key(result): result for result in base["results"]}
+    regressions = []
+    for result in new["results"]:
+        old = base_cases.get(key(result))
+        if old is None:
+            continue
+        old_metrics = dict(_flatten(old))
+        for metric, value in _flatten(result):
+            if metric in CASE_KEYS:
+                continue
+            before = old_metrics.get(metric)
+            if not before:
+                continue
+            change = (value - before) / before
+            if change > threshold:
+                regressions.append((f"{result['shape']}/{result['commits']}/{metric}", before, value, change))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python benchmark.py", description="Commit visualizer benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the suite and write results as JSON")
+    run_parser.add_argument("--shapes", default=",".join(SHAPES))
+    run_parser.add_argument("--scales", default="1000,100000",
+                            help=f"comma separated commit counts, e.g. {','.join(map(str, DEFAULT_SCALES))}")
+    run_parser.add_argument("--files-per-commit", type=int, default=3)
+    run_parser.add_argument("--depth", type=int, default=3, help="folders above every file")
+    run_parser.add_argument("--files", type=int, default=10000, help="different files in the repository")
+    run_parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "gitdz-bench-repos"),
+                            help="where generated repositories are kept between runs")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--trace-max-commits", type=int, default=TRACE_MAX_COMMITS,
+                            help="largest case measured with tracemalloc (-1 for all)")
+    run_parser.add_argument("--out", default="-", help="results file ('-' for stdout)")
+
+    case_parser = subparsers.add_parser("case", help="measure a single repository (used by run)")
+    case_parser.add_argument("repository")
+    case_parser.add_argument("--repeat", type=int, default=5)
+    case_parser.add_argument("--no-trace", action="store_true")
+    case_parser.add_argument("--out", required=True)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command == "case":
+        result = run_case(args.repository, args.repeat, not args.no_trace)
+        with open(args.out, "w") as f:
+            json.dump(result, f)
+        return 0
+    if args.command == "run":
+        document = run_suite(
+            args.shapes.split(","),
+            [int(scale) for scale in args.scales.split(",")],
+            args.workdir,
+            args.files_per_commit,
+            args.depth,
+            args.files,
+            args.seed,
+            args.repeat,
+            None if args.trace_max_commits < 0 else args.trace_max_commits,
+        )
+        text = json.dumps(document, indent=2)
+        if args.out == "-":
+            print(text)
+        else:
+            with open(args.out, "w") as f:
+                f.write(text + "\n")
+        return 0
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = compare(base, new, args.threshold)
+    for name, before, after, change in regressions:
+        print(f"REGRESSION {name}: {before} -> {after} ({change:+.0%})")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
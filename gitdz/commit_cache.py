@@ -0,0 +1,295 @@
+import marshal
+import os
+import re
+import sys
+from array import array
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from git_objects import GitRepository
+
+CACHE_VERSION = 2
+SHA_SIZE = 20
+
+
+def cache_path(graph_output_path: str, branch: str) -> str:
+    """
+    Path of the commit cache of a branch, next to the graph output.
+
+    Args:
+        graph_output_path (str): Path to the output file without extension.
+        branch (str): Branch name.
+
+    Returns:
+        str: '<graph_output_path>.<branch>.commits', with unsafe characters of the branch replaced.
+    """
+    return f"{graph_output_path}.{re.sub(r'[^A-Za-z0-9._-]', '_', branch)}.commits"
+
+
+def _extend_ends(ends: array, data: bytes) -> None:
+    # Chunk offsets start at 0; make them continue from the last one
+    chunk_ends = array("q")
+    chunk_ends.frombytes(data)
+    if ends and ends[-1]:
+        base = ends[-1]
+        chunk_ends = array("q", [end + base for end in chunk_ends])
+    ends.extend(chunk_ends)
+
+
+class CommitCache:
+    """
+    The processed commits of one branch: for every commit its parents, time
+    and the files it touched, plus the branch tip they were read up to.
+
+    Commits are stored column by column (concatenated shas, arrays of
+    timestamps and of ids into one table of path names), so loading does not
+    build objects per commit. The file is a sequence of marshal chunks: a
+    header, then one chunk per update with the new tip, the commits it
+    added and the path names it introduced. An update appends only its own
+    chunk; the file is rewritten only when the history was rewritten (or
+    the file is damaged).
+    """
+
+    def __init__(self, path: str, branch: str, since_date: str):
+        """
+        Args:
+            path (str): Cache file, see cache_path.
+            branch (str): The branch the cache is for.
+            since_date (str): Oldest commit date included, as in the config.
+        """
+        self.path = path
+        self.branch = branch
+        self.since_date = since_date
+        self._clear()
+
+    def _clear(self) -> None:
+        self.tip = None
+        # raw sha -> row; rows are in the order commits were added
+        self.rows = {}
+        self._shas = []
+        self._timestamps = array("q")
+        self._parents = bytearray()
+        self._parent_ends = array("q")
+        self._paths = array("l")
+        self._path_ends = array("q")
+        self._path_names = []
+        # name -> id, built when the first commit is added
+        self._path_ids = None
+        self._appendable = False
+
+    def _header(self) -> dict:
+        return {
+            "version": CACHE_VERSION,
+            "byteorder": sys.byteorder,
+            "branch": self.branch,
+            "since": self.since_date,
+        }
+
+    def __len__(self) -> int:
+        return len(self._shas)
+
+    def load(self) -> bool:
+        """
+        Read the cache file. A missing file, or one made for another branch,
+        since date or format version, leaves the cache empty.
+
+        Returns:
+            bool: True if anything was loaded.
+        """
+        self._clear()
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                if marshal.load(f) != self._header():
+                    return False
+            except (EOFError, ValueError, TypeError):
+                return False
+            size = os.fstat(f.fileno()).st_size
+            while True:
+                if f.tell() == size:
+                    # Only a clean end of file allows appending to it
+                    self._appendable = True
+                    break
+                try:
+                    chunk = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    # A chunk cut short by a crash: keep what was read before it
+                    break
+                self._add_chunk(chunk)
+        return True
+
+    def _make_chunk(self, tip: bytes, commits: Iterable[Tuple[bytes, int, List[bytes], List[str]]]) -> dict:
+        """
+        Encode (sha, timestamp, parents, paths) records as a chunk; path names
+        that are not in the table yet are listed in the chunk.
+        """
+        if self._path_ids is None:
+            self._path_ids = {name: i for i, name in enumerate(self._path_names)}
+        path_ids = self._path_ids
+        new_names = []
+        shas = bytearray()
+        timestamps = array("q")
+        parents = bytearray()
+        parent_ends = array("q")
+        paths = array("l")
+        path_ends = array("q")
+        for sha, timestamp, commit_parents, commit_paths in commits:
+            shas += sha
+            timestamps.append(timestamp)
+            parents += b"".join(commit_parents)
+            parent_ends.append(len(parents))
+            for name in commit_paths:
+                path_id = path_ids.get(name)
+                if path_id is None:
+                    path_id = path_ids[name] = len(self._path_names) + len(new_names)
+                    new_names.append(name)
+                paths.append(path_id)
+            path_ends.append(len(paths))
+        return {
+            "tip": tip,
+            "shas": bytes(shas),
+            "timestamps": timestamps.tobytes(),
+            "parents": bytes(parents),
+            "parent_ends": parent_ends.tobytes(),
+            "paths": paths.tobytes(),
+            "path_ends": path_ends.tobytes(),
+            "path_names": new_names,
+        }
+
+    def _add_chunk(self, chunk: dict) -> None:
+        self.tip = chunk["tip"]
+        shas = chunk["shas"]
+        row = len(self._shas)
+        for pos in range(0, len(shas), SHA_SIZE):
+            sha = shas[pos:pos + SHA_SIZE]
+            self.rows[sha] = row
+            self._shas.append(sha)
+            row += 1
+        self._timestamps.frombytes(chunk["timestamps"])
+        self._parents += chunk["parents"]
+        _extend_ends(self._parent_ends, chunk["parent_ends"])
+        self._paths.frombytes(chunk["paths"])
+        _extend_ends(self._path_ends, chunk["path_ends"])
+        if self._path_ids is not None:
+            for i, name in enumerate(chunk["path_names"], len(self._path_names)):
+                self._path_ids.setdefault(name, i)
+        self._path_names.extend(chunk["path_names"])
+
+    def parents(self, row: int) -> List[bytes]:
+        start = self._parent_ends[row - 1] if row else 0
+        data = bytes(self._parents[start:self._parent_ends[row]])
+        return [data[pos:pos + SHA_SIZE] for pos in range(0, len(data), SHA_SIZE)]
+
+    def paths(self, row: int) -> List[str]:
+        start = self._path_ends[row - 1] if row else 0
+        names = self._path_names
+        return [names[i] for i in self._paths[start:self._path_ends[row]]]
+
+    def _closure(self, starts: Iterable[bytes], target: Optional[bytes] = None) -> Set[bytes]:
+        """
+        Cached commits reachable from starts through the cached parent links,
+        stopping early once target is reached.
+        """
+        reached = set()
+        stack = [sha for sha in starts if sha in self.rows]
+        while stack:
+            sha = stack.pop()
+            if sha in reached:
+                continue
+            reached.add(sha)
+            if sha == target:
+                break
+            stack.extend(parent for parent in self.parents(self.rows[sha]) if parent in self.rows)
+        return reached
+
+    def update(self, repo: GitRepository, since: Optional[int] = None) -> int:
+        """
+        Bring the cache up to the branch's current tip, reading only the
+        commits that are not in it yet.
+
+        If the old tip is not an ancestor of the new one (the merge base of
+        the two is not the old tip), the history was rewritten: cached
+        commits that are no longer reachable from the new tip are dropped.
+
+        Args:
+            repo (GitRepository): The repository.
+            since (Optional[int]): Unix time of the oldest commit to include.
+
+        Returns:
+            int: Number of commits read from the repository.
+        """
+        tip = repo.resolve(self.branch)
+        if tip == self.tip:
+            return 0
+        new = list(repo.walk(tip, since, exclude=self.rows))
+        # Cached commits the walk ran into, where the new history joins the old
+        joins = {parent for commit in new for parent in commit.parents if parent in self.rows}
+        if tip in self.rows:
+            joins.add(tip)
+        rewritten = self.tip is not None and self.tip not in joins and self.tip not in self._closure(joins, self.tip)
+        if rewritten:
+            self._keep(self._closure(joins))
+        chunk = self._make_chunk(tip, (
+            (commit.sha, commit.timestamp, commit.parents, sorted(repo.changed_paths(commit)))
+            for commit in reversed(new)
+        ))
+        self._add_chunk(chunk)
+        if rewritten or not self._appendable:
+            self._rewrite()
+        else:
+            with open(self.path, "ab") as f:
+                marshal.dump(chunk, f)
+        return len(new)
+
+    def _keep(self, shas: Set[bytes]) -> None:
+        """
+        Drop every commit not in shas, and the path names no longer used.
+        """
+        kept = [
+            (sha, self._timestamps[row], self.parents(row), self.paths(row))
+            for sha, row in self.rows.items()
+            if sha in shas
+        ]
+        tip = self.tip
+        self._clear()
+        self._add_chunk(self._make_chunk(tip, kept))
+
+    def _rewrite(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            marshal.dump(self._header(), f)
+            marshal.dump({
+                "tip": self.tip,
+                "shas": b"".join(self._shas),
+                "timestamps": self._timestamps.tobytes(),
+                "parents": bytes(self._parents),
+                "parent_ends": self._parent_ends.tobytes(),
+                "paths": self._paths.tobytes(),
+                "path_ends": self._path_ends.tobytes(),
+                "path_names": self._path_names,
+            }, f)
+        os.replace(tmp_path, self.path)
+        self._appendable = True
+
+    def sha(self, row: int) -> bytes:
+        return self._shas[row]
+
+    def latest_timestamp(self) -> int:
+        return max(self._timestamps, default=0)
+
+    def records(self, start: int = 0) -> Iterator[Tuple[bytes, int, List[str]]]:
+        """
+        The cached commits, oldest first.
+
+        Args:
+            start (int): Skip the commits that were added to the cache before
+                row start (rows are numbered in the order commits are added).
+
+        Yields:
+            Tuple[bytes, int, List[str]]: (sha, timestamp, paths) of every commit.
+        """
+        timestamps = self._timestamps
+        for row in sorted(range(start, len(self._shas)), key=timestamps.__getitem__):
+            yield self._shas[row], timestamps[row], self.paths(row)
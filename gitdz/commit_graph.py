@@ -0,0 +1,284 @@
+from array import array
+from typing import Iterable, Iterator, Optional, Set, TextIO, Tuple
+
+FILE = 0
+FOLDER = 1
+COMMIT = 2
+# PlantUML element used for each node kind
+_ELEMENTS = ("file", "folder", "rectangle")
+WRITE_BUFFER = 1024 * 1024
+PLANTUML_END = "@enduml\n"
+
+
+def folders_of(paths: Iterable[str]) -> Set[str]:
+    """
+    All folders containing the given paths, e.g. 'a' and 'a/b' for 'a/b/c.txt'.
+
+    Args:
+        paths (Iterable[str]): '/'-separated file paths.
+
+    Returns:
+        Set[str]: The folder paths.
+    """
+    folders = set()
+    for path in paths:
+        end = path.rfind("/")
+        while end > 0 and path[:end] not in folders:
+            folders.add(path[:end])
+            end = path.rfind("/", 0, end)
+    return folders
+
+
+def collapse_path(path: str, max_depth: Optional[int]) -> Tuple[int, str]:
+    """
+    The node a changed file is shown as: the file itself, or with max_depth
+    the folder max_depth levels down (at least the top folder) when the
+    file is nested deeper than that.
+
+    Args:
+        path (str): '/'-separated file path.
+        max_depth (Optional[int]): Number of folder levels shown, None for all.
+
+    Returns:
+        Tuple[int, str]: Node kind (FILE or FOLDER) and path.
+    """
+    if max_depth is None or path.count("/") <= max_depth:
+        return FILE, path
+    end = -1
+    for _ in range(max(max_depth, 1)):
+        end = path.find("/", end + 1)
+    return FOLDER, path[:end]
+
+
+class CommitGraph:
+    """
+    Graph of commits and the files and folders they touched.
+
+    Nodes are small integers: their kind is kept in a bytearray and their
+    label in a list, and a file or folder is interned so that it is a
+    single node however many commits touch it. Edges are two parallel
+    arrays. Commits are chained in the order they are added (oldest first),
+    and every commit points to each file and folder it touched.
+
+    A graph can be continued later from its state() (see resume): the
+    continuation only holds the nodes and edges added to it.
+    """
+
+    def __init__(self, max_depth: Optional[int] = None):
+        """
+        Args:
+            max_depth (Optional[int]): Collapse folder subtrees deeper than this
+                many levels into their top folder (see collapse_path).
+        """
+        self.max_depth = max_depth
+        self.kinds = bytearray()
+        self.labels = []
+        self.commits = array("l")
+        self.sources = array("l")
+        self.targets = array("l")
+        # Nodes left out by cap(); None while every node is shown
+        self.hidden = None
+        self.omitted_commits = 0
+        # Id of the first node held; not 0 in a resumed graph
+        self.first = 0
+        self._last_commit = None
+        self._paths = {}
+
+    @classmethod
+    def resume(cls, state: dict) -> "CommitGraph":
+        """
+        Continue a graph from its state(): new commits are chained to its
+        last commit and reuse its file and folder nodes. The resumed graph
+        holds only what is added to it, so it cannot be reduced or capped.
+
+        Args:
+            state (dict): The state of the graph to continue.
+
+        Returns:
+            CommitGraph: An empty graph whose nodes are numbered on from the old one.
+        """
+        graph = cls(state["max_depth"])
+        graph.first = state["nodes"]
+        graph._last_commit = state["last_commit"]
+        graph._paths = state["paths"]
+        return graph
+
+    def state(self) -> dict:
+        """
+        What resume needs to continue the graph, as marshal-able values:
+        the number of nodes, the last commit and the file and folder nodes.
+
+        Returns:
+            dict: The state.
+        """
+        return {
+            "max_depth": self.max_depth,
+            "nodes": len(self),
+            "last_commit": self._last_commit,
+            "paths": self._paths,
+        }
+
+    def __len__(self) -> int:
+        return self.first + len(self.kinds)
+
+    def _node(self, kind: int, label: str) -> int:
+        self.kinds.append(kind)
+        self.labels.append(label)
+        return len(self) - 1
+
+    def path_node(self, kind: int, path: str) -> int:
+        """
+        The node of a file or folder, created on first use.
+
+        Args:
+            kind (int): FILE or FOLDER.
+            path (str): '/'-separated path.
+
+        Returns:
+            int: The node id.
+        """
+        key = (kind, path)
+        node = self._paths.get(key)
+        if node is None:
+            node = self._paths[key] = self._node(kind, path)
+        return node
+
+    def add_commit(self, commit: str, date: str, paths: Iterable[str] = ()) -> int:
+        """
+        Add a commit after the previous one, with edges to what it touched.
+
+        Args:
+            commit (str): The commit hash.
+            date (str): The commit date.
+            paths (Iterable[str]): Paths of the files it changed.
+
+        Returns:
+            int: The commit's node id.
+        """
+        node = self._node(COMMIT, f"Commit: {commit}\\nDate: {date}")
+        if self._last_commit is not None:
+            self.sources.append(self._last_commit)
+            self.targets.append(node)
+        self.commits.append(node)
+        self._last_commit = node
+        touched = sorted({collapse_path(path, self.max_depth) for path in paths})
+        folders = sorted(folders_of(path for _, path in touched))
+        targets = {self.path_node(FOLDER, folder) for folder in folders}
+        targets.update(self.path_node(kind, path) for kind, path in touched)
+        for target in sorted(targets):
+            self.sources.append(node)
+            self.targets.append(target)
+        return node
+
+    def edges(self) -> Iterator[Tuple[int, int]]:
+        hidden = self.hidden
+        for source, target in zip(self.sources, self.targets):
+            if hidden is None or not (hidden[source] or hidden[target]):
+                yield source, target
+
+    def nodes(self) -> Iterator[Tuple[int, int, str]]:
+        """
+        Yields:
+            Tuple[int, int, str]: Id, kind and label of every shown node.
+        """
+        hidden = self.hidden
+        for node, (kind, label) in enumerate(zip(self.kinds, self.labels), self.first):
+            if hidden is None or not hidden[node]:
+                yield node, kind, label
+
+    def transitive_reduction(self) -> None:
+        """
+        Remove the edges implied by others. Commits form a chain and files
+        and folders have no outgoing edges, so an edge from a commit to a
+        file or folder is implied exactly when a later commit touches it
+        too: only the last commit touching each file and folder keeps its
+        edge. The chain itself is never redundant.
+        """
+        kinds = self.kinds
+        last = {}
+        for i, (source, target) in enumerate(zip(self.sources, self.targets)):
+            if kinds[target] != COMMIT:
+                last[target] = i
+        keep = [i for i, target in enumerate(self.targets) if kinds[target] == COMMIT or last[target] == i]
+        self.sources = array("l", [self.sources[i] for i in keep])
+        self.targets = array("l", [self.targets[i] for i in keep])
+
+    def cap(self, max_nodes: int) -> None:
+        """
+        Limit the graph to about max_nodes nodes by leaving out the oldest
+        commits and the files and folders only they point to. The newest
+        commit is always kept.
+
+        Args:
+            max_nodes (int): Maximum number of nodes to show.
+        """
+        if len(self) <= max_nodes:
+            return
+        kinds = self.kinds
+        out = {}
+        for source, target in zip(self.sources, self.targets):
+            if kinds[target] != COMMIT:
+                out.setdefault(source, []).append(target)
+        hidden = bytearray(b"\1") * len(self)
+        shown = 0
+        kept_commits = 0
+        for commit in reversed(self.commits):
+            new = [target for target in out.get(commit, ()) if hidden[target]]
+            if kept_commits and shown + 1 + len(new) > max_nodes:
+                break
+            hidden[commit] = 0
+            for target in new:
+                hidden[target] = 0
+            shown += 1 + len(new)
+            kept_commits += 1
+        self.hidden = hidden
+        self.omitted_commits = len(self.commits) - kept_commits
+
+
+def write_plantuml(graph: CommitGraph, out: TextIO) -> None:
+    """
+    Stream the graph as PlantUML code (see write_plantuml_body).
+
+    Args:
+        graph (CommitGraph): The graph.
+        out (TextIO): Where to write, e.g. a buffered file.
+    """
+    out.write("@startuml\n")
+    write_plantuml_body(graph, out)
+    out.write(PLANTUML_END)
+
+
+def write_plantuml_body(graph: CommitGraph, out: TextIO) -> None:
+    """
+    Stream the nodes and edges of the graph, every node declared right
+    before the first edge that uses it. Commits are added oldest first, so
+    the code of a resumed graph continues that of the old graph exactly as
+    if the whole graph had been written at once.
+
+    Args:
+        graph (CommitGraph): The graph.
+        out (TextIO): Where to write, e.g. a buffered file.
+    """
+    write = out.write
+    hidden = graph.hidden
+    kinds = graph.kinds
+    labels = graph.labels
+    first = graph.first
+
+    def declare(end: int) -> None:
+        for node in range(declared, end):
+            if hidden is None or not hidden[node]:
+                # Labels cannot contain double quotes in PlantUML
+                label = labels[node - first].replace(chr(34), chr(39))
+                write(f'{_ELEMENTS[kinds[node - first]]} "{label}" as n{node}\n')
+
+    declared = first
+    for source, target in graph.edges():
+        end = max(source, target) + 1
+        if end > declared:
+            declare(end)
+            declared = end
+        write(f"n{source} --> n{target}\n")
+    declare(len(graph))
+    if graph.omitted_commits:
+        write(f'note "{graph.omitted_commits} older commits not shown" as omitted\n')
@@ -0,0 +1,614 @@
+import glob
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import OrderedDict, namedtuple
+from heapq import heappop, heappush
+from typing import Container, Dict, Iterator, List, Optional, Set, Tuple
+
+# Object type numbers as stored in packfiles
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+_LOOSE_TYPES = {b"commit": OBJ_COMMIT, b"tree": OBJ_TREE, b"blob": OBJ_BLOB, b"tag": OBJ_TAG}
+_TREE_MODE = b"40000"
+# '<mode> <name>\0<20-byte sha>'
+_TREE_ENTRY = re.compile(rb"(\d+) ([^\0]*)\0(.{20})", re.DOTALL)
+_IDX_MAGIC = b"\377tOc"
+# Default size of the cache of resolved delta bases and trees
+CACHE_BYTES = 64 * 1024 * 1024
+# Parsed trees kept for the next diff (a commit's trees are its child's old side)
+TREE_CACHE_ENTRIES = 4096
+
+Commit = namedtuple("Commit", "sha tree parents timestamp")
+Commit.__doc__ = """A parsed commit: raw 20-byte sha, tree and parent shas, committer time."""
+
+
+class GitError(Exception):
+    """Raised for a missing object or ref, or a corrupt repository."""
+
+
+class ObjectCache:
+    """
+    LRU cache of resolved objects bounded by the total size of their data.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def put(self, key, obj_type: int, data: bytes) -> None:
+        if len(data) > self.max_bytes or key in self._items:
+            return
+        self._items[key] = (obj_type, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """
+    Apply a git delta (copy/insert instructions) to its base object.
+
+    Args:
+        base (bytes): The base object.
+        delta (bytes): The delta data.
+
+    Returns:
+        bytes: The resulting object.
+
+    Raises:
+        GitError: If the delta does not fit the base.
+    """
+    pos = 0
+    sizes = []
+    for _ in range(2):
+        size = shift = 0
+        while True:
+            byte = delta[pos]
+            pos += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        sizes.append(size)
+    base_size, result_size = sizes
+    if base_size != len(base):
+        raise GitError("delta base size mismatch")
+    out = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            if op & 0x01:
+                offset = delta[pos]
+                pos += 1
+            if op & 0x02:
+                offset |= delta[pos] << 8
+                pos += 1
+            if op & 0x04:
+                offset |= delta[pos] << 16
+                pos += 1
+            if op & 0x08:
+                offset |= delta[pos] << 24
+                pos += 1
+            if op & 0x10:
+                size = delta[pos]
+                pos += 1
+            if op & 0x20:
+                size |= delta[pos] << 8
+                pos += 1
+            if op & 0x40:
+                size |= delta[pos] << 16
+                pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise GitError("invalid delta opcode 0")
+    if len(out) != result_size:
+        raise GitError("delta result size mismatch")
+    return bytes(out)
+
+
+class Pack:
+    """
+    A packfile with its .idx index (version 1 or 2), both memory-mapped.
+    """
+
+    def __init__(self, idx_path: str):
+        """
+        Args:
+            idx_path (str): Path to the .idx file; the .pack file is next to it.
+        """
+        self.idx_path = idx_path
+        with open(idx_path, "rb") as f:
+            self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(idx_path[:-4] + ".pack", "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        idx = self._idx
+        if idx[:4] == _IDX_MAGIC:
+            if struct.unpack(">L", idx[4:8])[0] != 2:
+                raise GitError(f"unsupported pack index version: {idx_path}")
+            self._version = 2
+            fanout_start = 8
+        else:
+            self._version = 1
+            fanout_start = 0
+        self._fanout = struct.unpack(">256L", idx[fanout_start:fanout_start + 1024])
+        self.count = self._fanout[255]
+        table = fanout_start + 1024
+        if self._version == 2:
+            # sha table, crc32 table, 4-byte offsets, 8-byte large offsets
+            self._sha_start, self._sha_stride = table, 20
+            self._offsets_start = table + self.count * 24
+            self._large_start = self._offsets_start + self.count * 4
+        else:
+            # (4-byte offset, sha) entries
+            self._sha_start, self._sha_stride = table + 4, 24
+
+    def offset(self, sha: bytes) -> Optional[int]:
+        """
+        Find an object in the index with a binary search over its fanout bucket.
+
+        Args:
+            sha (bytes): Raw 20-byte object id.
+
+        Returns:
+            Optional[int]: Offset of the object in the pack, None if it is not in this pack.
+        """
+        first = sha[0]
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        idx, start, stride = self._idx, self._sha_start, self._sha_stride
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = start + mid * stride
+            found = idx[pos:pos + 20]
+            if found < sha:
+                lo = mid + 1
+            elif found > sha:
+                hi = mid
+            else:
+                return self._entry_offset(mid)
+        return None
+
+    def _entry_offset(self, n: int) -> int:
+        if self._version == 1:
+            pos = self._sha_start - 4 + n * 24
+            return struct.unpack(">L", self._idx[pos:pos + 4])[0]
+        pos = self._offsets_start + n * 4
+        offset = struct.unpack(">L", self._idx[pos:pos + 4])[0]
+        if offset & 0x80000000:
+            pos = self._large_start + (offset & 0x7FFFFFFF) * 8
+            offset = struct.unpack(">Q", self._idx[pos:pos + 8])[0]
+        return offset
+
+    def header(self, offset: int) -> Tuple[int, int, int]:
+        """
+        Parse the type and size header of the object at an offset.
+
+        Returns:
+            Tuple[int, int, int]: Object type, inflated size and the offset after the header.
+        """
+        pack = self._pack
+        byte = pack[offset]
+        offset += 1
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0F
+        shift = 4
+        while byte & 0x80:
+            byte = pack[offset]
+            offset += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+        return obj_type, size, offset
+
+    def delta_base(self, obj_type: int, offset: int, pos: int) -> Tuple[object, int]:
+        """
+        Find the base of a delta object.
+
+        Returns:
+            Tuple[object, int]: The base offset in this pack (ofs delta) or the raw base sha
+            (ref delta), and the offset of the delta data.
+        """
+        pack = self._pack
+        if obj_type == OBJ_REF_DELTA:
+            return pack[pos:pos + 20], pos + 20
+        byte = pack[pos]
+        pos += 1
+        distance = byte & 0x7F
+        while byte & 0x80:
+            byte = pack[pos]
+            pos += 1
+            distance = ((distance + 1) << 7) | (byte & 0x7F)
+        return offset - distance, pos
+
+    def inflate(self, pos: int, size: int) -> bytes:
+        """
+        Decompress the zlib stream at an offset, reading only as much of the pack as it needs.
+        """
+        decompressor = zlib.decompressobj()
+        chunk = size + 64
+        out = []
+        while not decompressor.eof:
+            data = self._pack[pos:pos + chunk]
+            if not data:
+                raise GitError(f"truncated object in {self.idx_path[:-4]}.pack")
+            out.append(decompressor.decompress(data))
+            pos += chunk
+            chunk = max(chunk, 16 * 1024)
+        data = b"".join(out)
+        if len(data) != size:
+            raise GitError(f"corrupt object in {self.idx_path[:-4]}.pack")
+        return data
+
+    def close(self) -> None:
+        self._idx.close()
+        self._pack.close()
+
+
+def parse_commit(sha: bytes, data: bytes) -> Commit:
+    """
+    Parse the headers of a commit object.
+
+    Args:
+        sha (bytes): Raw id of the commit.
+        data (bytes): The commit object.
+
+    Returns:
+        Commit: The parsed commit.
+    """
+    header = data.split(b"\n\n", 1)[0]
+    tree = None
+    parents = []
+    timestamp = 0
+    for line in header.split(b"\n"):
+        key, _, value = line.partition(b" ")
+        if key == b"tree":
+            tree = bytes.fromhex(value.decode("ascii"))
+        elif key == b"parent":
+            parents.append(bytes.fromhex(value.decode("ascii")))
+        elif key == b"committer":
+            timestamp = int(value.rsplit(b" ", 2)[1])
+    if tree is None:
+        raise GitError(f"commit {sha.hex()} has no tree")
+    return Commit(sha, tree, tuple(parents), timestamp)
+
+
+def parse_tree(data: bytes) -> Dict[str, Tuple[bytes, bytes]]:
+    """
+    Parse a tree object.
+
+    Args:
+        data (bytes): The tree object.
+
+    Returns:
+        Dict[str, Tuple[bytes, bytes]]: Entry name -> (mode, raw sha); the mode
+        is kept so that a change of mode alone counts as a change.
+    """
+    return {
+        name.decode("utf-8", "surrogateescape"): (mode, sha)
+        for mode, name, sha in _TREE_ENTRY.findall(data)
+    }
+
+
+class GitRepository:
+    """
+    Read-only access to a git repository without running git: refs and
+    packed-refs, loose objects, and packfiles through their .idx indexes,
+    with ofs/ref deltas resolved through a bounded cache of objects.
+    """
+
+    def __init__(self, path: str, cache_bytes: int = CACHE_BYTES):
+        """
+        Args:
+            path (str): The working tree, or the .git directory itself.
+            cache_bytes (int): Size limit of the cache of resolved objects.
+
+        Raises:
+            GitError: If path is not a git repository.
+        """
+        self.git_dir = _find_git_dir(path)
+        common = os.path.join(self.git_dir, "commondir")
+        self.common_dir = self.git_dir
+        if os.path.isfile(common):
+            # A linked worktree keeps its objects and most refs in the main repository
+            with open(common) as f:
+                self.common_dir = os.path.normpath(os.path.join(self.git_dir, f.read().strip()))
+        self.objects_dir = os.path.join(self.common_dir, "objects")
+        self.cache = ObjectCache(cache_bytes)
+        self._trees = OrderedDict()
+        self._packs = None
+        self._packed_refs = None
+
+    @property
+    def packs(self) -> List[Pack]:
+        if self._packs is None:
+            self._packs = [Pack(path) for path in sorted(glob.glob(os.path.join(self.objects_dir, "pack", "*.idx")))]
+        return self._packs
+
+    def _packed(self) -> Dict[str, str]:
+        if self._packed_refs is None:
+            self._packed_refs = {}
+            path = os.path.join(self.common_dir, "packed-refs")
+            if os.path.isfile(path):
+                with open(path) as f:
+                    for line in f:
+                        # Skip the header and the peeled '^sha' lines of tags
+                        if line.startswith(("#", "^")):
+                            continue
+                        sha, _, ref = line.strip().partition(" ")
+                        self._packed_refs[ref] = sha
+        return self._packed_refs
+
+    def read_ref(self, ref: str) -> Optional[str]:
+        """
+        Read a ref, following symbolic refs such as HEAD. Only HEAD and names
+        under refs/ are refs: other files in the git directory (such as
+        'config') are not.
+
+        Args:
+            ref (str): Full ref name, e.g. 'HEAD' or 'refs/heads/main'.
+
+        Returns:
+            Optional[str]: Hex sha the ref points to, None if there is no such ref.
+        """
+        for _ in range(10):
+            if ref != "HEAD" and not ref.startswith("refs/") or ".." in ref.split("/"):
+                return None
+            value = None
+            for base in (self.git_dir, self.common_dir):
+                path = os.path.join(base, ref)
+                if os.path.isfile(path):
+                    with open(path) as f:
+                        value = f.read().strip()
+                    break
+            if value is None:
+                return self._packed().get(ref)
+            if not value.startswith("ref: "):
+                return value
+            ref = value[5:]
+        raise GitError(f"symbolic ref loop at {ref}")
+
+    def resolve(self, name: str) -> bytes:
+        """
+        Resolve a branch, tag, ref or full sha to a commit, like 'git rev-parse name^{commit}'.
+
+        Args:
+            name (str): E.g. 'main', 'HEAD', 'refs/tags/v1.0' or a 40 character sha.
+
+        Returns:
+            bytes: Raw sha of the commit.
+
+        Raises:
+            GitError: If the name cannot be resolved.
+        """
+        sha = None
+        if len(name) == 40 and all(c in "0123456789abcdef" for c in name.lower()):
+            sha = name.lower()
+        else:
+            for ref in (name, f"refs/{name}", f"refs/tags/{name}", f"refs/heads/{name}",
+                        f"refs/remotes/{name}", f"refs/remotes/{name}/HEAD"):
+                sha = self.read_ref(ref)
+                if sha is not None:
+                    break
+        if sha is None:
+            raise GitError(f"unknown revision '{name}'")
+        raw = bytes.fromhex(sha)
+        obj_type, data = self.read(raw)
+        # Peel annotated tags down to the commit
+        while obj_type == OBJ_TAG:
+            raw = bytes.fromhex(data[7:47].decode("ascii"))
+            obj_type, data = self.read(raw)
+        if obj_type != OBJ_COMMIT:
+            raise GitError(f"'{name}' is not a commit")
+        return raw
+
+    def read(self, sha: bytes) -> Tuple[int, bytes]:
+        """
+        Read an object from the packs or the loose objects.
+
+        Args:
+            sha (bytes): Raw 20-byte object id.
+
+        Returns:
+            Tuple[int, bytes]: Object type (OBJ_COMMIT, OBJ_TREE, ...) and its data.
+
+        Raises:
+            GitError: If there is no such object.
+        """
+        cached = self.cache.get(sha)
+        if cached is not None:
+            return cached
+        for pack in self.packs:
+            offset = pack.offset(sha)
+            if offset is not None:
+                obj_type, data = self._read_packed(pack, offset)
+                break
+        else:
+            hex_sha = sha.hex()
+            path = os.path.join(self.objects_dir, hex_sha[:2], hex_sha[2:])
+            try:
+                with open(path, "rb") as f:
+                    raw = zlib.decompress(f.read())
+            except FileNotFoundError:
+                raise GitError(f"object {hex_sha} not found") from None
+            header, _, data = raw.partition(b"\0")
+            obj_type = _LOOSE_TYPES.get(header.split(b" ", 1)[0])
+            if obj_type is None:
+                raise GitError(f"object {hex_sha} has an unknown type")
+        if obj_type != OBJ_BLOB:
+            self.cache.put(sha, obj_type, data)
+        return obj_type, data
+
+    def _read_packed(self, pack: Pack, offset: int) -> Tuple[int, bytes]:
+        # Walk down the delta chain to a cached or undeltified base, then
+        # apply the deltas on the way back up
+        chain = []
+        while True:
+            cached = self.cache.get((pack, offset))
+            if cached is not None:
+                obj_type, data = cached
+                break
+            obj_type, size, pos = pack.header(offset)
+            if obj_type not in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+                data = pack.inflate(pos, size)
+                break
+            base, pos = pack.delta_base(obj_type, offset, pos)
+            chain.append((offset, pos, size))
+            if obj_type == OBJ_OFS_DELTA:
+                offset = base
+                continue
+            base_offset = pack.offset(base)
+            if base_offset is None:
+                obj_type, data = self.read(base)
+                break
+            offset = base_offset
+        for delta_offset, pos, size in reversed(chain):
+            data = apply_delta(data, pack.inflate(pos, size))
+            # Deltified objects are bases of other deltas more often than not
+            self.cache.put((pack, delta_offset), obj_type, data)
+        return obj_type, data
+
+    def commit(self, sha: bytes) -> Commit:
+        obj_type, data = self.read(sha)
+        if obj_type != OBJ_COMMIT:
+            raise GitError(f"object {sha.hex()} is not a commit")
+        return parse_commit(sha, data)
+
+    def tree(self, sha: bytes) -> Dict[str, Tuple[bytes, bytes]]:
+        """
+        Read and parse a tree; recently used trees are not parsed again.
+
+        Returns:
+            Dict[str, Tuple[bytes, bytes]]: See parse_tree. Must not be modified.
+        """
+        entries = self._trees.get(sha)
+        if entries is not None:
+            self._trees.move_to_end(sha)
+            return entries
+        obj_type, data = self.read(sha)
+        if obj_type != OBJ_TREE:
+            raise GitError(f"object {sha.hex()} is not a tree")
+        entries = self._trees[sha] = parse_tree(data)
+        if len(self._trees) > TREE_CACHE_ENTRIES:
+            self._trees.popitem(last=False)
+        return entries
+
+    def walk(self, tip: bytes, since: Optional[int] = None, exclude: Container[bytes] = ()) -> Iterator[Commit]:
+        """
+        Yield the commits reachable from tip, newest first by committer time.
+
+        Like 'git log --since', a commit older than since ends the walk along
+        its line of history. So does a commit in exclude, like 'git log ^sha'
+        for commits that were already processed.
+
+        Args:
+            tip (bytes): Raw sha of the first commit.
+            since (Optional[int]): Unix time of the oldest commit to include.
+            exclude (Container[bytes]): Raw shas of commits to stop at.
+
+        Yields:
+            Commit: The commits.
+        """
+        if tip in exclude:
+            return
+        seen = {tip}
+        first = self.commit(tip)
+        heap = [(-first.timestamp, 0, first)]
+        counter = 1
+        while heap:
+            commit = heappop(heap)[2]
+            if since is not None and commit.timestamp < since:
+                continue
+            yield commit
+            for parent in commit.parents:
+                if parent not in seen and parent not in exclude:
+                    seen.add(parent)
+                    parent_commit = self.commit(parent)
+                    heappush(heap, (-parent_commit.timestamp, counter, parent_commit))
+                    counter += 1
+
+    def changed_paths(self, commit: Commit) -> Set[str]:
+        """
+        Paths of the files a commit added, modified or removed, compared with
+        its first parent (every file for a root commit).
+
+        Subtrees with the same sha on both sides are skipped without being read.
+
+        Args:
+            commit (Commit): The commit.
+
+        Returns:
+            Set[str]: '/'-separated paths relative to the repository root.
+        """
+        changed = set()
+        parent_tree = self.commit(commit.parents[0]).tree if commit.parents else None
+        self._diff_trees(parent_tree, commit.tree, "", changed)
+        return changed
+
+    def _diff_trees(self, old: Optional[bytes], new: Optional[bytes], prefix: str, changed: Set[str]) -> None:
+        if old == new:
+            return
+        old_entries = self.tree(old) if old is not None else {}
+        new_entries = self.tree(new) if new is not None else {}
+        for name, entry in new_entries.items():
+            previous = old_entries.get(name)
+            if previous == entry:
+                continue
+            mode, sha = entry
+            is_dir = mode == _TREE_MODE
+            old_dir = previous[1] if previous is not None and previous[0] == _TREE_MODE else None
+            if previous is not None and old_dir is None:
+                changed.add(prefix + name)
+            if is_dir:
+                self._diff_trees(old_dir, sha, f"{prefix}{name}/", changed)
+            else:
+                changed.add(prefix + name)
+                if old_dir is not None:
+                    self._diff_trees(old_dir, None, f"{prefix}{name}/", changed)
+        for name, (mode, sha) in old_entries.items():
+            if name in new_entries:
+                continue
+            if mode == _TREE_MODE:
+                self._diff_trees(sha, None, f"{prefix}{name}/", changed)
+            else:
+                changed.add(prefix + name)
+
+    def close(self) -> None:
+        if self._packs is not None:
+            for pack in self._packs:
+                pack.close()
+            self._packs = None
+
+
+def _find_git_dir(path: str) -> str:
+    dot_git = os.path.join(path, ".git")
+    if os.path.isfile(dot_git):
+        # A worktree or submodule: '.git' is a file pointing to the git directory
+        with open(dot_git) as f:
+            line = f.read().strip()
+        if line.startswith("gitdir: "):
+            return os.path.normpath(os.path.join(path, line[8:]))
+    if os.path.isdir(dot_git):
+        return dot_git
+    if os.path.isfile(os.path.join(path, "HEAD")) and os.path.isdir(os.path.join(path, "objects")):
+        return path
+    raise GitError(f"not a git repository: {path}")
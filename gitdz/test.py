@@ -0,0 +1,275 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from git_objects import GitError, GitRepository, apply_delta
+from commit_graph import COMMIT, FILE, FOLDER, collapse_path, folders_of, write_plantuml
+from visualize_commits import (
+    build_dependency_graph, format_timestamp, get_commit_changes, get_commits, parse_since, save_graph
+)
+
+
+def git(repo, *args, date=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME="test", GIT_AUTHOR_EMAIL="test@example.com",
+               GIT_COMMITTER_NAME="test", GIT_COMMITTER_EMAIL="test@example.com")
+    if date is not None:
+        env["GIT_AUTHOR_DATE"] = env["GIT_COMMITTER_DATE"] = date
+    return subprocess.run(["git", "-C", str(repo), *args], env=env, check=True,
+                          stdout=subprocess.PIPE, text=True).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    """Fixture with a small repository: three commits on main, one a day."""
+    git(tmp_path, "init", "-q", "-b", "main")
+    for day in (1, 2, 3):
+        (tmp_path / f"{day}.txt").write_text(str(day))
+        git(tmp_path, "add", ".")
+        git(tmp_path, "commit", "-q", "-m", f"commit {day}", date=f"2024-01-0{day}T10:00:0{day}+00:00")
+    return tmp_path
+
+
+def test_format_timestamp():
+    assert format_timestamp(0) == "1970-01-01 00:00:00"
+    assert format_timestamp(1704103261) == "2024-01-01 10:01:01"
+    assert format_timestamp(951782399) == "2000-02-28 23:59:59"
+
+
+def test_parse_since(monkeypatch):
+    import time
+
+    assert parse_since("2024-01-01 10:01:01+00:00") == 1704103261
+    assert parse_since("2024-01-01T13:01:01+03:00") == 1704103261
+    # Without an offset the date is local time, as git reads it
+    monkeypatch.setenv("TZ", "UTC-3")
+    time.tzset()
+    try:
+        assert parse_since("2024-01-01 13:01:01") == 1704103261
+        assert parse_since("2024-01-01") == 1704056400
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    with pytest.raises(ValueError, match="not an ISO 8601 date"):
+        parse_since("2 weeks ago")
+
+
+def test_get_commits(repo):
+    hashes = git(repo, "log", "--reverse", "--pretty=format:%H").split()
+    commits = get_commits(str(repo), "2023-12-31")
+    assert next(commits) == (hashes[0], "2024-01-01 10:00:01")
+    assert list(commits) == [(hashes[1], "2024-01-02 10:00:02"), (hashes[2], "2024-01-03 10:00:03")]
+    assert [commit for commit, _ in get_commits(str(repo), "2024-01-01T12:00:00Z", reverse=False)] == hashes[:0:-1]
+    with pytest.raises(Exception, match="missing"):
+        list(get_commits(str(repo / "missing"), "2024-01-01"))
+
+
+def test_get_commits_stderr(tmp_path, monkeypatch):
+    # A git that writes more to stderr than a pipe holds before its output
+    fake_git = tmp_path / "git"
+    fake_git.write_text("#!/bin/sh\nhead -c 1000000 /dev/zero >&2\nprintf 'abc 1704103261'\n")
+    fake_git.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    assert list(get_commits("repo", "2024-01-01")) == [("abc", "2024-01-01 10:01:01")]
+
+
+def test_get_commit_changes(repo):
+    (repo / "a" / "b").mkdir(parents=True)
+    (repo / "a" / "b" / "c.txt").write_text("c")
+    (repo / "1.txt").unlink()
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "nested", date="2024-01-04T00:00:00+00:00")
+    (repo / "2.txt").write_text("changed")
+    git(repo, "commit", "-q", "-am", "modify", date="2024-01-05T00:00:00+00:00")
+    hashes = git(repo, "log", "--reverse", "--pretty=format:%H").split()
+    expected = [
+        (hashes[0], "2024-01-01 10:00:01", {"1.txt"}),
+        (hashes[1], "2024-01-02 10:00:02", {"2.txt"}),
+        (hashes[2], "2024-01-03 10:00:03", {"3.txt"}),
+        (hashes[3], "2024-01-04 00:00:00", {"1.txt", "a/b/c.txt"}),
+        (hashes[4], "2024-01-05 00:00:00", {"2.txt"}),
+    ]
+    assert list(get_commit_changes(str(repo), "main", "2023-12-31")) == expected
+    # The git-based reference sees the same commits
+    assert list(get_commits(str(repo), "2023-12-31")) == [change[:2] for change in expected]
+    # The same from packfiles with deltas and packed refs
+    git(repo, "gc", "-q", "--aggressive")
+    assert list(get_commit_changes(str(repo / ".git"), "main", "2024-01-03")) == expected[2:]
+    assert folders_of({"a/b/c.txt", "a/d.txt", "e.txt"}) == {"a", "a/b"}
+    graph = build_dependency_graph(expected[3:])
+    assert len(list(graph.edges())) == 1 + 4 + 1
+    with pytest.raises(GitError):
+        list(get_commit_changes(str(repo), "missing", "2023-12-31"))
+
+
+def test_git_objects(repo):
+    git(repo, "tag", "-a", "v1", "-m", "tag", "HEAD~1")
+    git(repo, "gc", "-q")
+    git(repo, "-c", "repack.useDeltaBaseOffset=false", "repack", "-adfq")
+    reader = GitRepository(str(repo))
+    assert reader.resolve("v1").hex() == git(repo, "rev-parse", "v1^{commit}")
+    assert reader.resolve("HEAD") == reader.resolve("refs/heads/main")
+    tip = reader.commit(reader.resolve("main"))
+    assert [commit.timestamp for commit in reader.walk(tip.sha)] == [1704276003, 1704189602, 1704103201]
+    assert sorted(reader.tree(tip.tree)) == ["1.txt", "2.txt", "3.txt"]
+    with pytest.raises(GitError):
+        reader.read(b"\0" * 20)
+    # Files in the git directory that are not refs
+    for name in ("config", "refs/../config", "description"):
+        with pytest.raises(GitError):
+            reader.resolve(name)
+    reader.close()
+    # Copy 4 bytes from offset 2 of the base, then insert 'xy'
+    assert apply_delta(b"abcdefgh", bytes([8, 6, 0x91, 2, 4, 2]) + b"xy") == b"cdefxy"
+
+
+def test_commit_cache(repo, tmp_path_factory):
+    from commit_cache import CommitCache, cache_path
+
+    path = cache_path(str(tmp_path_factory.mktemp("out") / "graph"), "feature/x")
+    assert path.endswith("graph.feature_x.commits")
+    reader = GitRepository(str(repo))
+    cache = CommitCache(path, "main", "2023-12-31")
+    assert not cache.load()
+    assert cache.update(reader) == 3
+    (repo / "4.txt").write_text("4")
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "commit 4", date="2024-01-04T00:00:00+00:00")
+    cache = CommitCache(path, "main", "2023-12-31")
+    assert cache.load()
+    assert cache.update(reader) == 1
+    assert cache.update(reader) == 0
+    # Rewritten history: the last two commits are replaced by another one
+    git(repo, "reset", "-q", "--hard", "HEAD~2")
+    (repo / "5.txt").write_text("5")
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "commit 5", date="2024-01-05T00:00:00+00:00")
+    cache = CommitCache(path, "main", "2023-12-31")
+    cache.load()
+    assert cache.update(reader) == 1
+    hashes = git(repo, "log", "--reverse", "--pretty=format:%H").split()
+    assert [(sha.hex(), paths) for sha, _, paths in cache.records()] == [
+        (hashes[0], ["1.txt"]), (hashes[1], ["2.txt"]), (hashes[2], ["5.txt"]),
+    ]
+    # A damaged tail is dropped and the file rewritten on the next update
+    with open(path, "ab") as f:
+        f.write(b"\xff")
+    cache = CommitCache(path, "main", "2023-12-31")
+    assert cache.load() and len(cache) == 3
+    reader.close()
+
+
+def test_commit_graph(tmp_path):
+    assert collapse_path("a/b/c/d.txt", 2) == (FOLDER, "a/b")
+    assert collapse_path("a/b/c.txt", 2) == (FILE, "a/b/c.txt")
+    assert collapse_path("a/b.txt", 0) == (FOLDER, "a")
+    assert collapse_path("a/b.txt", None) == (FILE, "a/b.txt")
+    commits = [("c1", "d1", ["a/x.txt", "a/b/c/y.txt"]), ("c2", "d2", ["a/x.txt"]), ("c3", "d3", ['q"uote.txt'])]
+    graph = build_dependency_graph(commits, max_depth=2)
+    assert [(kind, label) for _, kind, label in graph.nodes() if kind != COMMIT] == [
+        (FOLDER, "a"), (FILE, "a/x.txt"), (FOLDER, "a/b"), (FILE, 'q"uote.txt'),
+    ]
+    assert len(list(graph.edges())) == 3 + 3 + 2
+    save_graph(graph, str(tmp_path / "graph"))
+    lines = (tmp_path / "graph.puml").read_text().splitlines()
+    assert lines[0] == "@startuml" and lines[-1] == "@enduml"
+    assert 'rectangle "Commit: c1\\nDate: d1" as n0' in lines
+    assert "file \"q'uote.txt\" as n6" in lines
+    assert "n0 --> n4" in lines and "n4 --> n2" in lines
+
+    graph = build_dependency_graph(commits, max_depth=2, transitive_reduction=True)
+    # c1 -> 'a' and c1 -> 'a/x.txt' are implied by c1 -> c2 -> ...
+    assert sorted(graph.edges()) == [(0, 3), (0, 4), (4, 1), (4, 2), (4, 5), (5, 6)]
+    graph.cap(5)
+    assert [label for _, kind, label in graph.nodes() if kind == COMMIT] == ["Commit: c2\\nDate: d2", "Commit: c3\\nDate: d3"]
+    assert graph.omitted_commits == 1
+    out = io.StringIO()
+    write_plantuml(graph, out)
+    assert 'note "1 older commits not shown" as omitted' in out.getvalue()
+
+
+def test_extend_graph(repo, tmp_path_factory, capsys):
+    from visualize_commits import _records, extend_graph, update_commit_cache
+
+    out = tmp_path_factory.mktemp("out")
+    full, extended = str(out / "full"), str(out / "extended")
+
+    def commit(day, *names):
+        for name in names:
+            (repo / name).parent.mkdir(parents=True, exist_ok=True)
+            (repo / name).write_text(str(day))
+        git(repo, "add", ".")
+        git(repo, "commit", "-q", "-m", f"commit {day}", date=f"2024-01-0{day}T10:00:00+00:00")
+
+    def update(output):
+        return update_commit_cache(str(repo), "main", "2023-12-31", output + ".commits")
+
+    cache = update(extended)
+    assert not extend_graph(cache, extended, 1)
+    save_graph(build_dependency_graph(_records(cache.records()), 1), extended, cache)
+    commit(4, "a/b/c.txt", "1.txt")
+    commit(5, "a/d.txt")
+    assert extend_graph(update(extended), extended, 1)
+    assert extend_graph(update(extended), extended, 1)
+    cache = update(full)
+    save_graph(build_dependency_graph(_records(cache.records()), 1), full)
+    assert (out / "extended.puml").read_bytes() == (out / "full.puml").read_bytes()
+    assert "up to date" in capsys.readouterr().out
+    # Other options, a graph growing beyond max_nodes or rewritten history need a rebuild
+    assert not extend_graph(update(extended), extended, 2)
+    commit(6, "6.txt")
+    assert not extend_graph(update(extended), extended, 1, max_nodes=10)
+    git(repo, "reset", "-q", "--hard", "HEAD~3")
+    commit(7, "7.txt")
+    assert not extend_graph(update(extended), extended, 1)
+
+
+def test_benchmark_repository(tmp_path):
+    from benchmark import SHAPES, build_repository, file_path, generate_commits
+
+    assert file_path(100, 3) == "d0/d1/d4/file100.txt" and file_path(9, 1) == "d1/file9.txt"
+    assert list(generate_commits("linear", 3, seed=1)) == list(generate_commits("linear", 3, seed=1))
+    merges = list(generate_commits("merges", 9, files_per_commit=1))
+    assert [parents for _, parents, _ in merges] == [[], [0], [1], [2], [3], [4], [5], [1, 6], [7]]
+    assert merges[7][2] == sorted({path for _, _, paths in merges[2:7] for path in paths})
+    with pytest.raises(ValueError):
+        list(generate_commits("tangled", 3))
+    for shape in SHAPES:
+        path = build_repository(str(tmp_path / shape), shape, 20, files_per_commit=2, depth=2, files=50)
+        assert git(path, "rev-list", "--count", "main") == "20"
+        changes = list(get_commit_changes(path, "main", "2023-12-31"))
+        assert len(changes) == 20 and changes[0][1] == "2024-01-01 00:00:00"
+        history = generate_commits(shape, 20, files_per_commit=2, depth=2, files=50)
+        assert [sorted(paths) for _, _, paths in changes] == [paths for _, _, paths in history]
+
+
+def test_benchmark_case(tmp_path):
+    from benchmark import STAGES, build_repository, compare, run_case
+
+    path = build_repository(str(tmp_path / "repo"), "merges", 30)
+    result = run_case(path, repeat=2)
+    assert result["commits"] == 30 and result["edges"] >= 29
+    assert list(result["stages"]) == list(STAGES)
+    assert all(stage["seconds"] >= 0 and stage["peak_bytes"] >= 0 for stage in result["stages"].values())
+    base = {"results": [dict(result, shape="merges", files_per_commit=3, depth=3, files=10000)]}
+    new = json.loads(json.dumps(base))
+    assert compare(base, new) == []
+    new["results"][0]["stages"]["build_graph"]["seconds"] = base["results"][0]["stages"]["build_graph"]["seconds"] * 2 + 1
+    new["results"][0]["nodes"] *= 2
+    assert [name for name, *_ in compare(base, new)] == ["merges/30/stages.build_graph.seconds"]
+
+
+def test_mode_change(repo):
+    (repo / "f.sh").write_text("echo hi")
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "script", date="2024-01-04T00:00:00+00:00")
+    git(repo, "update-index", "--chmod=+x", "f.sh")
+    git(repo, "commit", "-q", "-m", "executable", date="2024-01-05T00:00:00+00:00")
+    assert git(repo, "log", "-1", "--name-only", "--pretty=format:") == "f.sh"
+    *_, (_, _, changed) = get_commit_changes(str(repo), "main", "2023-12-31")
+    assert changed == {"f.sh"}
@@ -1,10 +1,20 @@
+import io
+import marshal
 import os
 import subprocess
-from datetime import datetime
-from typing import List, Tuple
+import tempfile
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 import xml.etree.ElementTree as ET
-from graphviz import Digraph
-from plantuml import PlantUML
+from commit_cache import CommitCache, cache_path
+from commit_graph import PLANTUML_END, WRITE_BUFFER, CommitGraph, write_plantuml, write_plantuml_body
+from git_objects import GitRepository
+
+# Bytes read from the 'git log' pipe at a time
+CHUNK_SIZE = 64 * 1024
+EPOCH = datetime(1970, 1, 1)
+GRAPH_STATE_VERSION = 1
 
 
 def load_config_from_xml(config_file: str) -> dict:
@@ -24,21 +34,65 @@ def load_config_from_xml(config_file: str) -> dict:
     config = {
         "repository_path": root.find("repository_path").text,
         "graph_output_path": root.find("graph_output_path").text,
-        "since_date": root.find("since_date").text
+        "since_date": root.find("since_date").text,
+        "branch": root.findtext("branch", "HEAD"),
+        # Optional reductions of the graph, see build_dependency_graph
+        "max_depth": _optional_int(root.findtext("max_depth")),
+        "transitive_reduction": root.findtext("transitive_reduction", "false").strip().lower() == "true",
+        "max_nodes": _optional_int(root.findtext("max_nodes")),
     }
     
     return config
 
-def get_commits(repo_path: str, since_date: str) -> List[Tuple[str, str]]:
+def _optional_int(text: Optional[str]) -> Optional[int]:
+    return int(text) if text is not None and text.strip() else None
+
+
+def format_timestamp(timestamp: int) -> str:
     """
-    Get a list of commits from the repository since the given date.
+    Format a Unix timestamp as a UTC 'YYYY-MM-DD HH:MM:SS' string.
+
+    The date part is cached per day, so a run of commits from the same day
+    costs only integer arithmetic instead of a datetime object each.
+
+    Args:
+        timestamp (int): Seconds since the epoch.
+
+    Returns:
+        str: The formatted UTC time.
+    """
+    days, seconds = divmod(timestamp, 86400)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return f"{_format_day(days)} {hour:02d}:{minute:02d}:{second:02d}"
+
+
+@lru_cache(maxsize=4096)
+def _format_day(days: int) -> str:
+    return (EPOCH + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def get_commits(repo_path: str, since_date: str, reverse: bool = True) -> Iterator[Tuple[str, str]]:
+    """
+    Stream the commits of the repository since the given date.
+
+    main does not use this: it reads the objects directly (see
+    get_commit_changes). This is kept as the git-based reference that
+    benchmark.py measures get_commit_changes against, and the tests check
+    both agree on the commits.
+
+    'git log' writes NUL-terminated '<hash> <timestamp>' records to a pipe
+    that is read in fixed-size chunks, and every record is parsed once as it
+    arrives. Memory use does not depend on the size of the history; with
+    reverse the oldest-first order is produced by git itself.
 
     Args:
         repo_path (str): Path to the git repository.
         since_date (str): Date string in a format accepted by 'git log --since', e.g., '2023-01-01'.
+        reverse (bool): Yield the commits in chronological order (oldest first).
 
-    Returns:
-        List[Tuple[str, str]]: List of tuples where each tuple contains the commit hash and the commit date.
+    Yields:
+        Tuple[str, str]: The commit hash and the commit date.
 
     Raises:
         Exception: If the git command fails.
@@ -48,70 +102,308 @@ def get_commits(repo_path: str, since_date: str) -> List[Tuple[str, str]]:
         "-C",
         repo_path,
         "log",
+        "-z",
         "--pretty=format:%H %ct",
         "--since",
         since_date,
     ]
-    result = subprocess.run(git_command, stdout=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        raise Exception(f"Error running git command: {result.stderr}")
-
-    commits = result.stdout.splitlines()
-    commit_data = [
-        (
-            c.split()[0],
-            datetime.utcfromtimestamp(int(c.split()[1])).strftime("%Y-%m-%d %H:%M:%S"),
-        )
-        for c in commits
-    ]
-    return commit_data[::-1]  # Reverse to have chronological order
+    if reverse:
+        git_command.append("--reverse")
+    # stderr goes to a file: a pipe nobody reads while stdout is streamed
+    # would block git as soon as it filled up
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(git_command, stdout=subprocess.PIPE, stderr=stderr)
+    try:
+        carry = b""
+        while True:
+            chunk = process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            records = (carry + chunk).split(b"\0")
+            carry = records.pop()
+            for record in records:
+                commit, _, timestamp = record.partition(b" ")
+                yield commit.decode("ascii"), format_timestamp(int(timestamp))
+        # The last record has no terminator after it
+        if carry:
+            commit, _, timestamp = carry.partition(b" ")
+            yield commit.decode("ascii"), format_timestamp(int(timestamp))
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise Exception(f"Error running git command: {stderr.read().decode(errors='replace')}")
+    finally:
+        # Also reached when the caller stops iterating early
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr.close()
+
+
+def parse_since(since_date: str) -> int:
+    """
+    Convert an ISO 8601 date, 'YYYY-MM-DD[ HH:MM:SS][+HH:MM]', to a Unix timestamp.
 
+    A date without a UTC offset is local time, as 'git log --since' reads it.
+    Relative dates such as '2 weeks ago' or 'yesterday' are not supported.
 
-def build_dependency_graph(commits: List[Tuple[str, str]]):
-    dot = Digraph(comment="Git Commit Dependencies")
+    Args:
+        since_date (str): The date.
 
-    for i, (commit, date) in enumerate(commits):
-        dot.node(str(i), f"Commit: {commit}\nDate: {date}")
-        if i > 0:
-            dot.edge(str(i - 1), str(i))  # Connect commits in chronological order
+    Returns:
+        int: Seconds since the epoch.
 
-    return dot
+    Raises:
+        ValueError: If the date is not in ISO 8601 format.
+    """
+    try:
+        date = datetime.fromisoformat(since_date.strip())
+    except ValueError:
+        raise ValueError(
+            f"since_date {since_date!r} is not an ISO 8601 date "
+            "such as '2024-01-01' or '2024-01-01 12:00:00+03:00'"
+        ) from None
+    # Naive datetimes are converted from local time
+    return int(date.timestamp())
 
 
-def save_graph(graph: Digraph, output_file: str) -> None:
+def get_commit_changes(
+    repo_path: str, branch: str, since_date: str, reverse: bool = True
+) -> Iterator[Tuple[str, str, Set[str]]]:
     """
-    Save the dependency graph in PlantUML format and generate the diagram.
+    Stream the commits of a branch with the files each one changed, reading
+    the repository's objects directly instead of running git.
 
     Args:
-        graph (Digraph): The dependency graph to be saved.
+        repo_path (str): Path to the repository (working tree or .git directory).
+        branch (str): Branch, tag or other ref to start from, e.g. 'main'.
+        since_date (str): Oldest commit date to include, see parse_since.
+        reverse (bool): Yield the commits in chronological order (oldest first).
+            Only the parsed commit headers are held for this, not their changes.
+
+    Yields:
+        Tuple[str, str, Set[str]]: The commit hash, the commit date and the paths
+        of the files it changed compared with its first parent.
+
+    Raises:
+        git_objects.GitError: If the branch or an object cannot be read.
+    """
+    repo = GitRepository(repo_path)
+    try:
+        commits = repo.walk(repo.resolve(branch), parse_since(since_date))
+        if reverse:
+            commits = reversed(list(commits))
+        for commit in commits:
+            yield commit.sha.hex(), format_timestamp(commit.timestamp), repo.changed_paths(commit)
+    finally:
+        repo.close()
+
+
+def get_cached_commit_changes(
+    repo_path: str, branch: str, since_date: str, cache_file: str
+) -> Iterator[Tuple[str, str, List[str]]]:
+    """
+    Like get_commit_changes (oldest first), but through a commit cache:
+    only the commits added to the branch since the last run are read from
+    the repository.
+
+    Args:
+        repo_path (str): Path to the repository (working tree or .git directory).
+        branch (str): Branch, tag or other ref to start from, e.g. 'main'.
+        since_date (str): Oldest commit date to include, see parse_since.
+        cache_file (str): The cache file, see commit_cache.cache_path.
+
+    Yields:
+        Tuple[str, str, List[str]]: The commit hash, the commit date and the paths
+        of the files it changed.
+
+    Raises:
+        git_objects.GitError: If the branch or an object cannot be read.
+    """
+    cache = update_commit_cache(repo_path, branch, since_date, cache_file)
+    yield from _records(cache.records())
+
+
+def update_commit_cache(repo_path: str, branch: str, since_date: str, cache_file: str) -> CommitCache:
+    """
+    Load the commit cache of a branch and bring it up to the branch's tip.
+
+    Args:
+        repo_path (str): Path to the repository (working tree or .git directory).
+        branch (str): Branch, tag or other ref to start from, e.g. 'main'.
+        since_date (str): Oldest commit date to include, see parse_since.
+        cache_file (str): The cache file, see commit_cache.cache_path.
+
+    Returns:
+        CommitCache: The updated cache.
+
+    Raises:
+        git_objects.GitError: If the branch or an object cannot be read.
+    """
+    cache = CommitCache(cache_file, branch, since_date)
+    cache.load()
+    repo = GitRepository(repo_path)
+    try:
+        cache.update(repo, parse_since(since_date))
+    finally:
+        repo.close()
+    return cache
+
+
+def build_dependency_graph(
+    commits: Iterable[Tuple],
+    max_depth: Optional[int] = None,
+    transitive_reduction: bool = False,
+    max_nodes: Optional[int] = None,
+) -> CommitGraph:
+    """
+    Build the commit graph. Commits are linked in chronological order; with
+    (hash, date, changed paths) records every commit is also linked to the
+    files and folders it touched, each of which is a single node.
+
+    Args:
+        commits (Iterable[Tuple]): (hash, date) or (hash, date, paths) records, oldest first.
+        max_depth (Optional[int]): Collapse folder subtrees deeper than this many levels.
+        transitive_reduction (bool): Remove the edges implied by other edges.
+        max_nodes (Optional[int]): Leave out the oldest commits beyond this many nodes.
+
+    Returns:
+        CommitGraph: The dependency graph.
+    """
+    graph = CommitGraph(max_depth)
+    for commit, date, *changes in commits:
+        graph.add_commit(commit, date, changes[0] if changes else ())
+    if transitive_reduction:
+        graph.transitive_reduction()
+    if max_nodes is not None:
+        graph.cap(max_nodes)
+    return graph
+
+
+def _records(records: Iterable[Tuple[bytes, int, List[str]]]) -> Iterator[Tuple[str, str, List[str]]]:
+    # Commit cache records as (hash, date, paths)
+    for sha, timestamp, paths in records:
+        yield sha.hex(), format_timestamp(timestamp), paths
+
+
+def _cache_position(cache: CommitCache) -> dict:
+    # Which commits of which cache a saved graph was built from
+    return {
+        "branch": cache.branch,
+        "since": cache.since_date,
+        "rows": len(cache),
+        "last_sha": cache.sha(len(cache) - 1),
+        "last_timestamp": cache.latest_timestamp(),
+    }
+
+
+def save_graph(graph: CommitGraph, output_file: str, cache: Optional[CommitCache] = None) -> None:
+    """
+    Save the dependency graph in PlantUML format.
+
+    The code is written straight to a buffered file while the graph is
+    walked, without building it in memory first. Given the commit cache the
+    graph was built from, the state of the graph is saved next to it in
+    '<output_file>.graph', so that extend_graph can append to it later.
+
+    Args:
+        graph (CommitGraph): The dependency graph to be saved.
         output_file (str): Path to the output file without extension.
+        cache (Optional[CommitCache]): The cache holding exactly the commits of the graph.
     """
-    plantuml_code = "@startuml\n"
-
-    # Сохраняем узлы
-    node_names = {}  # Для хранения отображения узлов
-    # Сохраняем связи
-    for line in graph.body:
-        if 'Commit' in line:
-            # Извлекаем имя узла из строки вида 'node "Commit: abc123"'
-            node_name = line.split('"')[1]  # Имя узла
-            node_id = line.split(' ')[-1][:-2]  # ID узла (например, i)
-            node_names[node_id] = node_name
-            #pl_code += f'node "{node_name}" as {node_id}\n'
-            #plantuml_code += f'node "{node_name}" as {node_id}\n'
-        if '->' in line:
-            parts = line.split('->')
-            tail = parts[0].strip()
-            head = parts[1].strip()
-            plantuml_code += f"{tail} --> {head} : {node_name}\n"
-    plantuml_code += "@enduml"
-
-    # Запись в файл
-    with open(f"{output_file}.puml", "w") as f:
-        f.write(plantuml_code)
+    with open(f"{output_file}.puml", "w", encoding="utf-8", buffering=WRITE_BUFFER) as f:
+        write_plantuml(graph, f)
+    if cache is None:
+        try:
+            os.remove(f"{output_file}.graph")
+        except FileNotFoundError:
+            pass
+    else:
+        _save_state(output_file, graph, cache, os.path.getsize(f"{output_file}.puml"))
     print(f"Graph saved in PlantUML format to {output_file}.puml")
 
-    # Генерация диаграммы с использованием PlantUML
+
+def _save_state(output_file: str, graph: CommitGraph, cache: CommitCache, puml_size: int) -> None:
+    state = dict(_cache_position(cache), version=GRAPH_STATE_VERSION, puml_size=puml_size, graph=graph.state())
+    tmp_path = f"{output_file}.graph.tmp"
+    with open(tmp_path, "wb") as f:
+        marshal.dump(state, f)
+    os.replace(tmp_path, f"{output_file}.graph")
+
+
+def extend_graph(
+    cache: CommitCache, output_file: str, max_depth: Optional[int] = None, max_nodes: Optional[int] = None
+) -> bool:
+    """
+    Append the commits added to the cache since the graph was saved to
+    '<output_file>.puml', without rebuilding or rewriting the graph: only the
+    new nodes and edges are written, replacing the final '@enduml'. The
+    result is the same as that of saving the whole graph again.
+
+    This is not possible, and nothing is changed, when there is no saved
+    state matching the output file and the options, the history was
+    rewritten, a new commit is older than the graph's newest one, or the
+    graph grows beyond max_nodes. Graphs with a transitive reduction are
+    never saved with a state: a new commit removes edges of older ones.
+
+    Args:
+        cache (CommitCache): The updated commit cache of the branch.
+        output_file (str): Path to the output file without extension.
+        max_depth (Optional[int]): Collapse folder subtrees deeper than this many levels.
+        max_nodes (Optional[int]): Maximum number of nodes of the graph.
+
+    Returns:
+        bool: True if the graph is up to date.
+    """
+    try:
+        with open(f"{output_file}.graph", "rb") as f:
+            state = marshal.load(f)
+        rows = state["rows"]
+        if (
+            state["version"] != GRAPH_STATE_VERSION
+            or (state["branch"], state["since"]) != (cache.branch, cache.since_date)
+            or state["graph"]["max_depth"] != max_depth
+            or not 0 < rows <= len(cache)
+            or cache.sha(rows - 1) != state["last_sha"]
+        ):
+            return False
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return False
+    new = list(cache.records(rows))
+    # A full rebuild would put an older commit before some of the graph
+    if new and new[0][1] < state["last_timestamp"]:
+        return False
+    graph = CommitGraph.resume(state["graph"])
+    for commit, date, paths in _records(new):
+        graph.add_commit(commit, date, paths)
+    if max_nodes is not None and len(graph) > max_nodes:
+        return False
+    try:
+        f = open(f"{output_file}.puml", "r+b", buffering=WRITE_BUFFER)
+    except OSError:
+        return False
+    with f:
+        end = state["puml_size"] - len(PLANTUML_END)
+        if os.fstat(f.fileno()).st_size != state["puml_size"] or end < 0:
+            return False
+        f.seek(end)
+        if f.read() != PLANTUML_END.encode():
+            return False
+        if not new:
+            print(f"Graph in {output_file}.puml is up to date")
+            return True
+        f.seek(end)
+        f.truncate()
+        out = io.TextIOWrapper(f, encoding="utf-8")
+        write_plantuml_body(graph, out)
+        out.write(PLANTUML_END)
+        out.flush()
+        puml_size = f.tell()
+        out.detach()
+    _save_state(output_file, graph, cache, puml_size)
+    print(f"Graph in {output_file}.puml extended with {len(new)} new commits")
+    return True
+
 
 def main(config_file: str) -> None:
     """
@@ -125,19 +417,32 @@ def main(config_file: str) -> None:
     repo_path = config["repository_path"]
     graph_output_path = config["graph_output_path"]
     since_date = config["since_date"]
+    branch = config["branch"]
     if not os.path.exists(repo_path):
         print(f"Error: Repository path '{repo_path}' does not exist.")
         return
+    try:
+        parse_since(since_date)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
 
-    commits = get_commits(repo_path, since_date)
-
-    if not commits:
+    cache = update_commit_cache(repo_path, branch, since_date, cache_path(graph_output_path, branch))
+    if not len(cache):
         print(f"No commits found since {since_date}")
         return
+    # Usually only the commits pushed since the last run are added
+    if not config["transitive_reduction"] and extend_graph(
+        cache, graph_output_path, config["max_depth"], config["max_nodes"]
+    ):
+        return
 
-    graph = build_dependency_graph(commits)
-    save_graph(graph, graph_output_path)
-
+    graph = build_dependency_graph(
+        _records(cache.records()), config["max_depth"], config["transitive_reduction"], config["max_nodes"]
+    )
+    # Reduced or capped graphs change as a whole, they cannot be extended
+    extendable = not config["transitive_reduction"] and graph.hidden is None
+    save_graph(graph, graph_output_path, cache if extendable else None)
 
 if __name__ == "__main__":
     #config_file = "config.yaml"  # Path to your YAML configuration file
@@ -0,0 +1,389 @@
+import os
+import re
+import struct
+import zlib
+from collections.abc import Sequence
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows: a history file there must not be shared
+    fcntl = None
+
+# Entries per block of the search index and size of a block's bloom filter.
+# A filter has one bit per key: about 4 bytes per entry, a fraction of the
+# entries themselves, and every further trigram of a search divides the
+# chance that a block is read for nothing.
+BLOCK_ENTRIES = 64
+BLOOM_BYTES = 256
+_BLOOM_MAGIC = b"hbloom\x02\n"
+_OFFSET = struct.Struct("<Q")
+_ESCAPE = re.compile(r"\\(.)")
+
+
+def _escape(command):
+    return command.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _unescape(line):
+    return _ESCAPE.sub(lambda m: "\n" if m.group(1) == "n" else m.group(1), line)
+
+
+def _grams(text, prefix=False):
+    """
+    Keys of a command in the bloom filters: its trigrams, plus its first
+    one and two characters (marked with a leading NUL) for prefix searches.
+    """
+    grams = {text[i:i + 3] for i in range(len(text) - 2)}
+    if prefix:
+        grams.update("\0" + text[:n] for n in (1, 2) if len(text) >= n)
+    return grams
+
+
+def _bit(gram):
+    return zlib.crc32(gram.encode("utf-8")) & (BLOOM_BYTES * 8 - 1)
+
+
+def _bloom(commands):
+    bloom = bytearray(BLOOM_BYTES)
+    for command in commands:
+        for gram in _grams(command, True):
+            bit = _bit(gram)
+            bloom[bit >> 3] |= 1 << (bit & 7)
+    return bloom
+
+
+def _bloom_has(bloom, gram):
+    bit = _bit(gram)
+    return bloom[bit >> 3] & (1 << (bit & 7))
+
+
+class CommandHistory(Sequence):
+    """
+    Command history with a fixed memory footprint.
+
+    The newest `capacity` entries live in a ring buffer. With a file, every
+    entry is also appended to it, so older entries (and those of previous
+    sessions) stay available:
+
+    - <file>: one command per line (backslash-escaped)
+    - <file>.off: 8 byte offset of every entry in <file>, for O(1) recall
+    - <file>.bloom: a bloom filter of the trigrams of every block of
+      BLOCK_ENTRIES entries; searches only read the blocks that can match
+
+    Several shells may share the files: appends hold an flock on <file>,
+    and entries the other shells added are read from the file. Offsets
+    that do not match <file> (e.g. after a crash) are rebuilt from it.
+
+    Entries are numbered from 1, across sessions when a file is used.
+    Indexing the sequence is 0-based like a list.
+    """
+
+    def __init__(self, capacity=1000, path=None):
+        """
+        :param capacity: Number of entries kept in memory
+        :type capacity: int
+        :param path: History file, None to keep the history in memory only
+        :type path: str, optional
+        """
+        self.capacity = max(1, capacity)
+        self.path = path
+        self.count = 0
+        # (number, command) of the newest entries this instance has seen
+        self._ring = [None] * self.capacity
+        self._file = self._offsets = self._blooms = None
+        self._reader = self._offsets_reader = None
+        if path is not None:
+            self._open()
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _open(self):
+        # Unbuffered appends: every entry reaches the file before the lock is released
+        self._file = open(self.path, "ab", buffering=0)
+        self._offsets = open(self.path + ".off", "ab", buffering=0)
+        self._blooms = open(self.path + ".bloom", "ab", buffering=0)
+        self._reader = open(self.path, "rb")
+        self._offsets_reader = open(self.path + ".off", "rb")
+        with self._lock():
+            if not self._load_ring():
+                self._rebuild()
+                self._load_ring()
+            blooms = os.fstat(self._blooms.fileno()).st_size
+            if blooms != len(_BLOOM_MAGIC) + self.count // BLOCK_ENTRIES * BLOOM_BYTES:
+                self._write_blooms()
+
+    def _sync(self):
+        """
+        Takes the entries other shells appended into account.
+        """
+        if self._offsets is not None:
+            self.count = os.fstat(self._offsets.fileno()).st_size // _OFFSET.size
+
+    def _load_ring(self):
+        """
+        Reads the newest entries into the ring buffer, checking that their
+        offsets match the lines of the history file.
+
+        :return: False if the offsets are out of step with the file
+        :rtype: bool
+        """
+        offsets_size = os.fstat(self._offsets.fileno()).st_size
+        data_size = os.fstat(self._file.fileno()).st_size
+        count = offsets_size // _OFFSET.size
+        if offsets_size % _OFFSET.size or (count == 0) != (data_size == 0):
+            return False
+        self.count = count
+        if not count:
+            return True
+        first = max(1, count - self.capacity + 1)
+        self._offsets_reader.seek((first - 1) * _OFFSET.size)
+        offsets = [offset for (offset,) in _OFFSET.iter_unpack(self._offsets_reader.read())]
+        start = offsets[0]
+        if start >= data_size:
+            return False
+        self._reader.seek(max(0, start - 1))
+        data = self._reader.read(data_size - max(0, start - 1))
+        if start and not data.startswith(b"\n"):
+            return False
+        lines = (data[1:] if start else data).split(b"\n")
+        # The file ends with a newline, so the last item is empty
+        if len(lines) != len(offsets) + 1 or lines.pop():
+            return False
+        position = start
+        for n, (offset, line) in enumerate(zip(offsets, lines), first):
+            if offset != position:
+                return False
+            position += len(line) + 1
+            self._ring[(n - 1) % self.capacity] = (n, _unescape(line.decode("utf-8", "replace")))
+        return True
+
+    def _rebuild(self):
+        """
+        Rewrites the offsets from the history file, dropping a partly
+        written last line.
+        """
+        offsets = []
+        position = 0
+        self._reader.seek(0)
+        for line in self._reader:
+            if not line.endswith(b"\n"):
+                break
+            offsets.append(_OFFSET.pack(position))
+            position += len(line)
+        self._file.truncate(position)
+        self._offsets.truncate(0)
+        self._offsets.write(b"".join(offsets))
+        self._ring = [None] * self.capacity
+
+    def _write_blooms(self):
+        """
+        Rewrites the bloom filters of all complete blocks.
+        """
+        self._blooms.truncate(0)
+        self._blooms.write(_BLOOM_MAGIC)
+        block = []
+        for _, command in self._read(1, self.count // BLOCK_ENTRIES * BLOCK_ENTRIES):
+            block.append(command)
+            if len(block) == BLOCK_ENTRIES:
+                self._blooms.write(_bloom(block))
+                block = []
+
+    def append(self, command):
+        """
+        Adds a command as entry len(self) + 1.
+
+        :type command: str
+        """
+        if self._file is None:
+            self.count += 1
+            self._ring[(self.count - 1) % self.capacity] = (self.count, command)
+            return
+        with self._lock():
+            self._sync()
+            number = self.count + 1
+            offset = os.fstat(self._file.fileno()).st_size
+            # The line goes first: an offset never points past the file
+            self._file.write((_escape(command) + "\n").encode("utf-8"))
+            self._offsets.write(_OFFSET.pack(offset))
+            self.count = number
+            self._ring[(number - 1) % self.capacity] = (number, command)
+            if number % BLOCK_ENTRIES == 0:
+                expected = len(_BLOOM_MAGIC) + (number // BLOCK_ENTRIES - 1) * BLOOM_BYTES
+                if os.fstat(self._blooms.fileno()).st_size != expected:
+                    self._write_blooms()
+                else:
+                    block = self.entries(number - BLOCK_ENTRIES + 1, number)
+                    self._blooms.write(_bloom(command for _, command in block))
+
+    def __len__(self):
+        self._sync()
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        command = self.get(index + 1)
+        if command is None:
+            raise IndexError("history index out of range")
+        return command
+
+    def __iter__(self):
+        for _, command in self.entries():
+            yield command
+
+    def _held(self, number):
+        entry = self._ring[(number - 1) % self.capacity]
+        return entry is not None and entry[0] == number
+
+    def get(self, number):
+        """
+        Entry by number in O(1): from the ring buffer, or with one seek into
+        the history file.
+
+        :param number: Entry number, starting at 1
+        :type number: int
+        :return: The command, None if there is no such entry (or it was
+            dropped from a history without a file)
+        :rtype: str or None
+        """
+        self._sync()
+        if not 1 <= number <= self.count:
+            return None
+        if self._held(number):
+            return self._ring[(number - 1) % self.capacity][1]
+        if self._file is None:
+            return None
+        for _, command in self._read(number, number):
+            return command
+        return None
+
+    def entries(self, first=1, last=None):
+        """
+        Yields (number, command) from entry `first` to `last` (the newest
+        one by default), streaming the entries that are not in memory from
+        the history file.
+
+        :rtype: Iterator[tuple[int, str]]
+        """
+        self._sync()
+        n = max(first, 1)
+        last = self.count if last is None else min(last, self.count)
+        while n <= last:
+            if self._held(n):
+                yield self._ring[(n - 1) % self.capacity]
+                n += 1
+                continue
+            if self._file is None:
+                n += 1
+                continue
+            # Stream up to the next entry in memory; below the ring window
+            # no entry can be in memory
+            end = max(n, min(last, self.count - self.capacity))
+            while end < last and not self._held(end + 1):
+                end += 1
+            yield from self._read(n, end)
+            n = end + 1
+
+    def _read(self, first, last):
+        """
+        Reads entries first..last from the history file in one sequential read.
+        """
+        if first > last:
+            return
+        self._offsets_reader.seek((first - 1) * _OFFSET.size)
+        (start,) = _OFFSET.unpack(self._offsets_reader.read(_OFFSET.size))
+        self._reader.seek(start)
+        for n in range(first, last + 1):
+            line = self._reader.readline()
+            if not line:
+                return
+            yield n, _unescape(line.decode("utf-8", "replace").rstrip("\n"))
+
+    def _candidates(self, grams, reverse=False):
+        """
+        Yields (number, command) of the entries whose block may contain
+        all grams, skipping the rest of the file with the bloom filters.
+        """
+        self._sync()
+        in_memory = max(1, self.count - self.capacity + 1)
+        recent = self.entries(in_memory)
+        if reverse:
+            yield from reversed(list(recent))
+        if self._file is not None and in_memory > 1:
+            # Blocks completed by another shell a moment ago may have no filter yet
+            filters = (os.fstat(self._blooms.fileno()).st_size - len(_BLOOM_MAGIC)) // BLOOM_BYTES
+            blocks = range((in_memory - 2) // BLOCK_ENTRIES + 1)
+            with open(self.path + ".bloom", "rb") as blooms:
+                for block in reversed(blocks) if reverse else blocks:
+                    if block < filters:
+                        blooms.seek(len(_BLOOM_MAGIC) + block * BLOOM_BYTES)
+                        bloom = blooms.read(BLOOM_BYTES)
+                        if not all(_bloom_has(bloom, gram) for gram in grams):
+                            continue
+                    first = block * BLOCK_ENTRIES + 1
+                    entries = self._read(first, min(first + BLOCK_ENTRIES, in_memory) - 1)
+                    yield from reversed(list(entries)) if reverse else entries
+        if not reverse:
+            yield from recent
+
+    def search(self, text):
+        """
+        Yields (number, command) of every entry containing text, oldest first.
+
+        :type text: str
+        :rtype: Iterator[tuple[int, str]]
+        """
+        for n, command in self._candidates(_grams(text)):
+            if text in command:
+                yield n, command
+
+    def find_prefix(self, prefix):
+        """
+        Newest entry starting with prefix.
+
+        :type prefix: str
+        :return: (number, command), None if there is none
+        :rtype: tuple[int, str] or None
+        """
+        for n, command in self._candidates(_grams(prefix, True), reverse=True):
+            if command.startswith(prefix):
+                return n, command
+        return None
+
+    def expand(self, event):
+        """
+        Resolves a history event like bash: '!!' (the last command),
+        '!n' (entry n), '!-n' (n commands back) or '!prefix'.
+
+        :param event: Command line starting with '!'
+        :type event: str
+        :return: The command, None if the event is not found
+        :rtype: str or None
+        """
+        spec = event[1:]
+        count = len(self)
+        if spec == "!":
+            return self.get(count)
+        if spec.isdigit():
+            return self.get(int(spec))
+        if spec.startswith("-") and spec[1:].isdigit():
+            return self.get(count + 1 - int(spec[1:]))
+        found = self.find_prefix(spec)
+        return None if found is None else found[1]
+
+    def close(self):
+        for f in (self._file, self._offsets, self._blooms, self._reader, self._offsets_reader):
+            if f is not None:
+                f.close()
+        self._file = self._offsets = self._blooms = self._reader = self._offsets_reader = None
@@ -0,0 +1,168 @@
+import os
+import resource
+import time
+from array import array
+
+# Bucket i of a histogram counts latencies below 2**i microseconds
+_BUCKETS = 32
+
+
+class LatencyHistogram:
+    """
+    Latency histogram with power-of-two buckets in microseconds.
+    Recording is O(1) and the memory use is fixed.
+    """
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = array("Q", bytes(8 * _BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        :param seconds: Duration of one call
+        :type seconds: float
+        """
+        micros = int(seconds * 1e6)
+        self.buckets[min(micros.bit_length(), _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the given fraction of calls.
+
+        :param fraction: e.g. 0.99 for the 99th percentile
+        :type fraction: float
+        :return: Latency bound in microseconds
+        :rtype: int
+        """
+        target = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return 1 << i
+        return 1 << (_BUCKETS - 1)
+
+
+def rss_bytes():
+    """
+    Current and peak resident set size of the process.
+    The current size is only known where /proc is available.
+
+    :rtype: tuple[int or None, int]
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None, peak
+    return current, max(current, peak)
+
+
+class SessionStats:
+    """
+    Per-command latency histograms of a session plus an optional periodic
+    dump of the summary into the session log.
+    """
+
+    def __init__(self, log_interval=None):
+        """
+        :param log_interval: Seconds between summaries written to the log,
+            None to never write them
+        :type log_interval: float, optional
+        """
+        self.histograms = {}
+        self.log_interval = log_interval
+        self._last_dump = time.monotonic()
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def dump_due(self):
+        """
+        Whether a summary should go to the log now. Resets the timer if so.
+
+        :rtype: bool
+        """
+        if self.log_interval is None:
+            return False
+        now = time.monotonic()
+        if now - self._last_dump < self.log_interval:
+            return False
+        self._last_dump = now
+        return True
+
+    def summary(self):
+        """
+        One line summary for the session log.
+
+        :rtype: str
+        """
+        parts = [
+            f"{name}:n={h.count},mean_us={h.total / h.count * 1e6:.1f},p99_us<={h.percentile(0.99)}"
+            for name, h in sorted(self.histograms.items())
+        ]
+        return "stats " + " ".join(parts)
+
+    def report(self):
+        """
+        Lines of the latency table printed by the 'stats' command.
+
+        :rtype: list[str]
+        """
+        lines = ["command       count    mean_us   p50_us<=   p99_us<=     max_us"]
+        for name, h in sorted(self.histograms.items()):
+            lines.append(
+                f"{name:<12} {h.count:>6} {h.total / h.count * 1e6:>10.1f} "
+                f"{h.percentile(0.5):>10} {h.percentile(0.99):>10} {h.max * 1e6:>10.1f}"
+            )
+        return lines
+
+
+class Profiler:
+    """
+    Session wide cProfile or tracemalloc profiling, written to a file
+    when the session ends.
+    """
+
+    def __init__(self, kind, output):
+        """
+        :param kind: 'cprofile' or 'tracemalloc'
+        :type kind: str
+        :param output: File the profile (pstats) or snapshot is written to
+        :type output: str
+        :raises ValueError: If the kind is unknown
+        """
+        self.kind = kind
+        self.output = output
+        if kind == "cprofile":
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif kind == "tracemalloc":
+            import tracemalloc
+
+            self._profile = tracemalloc
+            tracemalloc.start()
+        else:
+            raise ValueError(f"Unknown profiler: {kind}")
+
+    def stop(self):
+        if self.kind == "cprofile":
+            self._profile.disable()
+            self._profile.dump_stats(self.output)
+        else:
+            self._profile.take_snapshot().dump(self.output)
+            self._profile.stop()
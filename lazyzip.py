@@ -0,0 +1,424 @@
+import io
+import mmap
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD_SIG = b"PK\x05\x06"
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_ZIP64_LOCATOR_SIG = b"PK\x06\x07"
+_ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+_ZIP64_EOCD_SIG = b"PK\x06\x06"
+_CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+_CENTRAL_HEADER_SIG = b"PK\x01\x02"
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_LOCAL_HEADER_SIG = b"PK\x03\x04"
+_MAX_COMMENT = 0xFFFF
+_FLAG_ENCRYPTED = 0x1
+_FLAG_UTF8 = 0x800
+# Compressed bytes inflated at a time by a streaming member reader
+_READ_CHUNK = 64 * 1024
+
+
+def find_central_directory(buf):
+    """
+    Locates the central directory from the end of central directory record
+    (zip64 aware).
+
+    :param buf: The whole archive (usually an mmap)
+    :type buf: mmap.mmap or bytes
+    :raises zipfile.BadZipFile: If the central directory cannot be found
+    :return: Start and end position of the central directory, the number of
+        entries and the length of data prepended to the archive
+    :rtype: tuple[int, int, int, int]
+    """
+    start = max(0, len(buf) - _EOCD.size - _MAX_COMMENT)
+    eocd_pos = buf.rfind(_EOCD_SIG, start)
+    if eocd_pos < 0:
+        raise zipfile.BadZipFile("End of central directory not found")
+    _, _, _, _, count, cd_size, cd_offset, _ = _EOCD.unpack_from(buf, eocd_pos)
+    cd_end = eocd_pos
+    locator_pos = eocd_pos - _ZIP64_LOCATOR.size
+    if locator_pos >= 0 and buf[locator_pos:locator_pos + 4] == _ZIP64_LOCATOR_SIG:
+        # The locator stores the offset without any prepended data,
+        # the zip64 record is right before it
+        zip64_pos = locator_pos - _ZIP64_EOCD.size
+        if zip64_pos < 0 or buf[zip64_pos:zip64_pos + 4] != _ZIP64_EOCD_SIG:
+            raise zipfile.BadZipFile("Corrupt zip64 end of central directory")
+        fields = _ZIP64_EOCD.unpack_from(buf, zip64_pos)
+        count, cd_size, cd_offset = fields[7], fields[8], fields[9]
+        cd_end = zip64_pos
+    # Data prepended to the archive (e.g. self-extracting stubs)
+    concat = cd_end - cd_size - cd_offset
+    if concat < 0:
+        raise zipfile.BadZipFile("Bad central directory offset")
+    return cd_offset + concat, cd_end, count, concat
+
+
+class CentralDirectory:
+    """
+    Index of a zip archive read from its central directory only.
+
+    Member names are kept in a list, sizes, offsets and CRCs in compact
+    parallel arrays indexed by member number. No member data is read.
+    """
+
+    def __init__(self, buf=None):
+        """
+        :param buf: The whole archive (usually an mmap), None for an empty
+            index to be filled by the caller
+        :type buf: mmap.mmap or bytes, optional
+        :raises zipfile.BadZipFile: If the central directory cannot be found
+        """
+        self.names = []
+        self.methods = array("H")
+        self.flags = array("H")
+        self.crcs = array("L")
+        self.compressed_sizes = array("Q")
+        self.sizes = array("Q")
+        self.offsets = array("Q")
+        self.concat = 0
+        if buf is not None:
+            self._parse(buf)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _parse(self, buf):
+        pos, _, count, self.concat = find_central_directory(buf)
+        for _ in range(count):
+            if buf[pos:pos + 4] != _CENTRAL_HEADER_SIG:
+                raise zipfile.BadZipFile("Bad central directory header")
+            (_, _, _, flags, method, _, _, crc, csize, size,
+             name_len, extra_len, comment_len, _, _, _, offset) = _CENTRAL_HEADER.unpack_from(buf, pos)
+            pos += _CENTRAL_HEADER.size
+            raw_name = bytes(buf[pos:pos + name_len])
+            name = raw_name.decode("utf-8" if flags & _FLAG_UTF8 else "cp437")
+            pos += name_len
+            if 0xFFFFFFFF in (csize, size, offset):
+                size, csize, offset = self._zip64_extra(
+                    buf[pos:pos + extra_len], size, csize, offset
+                )
+            pos += extra_len + comment_len
+            self.names.append(name)
+            self.methods.append(method)
+            self.flags.append(flags)
+            self.crcs.append(crc)
+            self.compressed_sizes.append(csize)
+            self.sizes.append(size)
+            self.offsets.append(offset)
+
+    @staticmethod
+    def _zip64_extra(extra, size, csize, offset):
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, length = struct.unpack_from("<2H", extra, pos)
+            if tag == 0x0001:
+                values = iter(struct.unpack_from(f"<{length // 8}Q", extra, pos + 4))
+                if size == 0xFFFFFFFF:
+                    size = next(values)
+                if csize == 0xFFFFFFFF:
+                    csize = next(values)
+                if offset == 0xFFFFFFFF:
+                    offset = next(values)
+                break
+            pos += 4 + length
+        return size, csize, offset
+
+
+class _MemberReader(io.RawIOBase):
+    """
+    Streams a stored or deflated member out of the archive mmap, inflating
+    at most one buffer at a time and checking the CRC at the end.
+    """
+
+    def __init__(self, store, i):
+        index = store.index
+        self._store = store
+        self._buf = store._mmap
+        self._pos = store._data_start(i)
+        self._end = self._pos + index.compressed_sizes[i]
+        self._inflate = zlib.decompressobj(-15) if index.methods[i] == zipfile.ZIP_DEFLATED else None
+        self._name = index.names[i]
+        self._expected_crc = index.crcs[i]
+        self._crc = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not len(b):
+            return 0
+        while True:
+            if self._inflate is None:
+                raw = self._buf[self._pos:min(self._end, self._pos + len(b))]
+                self._pos += len(raw)
+                data = raw
+            else:
+                raw = self._inflate.unconsumed_tail
+                if not raw and self._pos < self._end:
+                    raw = self._buf[self._pos:min(self._end, self._pos + _READ_CHUNK)]
+                    self._pos += len(raw)
+                data = self._inflate.decompress(raw, len(b)) if raw else b""
+            if data:
+                self._crc = zlib.crc32(data, self._crc)
+                self._store._count_decompressed(len(data))
+                b[:len(data)] = data
+                return len(data)
+            if not raw or self._inflate.eof:
+                if self._crc != self._expected_crc:
+                    raise zipfile.BadZipFile(f"Bad CRC-32 for {self._name}")
+                return 0
+
+
+class LazyZipStore(Mapping):
+    """
+    Read-only path -> content mapping over a zip archive.
+
+    Only the central directory is parsed when the store is created. Member
+    bytes are decompressed from an mmap of the archive when first requested
+    and kept in an LRU cache bounded by total size in bytes; members larger
+    than the cache are streamed by open() instead. The cache and the
+    counters are guarded by a lock, so sessions served from several threads
+    can share one store.
+    Contents are decoded as UTF-8 where possible, otherwise returned as bytes.
+    """
+
+    def __init__(self, zip_path, cache_size=64 * 1024 * 1024, index_path=None, small_file_size=0):
+        """
+        :param zip_path: Path to the zip archive
+        :type zip_path: str
+        :param cache_size: Maximum number of bytes kept in the LRU cache,
+            None for no limit
+        :type cache_size: int or None
+        :param index_path: Index cache file (see vfs_index). When it matches
+            the archive the central directory is not parsed at all; a missing,
+            stale or corrupt cache is rebuilt.
+        :type index_path: str, optional
+        :param small_file_size: Members up to this size are stored in a newly
+            built index cache together with their contents
+        :type small_file_size: int
+        """
+        self.zip_path = zip_path
+        self.cache_size = cache_size
+        self.index_cache = None
+        self.index_cache_hit = False
+        # Counters reported by the 'stats' command
+        self.hits = 0
+        self.misses = 0
+        self.bytes_decompressed = 0
+        self._lock = threading.Lock()
+        self._file = open(zip_path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if index_path is None:
+                self.index = CentralDirectory(self._mmap)
+            else:
+                self._load_index(index_path, small_file_size)
+        except (ValueError, zipfile.BadZipFile):
+            self._file.close()
+            raise
+        self._positions = {
+            os.path.join("/", name): i for i, name in enumerate(self.index.names)
+        }
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._zipfile = None
+
+    def _load_index(self, index_path, small_file_size):
+        import vfs_index
+
+        fingerprint = vfs_index.archive_fingerprint(self.zip_path, self._mmap)
+        self.index_cache = vfs_index.load_index(index_path, fingerprint)
+        if self.index_cache is not None:
+            self.index_cache_hit = True
+            self.index = self.index_cache.index
+            return
+        self.index = CentralDirectory(self._mmap)
+        small_contents = {}
+        for i, size in enumerate(self.index.sizes):
+            if size <= small_file_size and not self.index.names[i].endswith("/"):
+                small_contents[i] = self._read_member(i)
+        try:
+            vfs_index.write_index(index_path, self.index, fingerprint, small_contents)
+        except OSError:
+            # A read-only location only costs the speed-up
+            return
+        # Serve the small members from the new cache instead of decompressing them again
+        self.index_cache = vfs_index.load_index(index_path, fingerprint)
+
+    def __getitem__(self, path):
+        data = self._cached(path)
+        if data is None:
+            data = self.read_bytes(path)
+            self._remember(path, data)
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError:
+            return data
+
+    def _cached(self, path):
+        """
+        Cached bytes of a member, counting the lookup as a hit or a miss.
+
+        :rtype: bytes or None
+        """
+        with self._lock:
+            data = self._cache.get(path)
+            if data is not None:
+                self.hits += 1
+                self._cache.move_to_end(path)
+                return data
+            if path not in self._positions:
+                raise KeyError(path)
+            self.misses += 1
+            return None
+
+    def in_cache(self, path):
+        """
+        Whether a member is in the cache; not counted as a hit or a miss.
+
+        :rtype: bool
+        """
+        return path in self._cache
+
+    def open(self, path):
+        """
+        Opens a member for reading. Members that fit in the cache are
+        served from it (and added to it on a miss); larger ones are
+        decompressed chunk by chunk as they are read, never as a whole.
+
+        :param path: Normalized member path (starting with '/')
+        :type path: str
+        :raises KeyError: If there is no such member
+        :rtype: io.BufferedIOBase
+        """
+        data = self._cached(path)
+        if data is not None:
+            return io.BytesIO(data)
+        i = self._positions[path]
+        if self._fits(self.index.sizes[i]):
+            data = self.read_bytes(path)
+            self._remember(path, data)
+            return io.BytesIO(data)
+        if self._needs_fallback(i):
+            return self._fallback().open(self.index.names[i])
+        return io.BufferedReader(_MemberReader(self, i), _READ_CHUNK)
+
+    def preload(self):
+        """
+        Decompresses every file member into the cache (as bytes, nothing
+        is decoded). Used for eagerly loaded images, whose cache has no limit.
+        """
+        for path in self._positions:
+            if not path.endswith("/") and path not in self._cache:
+                self._remember(path, self.read_bytes(path))
+
+    def __contains__(self, path):
+        return path in self._positions
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def size(self, path):
+        """
+        Uncompressed size of a member, taken from the central directory.
+
+        :rtype: int
+        """
+        return self.index.sizes[self._positions[path]]
+
+    def read_bytes(self, path):
+        """
+        Reads and decompresses a member without touching the cache.
+
+        :param path: Normalized member path (starting with '/')
+        :type path: str
+        :raises KeyError: If there is no such member
+        :raises zipfile.BadZipFile: If the member data is corrupt
+        :rtype: bytes
+        """
+        i = self._positions[path]
+        if self.index_cache is not None:
+            data = self.index_cache.small_content(i)
+            if data is not None:
+                return data
+        return self._read_member(i)
+
+    def _needs_fallback(self, i):
+        return self.index.flags[i] & _FLAG_ENCRYPTED or self.index.methods[i] not in (
+            zipfile.ZIP_STORED,
+            zipfile.ZIP_DEFLATED,
+        )
+
+    def _data_start(self, i):
+        pos = self.index.offsets[i] + self.index.concat
+        header = _LOCAL_HEADER.unpack_from(self._mmap, pos)
+        if header[0] != _LOCAL_HEADER_SIG:
+            raise zipfile.BadZipFile(f"Bad local header for {self.index.names[i]}")
+        return pos + _LOCAL_HEADER.size + header[9] + header[10]
+
+    def _read_member(self, i):
+        index = self.index
+        path = index.names[i]
+        method = index.methods[i]
+        if self._needs_fallback(i):
+            data = self._fallback().read(path)
+            self._count_decompressed(len(data))
+            return data
+        start = self._data_start(i)
+        raw = self._mmap[start:start + index.compressed_sizes[i]]
+        if method == zipfile.ZIP_DEFLATED:
+            data = zlib.decompressobj(-15).decompress(raw)
+        else:
+            data = raw
+        if zlib.crc32(data) != index.crcs[i]:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {path}")
+        self._count_decompressed(len(data))
+        return data
+
+    def _count_decompressed(self, size):
+        with self._lock:
+            self.bytes_decompressed += size
+
+    def close(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+        if self._zipfile is not None:
+            self._zipfile.close()
+        if self.index_cache is not None:
+            self.index_cache.close()
+        self._mmap.close()
+        self._file.close()
+
+    def _fits(self, size):
+        return self.cache_size is None or size <= self.cache_size
+
+    def _remember(self, path, data):
+        if not self._fits(len(data)):
+            return
+        with self._lock:
+            old = self._cache.pop(path, None)
+            if old is not None:
+                self._cached_bytes -= len(old)
+            self._cache[path] = data
+            self._cached_bytes += len(data)
+            while not self._fits(self._cached_bytes):
+                _, old = self._cache.popitem(last=False)
+                self._cached_bytes -= len(old)
+
+    def _fallback(self):
+        # Compression methods other than stored/deflate go through zipfile
+        with self._lock:
+            if self._zipfile is None:
+                self._zipfile = zipfile.ZipFile(self.zip_path, "r")
+            return self._zipfile
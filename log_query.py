@@ -0,0 +1,255 @@
+import argparse
+import csv
+import heapq
+import html
+import io
+import re
+import sys
+from codecs import getincrementaldecoder
+from datetime import datetime
+from operator import itemgetter
+from xml.etree.ElementTree import ParseError, iterparse
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+CHUNK_SIZE = 4 * 1024 * 1024
+_SESSION_START = b"<session>"
+_ACTION_END = "</action>"
+# One record as written by XMLLogWriter (and the older ElementTree log)
+_RECORD = re.compile(
+    r"\s*<action><user>([^<]*)</user><timestamp>([^<]*)</timestamp>"
+    r"<command>([^<]*)</command></action>"
+)
+
+
+class _Prefixed:
+    """
+    File-like object reading some bytes first and then the rest of a file.
+    Notes when the file is exhausted (eof).
+    """
+
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.pos = 0
+        self.f = f
+        self.eof = False
+
+    def read(self, size=-1):
+        # Hand out the prefix in pieces of the requested size too: iterparse
+        # queues the events of everything fed to it at once
+        if self.pos < len(self.prefix):
+            end = len(self.prefix) if size < 0 else self.pos + size
+            data = self.prefix[self.pos:end]
+            self.pos += len(data)
+            if self.pos >= len(self.prefix):
+                self.prefix = b""
+                self.pos = 0
+            return data
+        data = self.f.read(size)
+        if not data and size:
+            self.eof = True
+        return data
+
+
+def _unescape(text):
+    return html.unescape(text) if "&" in text else text
+
+
+def read_log(path):
+    """
+    Streams the records of a session log (XML or CSV, see session_log).
+
+    XML records in the layout the shell writes are matched with a regular
+    expression over large decoded chunks of the log. From the first record
+    in any other layout on (or a chunk without a complete record), the log
+    goes through iterparse, which drops every element once its record is
+    yielded. Either way memory use does
+    not depend on the size of the log. A log still being written (without
+    its closing tag) is read up to its last complete record.
+
+    :param path: Path to the log
+    :type path: str
+    :return: (user, timestamp, command) of every action, in log order
+    :rtype: Iterator[tuple[str, str, str]]
+    """
+    with open(path, "rb") as f:
+        first = f.read(len(_SESSION_START))
+        if not first.startswith(b"<"):
+            f.seek(0)
+            reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8", newline=""))
+            next(reader, None)
+            yield from map(tuple, reader)
+            return
+        if first != _SESSION_START:
+            f.seek(0)
+            yield from _iterparse_log(_Prefixed(b"", f))
+            return
+        decoder = getincrementaldecoder("utf-8")("replace")
+        carry = ""
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            text = carry + decoder.decode(chunk, final=not chunk)
+            pos = 0
+            irregular = False
+            escaped = "&" in text
+            for m in _RECORD.finditer(text):
+                if m.start() != pos:
+                    irregular = True
+                    break
+                if escaped:
+                    user, timestamp, command = m.groups()
+                    yield _unescape(user), timestamp, _unescape(command)
+                else:
+                    yield m.groups()
+                pos = m.end()
+            carry = text[pos:]
+            if not chunk:
+                # Whatever follows the last complete record is a record
+                # still being written
+                end = carry.rfind(_ACTION_END)
+                if end < 0:
+                    return
+                carry = carry[:end + len(_ACTION_END)]
+            # A chunk without a single record is in another layout (e.g.
+            # indented) or holds a huge record: don't let carry grow with it
+            if irregular or not chunk or not pos:
+                break
+        text = None
+        rest = _SESSION_START + carry.encode("utf-8") + decoder.getstate()[0]
+        carry = None
+        yield from _iterparse_log(_Prefixed(rest, f))
+
+
+def _iterparse_log(source):
+    """
+    Streams the records of an XML log with iterparse. A parse error at the
+    end of the input is a log still being written: the records before it
+    are all there is.
+
+    :param source: The log, from its start
+    :type source: _Prefixed
+    """
+    root = None
+    try:
+        for event, elem in iterparse(source, events=("start", "end")):
+            if root is None:
+                root = elem
+            elif event == "end" and elem.tag == "action":
+                yield elem.findtext("user", ""), elem.findtext("timestamp", ""), elem.findtext("command", "")
+                # Detach the finished action from <session> as well
+                root.clear()
+    except ParseError:
+        if not source.eof:
+            raise
+
+
+def filter_records(records, user=None, since=None, until=None, command=None):
+    """
+    Keeps the records matching all given filters. Timestamps use the log's
+    'YYYY-MM-DD HH:MM:SS' format and are compared as strings, so a prefix
+    such as '2024-11-07' works as a bound too. A log is in time order, so
+    reading stops at the first record after until.
+
+    :param records: (user, timestamp, command) records of one log
+    :type records: Iterable[tuple[str, str, str]]
+    :param user: Only actions of this user
+    :type user: str, optional
+    :param since: Only actions at or after this time
+    :type since: str, optional
+    :param until: Only actions up to this time (a date includes the whole day)
+    :type until: str, optional
+    :param command: Only lines running this command (the first word)
+    :type command: str, optional
+    :rtype: Iterator[tuple[str, str, str]]
+    """
+    if user is None and since is None and until is None and command is None:
+        yield from records
+        return
+    command_prefix = f"{command} "
+    for record in records:
+        record_user, timestamp, line = record
+        if since is not None and timestamp < since:
+            continue
+        if until is not None and timestamp[:len(until)] > until:
+            return
+        if user is not None and record_user != user:
+            continue
+        if command is not None and line != command and not line.startswith(command_prefix):
+            continue
+        yield record
+
+
+def merge_logs(paths, **filters):
+    """
+    Merges several logs into one stream ordered by timestamp with a heap
+    based k-way merge; only one record per log is held at a time.
+
+    :param paths: Paths to the logs
+    :type paths: list[str]
+    :param filters: Passed to filter_records
+    :rtype: Iterator[tuple[str, str, str]]
+    """
+    streams = [filter_records(read_log(path), **filters) for path in paths]
+    if len(streams) == 1:
+        return streams[0]
+    return heapq.merge(*streams, key=itemgetter(1))
+
+
+def command_stats(records):
+    """
+    Counts the commands of a record stream.
+
+    :return: Per command counts and the first and last timestamp
+    :rtype: tuple[dict[str, int], str or None, str or None]
+    """
+    counts = {}
+    first = last = None
+    for _, timestamp, line in records:
+        name = line.partition(" ")[0]
+        counts[name] = counts.get(name, 0) + 1
+        if first is None:
+            first = timestamp
+        last = timestamp
+    return counts, first, last
+
+
+def stats_report(counts, first, last):
+    """
+    Lines of the table printed by --stats: count, share and rate per minute
+    of every command over the time covered by the records.
+
+    :rtype: list[str]
+    """
+    total = sum(counts.values())
+    if not total:
+        return ["no matching actions"]
+    span = (datetime.strptime(last, TIMESTAMP_FORMAT) - datetime.strptime(first, TIMESTAMP_FORMAT)).total_seconds()
+    minutes = max(span, 1) / 60
+    lines = [f"{total} actions from {first} to {last}", "command           count   share  per_min"]
+    for name, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        lines.append(f"{name:<15} {count:>7} {count / total:>7.1%} {count / minutes:>8.2f}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query ShellEmulator session logs")
+    parser.add_argument("logs", nargs="+", metavar="LOG", help="XML or CSV session logs")
+    parser.add_argument("--user")
+    parser.add_argument("--since", help="'YYYY-MM-DD[ HH:MM:SS]'")
+    parser.add_argument("--until", help="'YYYY-MM-DD[ HH:MM:SS]'")
+    parser.add_argument("--command", help="command name, e.g. ls")
+    parser.add_argument("--stats", action="store_true", help="print per-command counts and rates")
+    args = parser.parse_args(argv)
+    records = merge_logs(
+        args.logs, user=args.user, since=args.since, until=args.until, command=args.command
+    )
+    if args.stats:
+        print("\n".join(stats_report(*command_stats(records))))
+        return 0
+    out = sys.stdout
+    for user, timestamp, command in records:
+        out.write(f"{timestamp} {user} {command}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
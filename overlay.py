@@ -0,0 +1,400 @@
+import errno
+import heapq
+import io
+import os
+import zipfile
+
+from find_index import FindIndex
+from vfs import VFSNode, VFSTree
+from zipwriter import ZipWriter
+
+
+def _error(cls, code, path):
+    return cls(code, os.strerror(code), path)
+
+
+class Overlay:
+    """
+    Copy-on-write layer over a read-only VFSImage, offering the same
+    interface (fs, vfs, open, member_name, member_size, find_index) plus
+    writes. The image itself is never modified, so any number of sessions
+    can each have their own overlay on one shared image.
+
+    The delta is kept in memory:
+
+    - files: path -> contents (bytes) of written files, or the image path
+      (str) of a file that was moved or copied there
+    - dirs: paths of created directories (ending with '/')
+    - whiteouts: image paths that were removed (a directory hides its subtree)
+
+    The directory tree shares every node with the image until a directory
+    changes; then only that directory and its ancestors are copied.
+    """
+
+    def __init__(self, base):
+        """
+        :param base: The image the changes are made on top of
+        :type base: vfs.VFSImage
+        """
+        self.base = base
+        self.fs = VFSTree(base.fs.root)
+        self.vfs = base.vfs
+        self.zip_path = base.zip_path
+        self.files = {}
+        self.dirs = set()
+        self.whiteouts = set()
+        # Nodes of self.fs that belong to this overlay and may be modified
+        self._owned = set()
+        self._delta_index = None
+
+    @property
+    def changed(self):
+        return bool(self.files or self.dirs or self.whiteouts)
+
+    def hidden(self, path):
+        """
+        Whether an image path was removed, directly or with a parent directory.
+
+        :param path: Normalized path, directories end with '/'
+        :type path: str
+        :rtype: bool
+        """
+        if not self.whiteouts:
+            return False
+        if path in self.whiteouts:
+            return True
+        end = len(path.rstrip("/"))
+        while end > 0:
+            end = path.rfind("/", 0, end)
+            if path[:end + 1] in self.whiteouts:
+                return True
+        return False
+
+    def member_name(self, path):
+        """
+        Name of the image member behind a path.
+
+        :raises KeyError: If the file is not in the image (it was written
+            in the overlay) or there is no such file
+        :rtype: str
+        """
+        source = self.files.get(path, path)
+        if isinstance(source, bytes) or (source == path and self.hidden(path)):
+            raise KeyError(path)
+        return self.base.member_name(source)
+
+    def member_size(self, path):
+        source = self.files.get(path, path)
+        if isinstance(source, bytes):
+            return len(source)
+        return self.base.member_size(source)
+
+    def open(self, path):
+        """
+        Opens a file of the merged view for streaming reads.
+
+        :raises KeyError: If there is no such file
+        :rtype: BinaryIO
+        """
+        source = self.files.get(path, path)
+        if isinstance(source, bytes):
+            return io.BytesIO(source)
+        if source == path and self.hidden(path):
+            raise KeyError(path)
+        return self.base.open(source)
+
+    def read_bytes(self, path):
+        with self.open(path) as stream:
+            return stream.read()
+
+    def find_index(self):
+        """
+        Index of the merged view for the 'find' command. Without changes
+        this is the image's own index.
+
+        :rtype: FindIndex or OverlayFindIndex
+        """
+        if not self.changed:
+            return self.base.find_index()
+        if self._delta_index is None:
+            members = [(path, 0) for path in self.dirs]
+            members.extend((path, self.member_size(path)) for path in self.files)
+            self._delta_index = OverlayFindIndex(self, FindIndex(members))
+        return self._delta_index
+
+    def _writable(self, node_path):
+        """
+        The overlay's own copy of a directory, copying it and its ancestors
+        out of the image first if they are still shared.
+        """
+        if self.fs.root not in self._owned:
+            self.fs.root = self._copy(self.fs.root, None)
+        node = self.fs.root
+        for part in node_path.split("/"):
+            if not part:
+                continue
+            child = node.children[part]
+            if child not in self._owned:
+                child = node.children[part] = self._copy(child, node)
+            node = child
+        return node
+
+    def _copy(self, node, parent):
+        copy = VFSNode(node.name, parent, is_dir=node.is_dir)
+        if node.is_dir:
+            copy.children = dict(node.children)
+        copy.explicit = node.explicit
+        self._owned.add(copy)
+        return copy
+
+    def _add(self, path, is_dir):
+        parent_path, _, name = path.rstrip("/").rpartition("/")
+        parent = self._writable(parent_path)
+        node = VFSNode(name, parent, is_dir=is_dir)
+        node.explicit = is_dir
+        self._owned.add(node)
+        parent.children[name] = node
+        self._delta_index = None
+        return node
+
+    def _parent(self, path):
+        parent = self.fs.lookup(path.rstrip("/").rpartition("/")[0] or "/")
+        if parent is None:
+            raise _error(FileNotFoundError, errno.ENOENT, path)
+        if not parent.is_dir:
+            raise _error(NotADirectoryError, errno.ENOTDIR, path)
+        return parent
+
+    def mkdir(self, path, parents=False):
+        """
+        Creates a directory.
+
+        :param path: Absolute path of the directory
+        :type path: str
+        :param parents: Create missing parents and accept an existing directory
+        :type parents: bool
+        :raises OSError: FileExistsError, FileNotFoundError or NotADirectoryError
+        """
+        path = path.rstrip("/") + "/"
+        node = self.fs.lookup(path)
+        if node is not None:
+            if parents and node.is_dir:
+                return
+            raise _error(FileExistsError, errno.EEXIST, path)
+        if parents and path.count("/") > 2:
+            self.mkdir(path.rstrip("/").rpartition("/")[0], parents=True)
+        self._parent(path)
+        self._add(path, True)
+        self.dirs.add(path)
+
+    def write(self, path, data, append=False):
+        """
+        Creates or replaces a file.
+
+        :param path: Absolute path of the file
+        :type path: str
+        :param data: New contents
+        :type data: bytes
+        :param append: Add data to the end of an existing file instead
+        :type append: bool
+        :raises OSError: IsADirectoryError, FileNotFoundError or NotADirectoryError
+        """
+        node = self.fs.lookup(path)
+        if node is not None and node.is_dir:
+            raise _error(IsADirectoryError, errno.EISDIR, path)
+        self._parent(path)
+        if node is None:
+            self._add(path, False)
+        elif append:
+            data = self.read_bytes(path) + data
+        self.files[path] = data
+        self._delta_index = None
+
+    def touch(self, path):
+        """
+        Creates an empty file if the path does not exist yet.
+
+        :raises OSError: FileNotFoundError or NotADirectoryError
+        """
+        if self.fs.lookup(path) is None:
+            self.write(path, b"")
+
+    def remove(self, path, recursive=False):
+        """
+        Removes a file, or a directory with recursive.
+
+        :param path: Absolute path
+        :type path: str
+        :raises OSError: FileNotFoundError, IsADirectoryError, or OSError
+            with ENOTEMPTY/EBUSY for the root
+        """
+        node = self.fs.lookup(path)
+        if node is None:
+            raise _error(FileNotFoundError, errno.ENOENT, path)
+        if node.parent is None:
+            raise _error(OSError, errno.EBUSY, path)
+        if node.is_dir and not recursive:
+            raise _error(IsADirectoryError, errno.EISDIR, path)
+        path = node.path
+        parent = self._writable(path.rstrip("/").rpartition("/")[0])
+        del parent.children[node.name]
+        if node.is_dir:
+            for key in [key for key in self.files if key.startswith(path)]:
+                del self.files[key]
+            self.dirs.difference_update([key for key in self.dirs if key.startswith(path)])
+            self.whiteouts.difference_update([key for key in self.whiteouts if key.startswith(path)])
+        else:
+            self.files.pop(path, None)
+        if self.base.fs.lookup(path) is not None:
+            self.whiteouts.add(path)
+        self._delta_index = None
+
+    def move(self, source, target):
+        """
+        Moves a file or directory. Moved image files keep referring to the
+        image, their contents are not copied.
+
+        :param source: Absolute path to move
+        :type source: str
+        :param target: New absolute path, or an existing directory to move into
+        :type target: str
+        :raises OSError: FileNotFoundError, FileExistsError, IsADirectoryError,
+            NotADirectoryError, or OSError with EINVAL for a move into itself
+        """
+        node = self.fs.lookup(source)
+        if node is None:
+            raise _error(FileNotFoundError, errno.ENOENT, source)
+        if node.parent is None:
+            raise _error(OSError, errno.EBUSY, source)
+        target_node = self.fs.lookup(target)
+        if target_node is not None and target_node.is_dir:
+            target = target_node.path + node.name
+            target_node = self.fs.lookup(target)
+        source = node.path
+        target = target.rstrip("/") + ("/" if node.is_dir else "")
+        if target == source:
+            return
+        if node.is_dir and target.startswith(source):
+            raise _error(OSError, errno.EINVAL, target)
+        if target_node is not None:
+            if node.is_dir:
+                raise _error(FileExistsError, errno.EEXIST, target)
+            if target_node.is_dir:
+                raise _error(IsADirectoryError, errno.EISDIR, target)
+        self._parent(target)
+        if not node.is_dir:
+            contents = self.files.get(source, source)
+            self.remove(source)
+            if target_node is None:
+                self._add(target, False)
+            self.files[target] = contents
+            return
+        moved = [(target, node)]
+        for path, child in self._subtree(node, source):
+            moved.append((target + path[len(source):], child))
+        entries = []
+        for new_path, child in moved:
+            old_path = source + new_path[len(target):]
+            if child.is_dir:
+                entries.append((new_path, True, child.explicit, None))
+            else:
+                entries.append((new_path, False, False, self.files.get(old_path, old_path)))
+        self.remove(source, recursive=True)
+        for new_path, is_dir, explicit, data in entries:
+            created = self._add(new_path, is_dir)
+            if is_dir:
+                created.explicit = explicit
+                if explicit:
+                    self.dirs.add(new_path)
+            else:
+                self.files[new_path] = data
+
+    def _subtree(self, node, path):
+        """
+        Yields (path, node) of everything below a directory, parents first.
+        """
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            for child in node.children.values():
+                child_path = path + child.name + ("/" if child.is_dir else "")
+                yield child_path, child
+                if child.is_dir:
+                    stack.append((child_path, child))
+
+    def commit(self, zip_path):
+        """
+        Writes the merged view as a new zip archive. Unchanged image members
+        (moved ones included) are copied across without recompression.
+
+        :param zip_path: Archive to create
+        :type zip_path: str
+        :return: Number of members written
+        :rtype: int
+        """
+        writer = ZipWriter(zip_path)
+        count = 0
+        try:
+            with zipfile.ZipFile(self.base.zip_path) as archive, open(self.base.zip_path, "rb") as source:
+                infos = {}
+                for info in archive.infolist():
+                    path = os.path.join("/", info.filename)
+                    infos[path] = info
+                    if path in self.files or self.hidden(path):
+                        continue
+                    writer.copy_member(source, info)
+                    count += 1
+                for path in sorted(self.dirs):
+                    writer.write_dir(path[1:])
+                    count += 1
+                for path in sorted(self.files):
+                    contents = self.files[path]
+                    if isinstance(contents, bytes):
+                        writer.write_bytes(path[1:], contents)
+                    else:
+                        writer.copy_member(source, infos[contents], path[1:])
+                    count += 1
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        return count
+
+    def close(self):
+        self.base.close()
+
+
+class OverlayFindIndex:
+    """
+    Find queries over an overlay: the image's index with removed and
+    replaced paths filtered out, merged with a small index of the delta.
+    """
+
+    def __init__(self, overlay, delta):
+        """
+        :param overlay: The overlay
+        :type overlay: Overlay
+        :param delta: Index of the files and directories of the delta
+        :type delta: FindIndex
+        """
+        self.overlay = overlay
+        self.delta = delta
+
+    def query(self, start, **predicates):
+        """
+        Same as FindIndex.query, over the merged view.
+
+        :rtype: Iterator[str]
+        """
+        overlay = self.overlay
+        base = (
+            path
+            for path in overlay.base.find_index().query(start, **predicates)
+            if path not in overlay.files and not overlay.hidden(path)
+        )
+        previous = None
+        for path in heapq.merge(base, self.delta.query(start, **predicates)):
+            # Parents of delta entries may exist in the image too
+            if path != previous:
+                yield path
+            previous = path
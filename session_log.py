@@ -0,0 +1,221 @@
+import atexit
+import os
+import time
+
+SESSION_END_TAG = "</session>"
+# How far from the end of a crashed log to look for the last complete record
+_RECOVERY_WINDOW = 64 * 1024
+
+
+def escape(text):
+    """
+    Escapes '&', '<' and '>' for XML character data, like
+    xml.sax.saxutils.escape, which would pull urllib and http into startup.
+
+    :type text: str
+    :rtype: str
+    """
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _rfind(f, tag, end):
+    """
+    Offset of the last occurrence of tag in the file before end, read
+    backwards in _RECOVERY_WINDOW sized blocks, or -1.
+    """
+    while end > 0:
+        start = max(0, end - _RECOVERY_WINDOW)
+        f.seek(start)
+        # Blocks overlap so that a tag across their border is found too
+        block = f.read(end - start + len(tag) - 1)
+        pos = block.rfind(tag)
+        if pos >= 0:
+            return start + pos
+        end = start
+    return -1
+
+
+def recover_xml_log(path):
+    """
+    Makes an XML session log left behind by a crashed session well-formed:
+    drops a partially written last record and appends the missing closing
+    '</session>' tag. The log is searched backwards from its end until the
+    last complete record, however long the partial record after it is.
+    Only files that start with '<session>' (after an optional XML
+    declaration) are touched.
+
+    :param path: Path to the XML log
+    :type path: str
+    :raises ValueError: If the file is not an XML session log
+    :return: True if the log had to be repaired
+    :rtype: bool
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+    with open(path, "rb+") as f:
+        head = f.read(_RECOVERY_WINDOW).lstrip()
+        if head.startswith(b"<?xml"):
+            head = head[head.find(b"?>") + 2:].lstrip()
+        if not head.startswith(b"<session>"):
+            raise ValueError(f"{path} is not an XML session log")
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - _RECOVERY_WINDOW))
+        if f.read().rstrip().endswith(SESSION_END_TAG.encode()):
+            return False
+        end = _rfind(f, b"</action>", size)
+        if end >= 0:
+            end += len(b"</action>")
+        else:
+            end = _rfind(f, b"<session>", size) + len(b"<session>")
+        f.truncate(end)
+        f.seek(0, os.SEEK_END)
+        f.write(SESSION_END_TAG.encode())
+    return True
+
+
+class SessionLogWriter:
+    """
+    Append-only session log streamed to disk.
+
+    Records go through a buffer of flush_bytes bytes; the buffer is also
+    flushed when more than flush_interval seconds passed since the last
+    flush, so a crashed session loses at most that much of its log.
+    Each record costs the same no matter how long the session is.
+    """
+
+    def __init__(self, path, flush_bytes=8192, flush_interval=1.0):
+        """
+        :param path: Path to the log file, overwritten by the new session
+        :type path: str
+        :param flush_bytes: Size of the write buffer in bytes
+        :type flush_bytes: int
+        :param flush_interval: Maximum time in seconds between flushes
+        :type flush_interval: float
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, "w", encoding="utf-8", newline="", buffering=flush_bytes)
+        self._last_flush = time.monotonic()
+        self.closed = False
+        self.start()
+        atexit.register(self.close)
+
+    def start(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def write_record(self, user, timestamp, command):
+        raise NotImplementedError
+
+    def write(self, user, timestamp, command):
+        """
+        Appends one action to the log.
+
+        :param user: The user who performed the action
+        :type user: str
+        :param timestamp: Time of the action
+        :type timestamp: str
+        :param command: The action
+        :type command: str
+        """
+        self.write_record(user, timestamp, command)
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self.flush(now)
+
+    @property
+    def bytes_written(self):
+        """
+        Size of the log so far, including buffered records.
+        Flushes the buffer, so it is meant for occasional use (e.g. 'stats').
+
+        :rtype: int
+        """
+        if self.closed:
+            return os.path.getsize(self.path)
+        return self._file.tell()
+
+    def flush(self, now=None):
+        self._file.flush()
+        self._last_flush = time.monotonic() if now is None else now
+
+    def close(self):
+        """
+        Finishes the log (closing tags etc.) and closes the file.
+        Safe to call more than once.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.finish()
+        self._file.close()
+
+
+class XMLLogWriter(SessionLogWriter):
+    """
+    Writes the log as a '<session>' element with one '<action>' per command,
+    the same layout the ElementTree based log used.
+    A log cut off by a crash is repaired with recover_xml_log and kept
+    as '<log>.1' when the next session starts; so is, unchanged, a file
+    at the log path that is not an XML session log at all.
+    """
+
+    def __init__(self, path, flush_bytes=8192, flush_interval=1.0):
+        try:
+            repaired = recover_xml_log(path)
+        except ValueError:
+            repaired = True
+        if repaired:
+            os.replace(path, path + ".1")
+        super().__init__(path, flush_bytes, flush_interval)
+
+    def start(self):
+        self._file.write("<session>")
+
+    def finish(self):
+        self._file.write(SESSION_END_TAG)
+
+    def write_record(self, user, timestamp, command):
+        self._file.write(
+            f"<action><user>{escape(user)}</user>"
+            f"<timestamp>{timestamp}</timestamp>"
+            f"<command>{escape(command)}</command></action>\n"
+        )
+
+
+class CSVLogWriter(SessionLogWriter):
+    """
+    Writes the log as CSV with a 'user,timestamp,command' header.
+    Every record is a complete line, so no recovery is needed after a crash.
+    """
+
+    def start(self):
+        import csv
+
+        self._csv = csv.writer(self._file)
+        self._csv.writerow(("user", "timestamp", "command"))
+
+    def write_record(self, user, timestamp, command):
+        self._csv.writerow((user, timestamp, command))
+
+
+def open_session_log(path, log_format=None, flush_bytes=8192, flush_interval=1.0):
+    """
+    Creates a log writer for the given file.
+
+    :param path: Path to the log file
+    :type path: str
+    :param log_format: 'xml' or 'csv', guessed from the file extension if None
+    :type log_format: str, optional
+    :raises ValueError: If the format is unknown
+    :rtype: SessionLogWriter
+    """
+    if log_format is None:
+        log_format = "csv" if path.lower().endswith(".csv") else "xml"
+    writers = {"xml": XMLLogWriter, "csv": CSVLogWriter}
+    if log_format not in writers:
+        raise ValueError(f"Unknown log format: {log_format}")
+    return writers[log_format](path, flush_bytes, flush_interval)
@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from config_cache import load_toml
+from session_log import open_session_log
+from var28 import ShellEmulator, load_image_from_config
+
+# Longest command line a client may send, asyncio's default stream limit
+LINE_LIMIT = 64 * 1024
+
+
+class ThreadStdout:
+    """
+    Stand-in for sys.stdout that sends each thread's output to its own
+    stream, so commands of different sessions can print at the same time.
+    Threads that redirected nothing write to the original stream.
+    """
+
+    def __init__(self, default):
+        """
+        :param default: Stream of threads without a redirection
+        :type default: io.TextIOBase
+        """
+        self.default = default
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, "target", None) or self.default
+
+    @contextmanager
+    def redirect(self, out):
+        """
+        Sends the output of the current thread to out, like
+        contextlib.redirect_stdout does for the whole process.
+
+        :param out: Stream to write to
+        :type out: io.TextIOBase
+        """
+        previous = getattr(self._local, "target", None)
+        self._local.target = out
+        try:
+            yield out
+        finally:
+            self._local.target = previous
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+class _SharedLog:
+    """
+    Session log shared by the sessions of a server: each call runs under a
+    lock, as the sessions write from several worker threads.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._lock = threading.Lock()
+
+    def write(self, user, timestamp, command):
+        with self._lock:
+            self._logger.write(user, timestamp, command)
+
+    def flush(self):
+        with self._lock:
+            self._logger.flush()
+
+    def close(self):
+        with self._lock:
+            self._logger.close()
+
+    @property
+    def bytes_written(self):
+        with self._lock:
+            return self._logger.bytes_written
+
+
+class ShellServer:
+    """
+    Hosts many shell sessions in one process over TCP or a Unix socket.
+
+    The VFS image is loaded once and shared read-only by all sessions, as is
+    the session log. Each session only keeps its own user, current directory,
+    history and start time (see ShellEmulator's host parameter).
+
+    Commands run in a pool of worker threads ([server] workers, by default
+    the ThreadPoolExecutor default), so a slow command neither stops the
+    event loop nor the commands of other sessions; the commands of one
+    session still run one after another. The shared image store and log
+    lock their state, and sys.stdout is replaced by a ThreadStdout so each
+    worker prints to the session it is running a command for.
+    """
+
+    def __init__(self, config_path):
+        """
+        :param config_path: Path to the configuration file
+        :type config_path: str
+        """
+        self.config = load_toml(config_path)
+        self.image = load_image_from_config(self.config)
+        log_options = self.config.get("log", {})
+        self.logger = _SharedLog(open_session_log(
+            self.config["paths"]["log"],
+            log_options.get("format"),
+            log_options.get("flush_bytes", 8192),
+            log_options.get("flush_interval", 1.0),
+        ))
+        self.sessions = set()
+        self._executor = ThreadPoolExecutor(max_workers=self.config.get("server", {}).get("workers"))
+        self._stdout = sys.stdout
+        self.stdout = sys.stdout = ThreadStdout(sys.stdout)
+
+    def session_count(self):
+        """
+        Number of logged in users.
+
+        :rtype: int
+        """
+        return len(self.sessions)
+
+    def start_session(self, user):
+        """
+        Creates a session for a user.
+
+        :param user: Name of the user, the configured one if empty
+        :type user: str
+        :rtype: ShellEmulator
+        """
+        session = ShellEmulator(self.config, host=self, user=user or None)
+        self.sessions.add(session)
+        return session
+
+    def end_session(self, session):
+        self.sessions.discard(session)
+
+    async def handle(self, reader, writer):
+        """
+        Serves one connection: asks for a login name, runs the start script,
+        then executes command lines until 'exit' or end of input.
+        A line longer than LINE_LIMIT ends the session.
+        """
+        writer.write(b"login: ")
+        try:
+            line = await reader.readline()
+        except ValueError:
+            writer.write(b"line too long\n")
+            writer.close()
+            return
+        session = self.start_session(line.decode("utf-8", "replace").strip())
+        out = io.StringIO()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._run, out, session.run_start_script)
+            while True:
+                writer.write(out.getvalue().encode("utf-8") + session.prompt().encode("utf-8"))
+                out.seek(0)
+                out.truncate()
+                await writer.drain()
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # The stream limit was hit; the rest of the line is still unread
+                    writer.write(b"line too long, closing the session\n")
+                    break
+                if not line:
+                    break
+                command = line.decode("utf-8", "replace").strip()
+                try:
+                    await loop.run_in_executor(self._executor, self._run, out, session.execute, command)
+                except SystemExit:
+                    writer.write(out.getvalue().encode("utf-8"))
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            if session in self.sessions:
+                session.close()
+            writer.close()
+
+    def _run(self, out, function, *args):
+        # Runs in a worker thread, with its output going to the session
+        with self.stdout.redirect(out):
+            return function(*args)
+
+    async def serve(self, host="127.0.0.1", port=2323, unix_path=None):
+        """
+        Accepts connections until cancelled.
+
+        :param host: Address to listen on
+        :type host: str
+        :param port: TCP port
+        :type port: int
+        :param unix_path: Listen on this Unix socket instead of TCP
+        :type unix_path: str, optional
+        """
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, unix_path, limit=LINE_LIMIT)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self._executor.shutdown()
+        sys.stdout = self._stdout
+        for session in list(self.sessions):
+            session.close()
+        self.logger.close()
+        self.image.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-session shell emulator server")
+    parser.add_argument("config", help="path to config.toml")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2323)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket")
+    cli_args = parser.parse_args()
+
+    shell_server = ShellServer(cli_args.config)
+    try:
+        asyncio.run(shell_server.serve(cli_args.host, cli_args.port, cli_args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shell_server.close()
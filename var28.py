@@ -1,77 +1,212 @@
 import os
-import xml.etree.ElementTree as ET
-import zipfile
-from calendar import TextCalendar
-from datetime import datetime, timedelta
-import io
-import toml
+import sys
 import time
+from datetime import datetime
+import io
+import posixpath
+from commands import COMMAND_NOT_FOUND, COMMANDS, command, parse_flags, split_redirect, tokenize
+from config_cache import load_toml
+from session_log import open_session_log
+
+# Modules only some commands need (content, find_index, history, overlay,
+# vfs, instrumentation, json, re, ...) are imported where they are used,
+# keeping the time to the first prompt low.
+
+
+def load_image_from_config(config):
+    """
+    Loads the VFS image named by [paths] vfs with the [vfs] options.
+
+    :param config: The loaded configuration
+    :type config: dict
+    :rtype: vfs.VFSImage
+    """
+    from vfs import load_image
+
+    zip_path = config["paths"]["vfs"]
+    vfs_options = config.get("vfs", {})
+    index_path = vfs_options.get("index_cache", False) or None
+    if index_path is True:
+        index_path = zip_path + ".idx"
+    return load_image(
+        zip_path,
+        vfs_options.get("lazy", False),
+        vfs_options.get("cache_size", 64 * 1024 * 1024),
+        index_path,
+        vfs_options.get("index_small_files", 4096),
+    )
 
 
 class ShellEmulator:
-    def __init__(self, config_path):
+    def __init__(self, config_path, batch=None, batch_json=None, host=None, user=None):
         """
         Initializes the ShellEmulator object from a configuration file.
-        :param config_path: Path to the configuration file
-        :type config_path: str
+        :param config_path: Path to the configuration file or the loaded configuration
+        :type config_path: str or dict
+        :param batch: Script to run non-interactively ('-' for stdin),
+            overrides [paths] batch
+        :type batch: str, optional
+        :param batch_json: Write batch results as JSON lines,
+            overrides [paths] batch_json
+        :type batch_json: bool, optional
+        :param host: Server hosting this shell as one of its sessions
+            (see shell_server). The session uses the host's shared VFS image
+            and log instead of loading its own, and does not run the start script.
+        :type host: shell_server.ShellServer, optional
+        :param user: Name of the logged in user, defaults to [user] name
+        :type user: str, optional
         """
         self.config = self.load_config(config_path)
-        self.username = self.config["user"]["name"]
+        self.host = host
+        self.username = user or self.config["user"]["name"]
         self.computer_name = self.config["user"]["computer"]
         self.fs_zip_path = self.config["paths"]["vfs"]
         self.log_file = self.config["paths"]["log"]
         self.start_script = self.config["paths"]["start_script"]
         self.parametr = self.config["user"]["parametr"]
+        self.batch = batch if batch is not None else self.config["paths"].get("batch")
+        self.batch_json = (
+            batch_json if batch_json is not None else self.config["paths"].get("batch_json", False)
+        )
+        self.tree_max_entries = self.config.get("tree", {}).get("max_entries", 100000)
+        self.grep_workers = self.config.get("content", {}).get("workers")
+        stats_options = self.config.get("stats", {})
+        self.stats = None
+        if stats_options.get("enabled", False):
+            from instrumentation import SessionStats
+
+            self.stats = SessionStats(stats_options.get("log_interval"))
+        self.profiler = None
+        if stats_options.get("profile"):
+            from instrumentation import Profiler
+
+            self.profiler = Profiler(
+                stats_options["profile"],
+                stats_options.get("profile_output", f"{self.log_file}.{stats_options['profile']}"),
+            )
         self.current_path = "/"
-        self.vfs = {}
-        self.hist = []
+        # The VFS image, the log and the history are created on first use
+        self._image = None
+        self._logger = None
+        self._hist = None
+        # Shared with every shell until register_command adds a command
+        self.commands = COMMANDS
         self.start = time.time()
         self.start_ = datetime.now()
-        self.load_vfs()
-        self.create_log_file()
-        self.run_start_script()
+        if host is not None:
+            # The shared log is already open, log the login right away
+            self.create_log_file()
+        self.load_plugins()
+        if not self.batch and host is None:
+            self.run_start_script()
 
     def load_config(self, config_path: str) -> dict:
         """
         Loads the configuration from the given file path.
 
-        :param config_path: Path to the configuration file
-        :type config_path: str
+        :param config_path: Path to the configuration file, an already
+            loaded configuration is returned as is
+        :type config_path: str or dict
         :return: The loaded configuration
         :rtype: dict
         """
-        with open(config_path, "r") as f:
-            return toml.load(f)
+        if isinstance(config_path, dict):
+            return config_path
+        return load_toml(config_path)
+
+    @property
+    def image(self):
+        """
+        The session's Overlay on the VFS image, loaded on first use.
+
+        :rtype: overlay.Overlay
+        """
+        if self._image is None:
+            self.load_vfs()
+        return self._image
+
+    @property
+    def fs(self):
+        return self.image.fs
+
+    @property
+    def vfs(self):
+        return self.image.vfs
+
+    @property
+    def logger(self):
+        """
+        The session log writer, opened on first use.
+
+        :rtype: session_log.SessionLogWriter
+        """
+        if self._logger is None:
+            self.create_log_file()
+        return self._logger
+
+    @property
+    def hist(self):
+        """
+        The command history (see history.CommandHistory), created on first
+        use with the [history] options. Sessions of a server keep their
+        history in memory only.
+
+        :rtype: history.CommandHistory
+        """
+        if self._hist is None:
+            from history import CommandHistory
+
+            history_options = self.config.get("history", {})
+            self._hist = CommandHistory(
+                history_options.get("size", 1000),
+                history_options.get("file") if self.host is None else None,
+            )
+        return self._hist
 
     def load_vfs(self):
         """
         Loads the virtual file system from the zip file at the given path.
+        Besides the path -> content map, builds a directory tree
+        (self.fs) that ls, cd and tree use to avoid scanning every path.
+
+        Every content read goes through the image's LazyZipStore. In lazy
+        mode ([vfs] lazy = true) only the central directory is read and
+        file contents are decompressed on first access; otherwise all of
+        them are decompressed into the store's cache while loading.
+        With [vfs] index_cache the central directory comes from an index
+        cache file instead (see vfs_index); true means '<archive>.idx'.
 
-        :raises UnicodeDecodeError: If a file cannot be decoded as UTF-8
+        A hosted session shares the image of its host. Either way the
+        session writes into its own copy-on-write Overlay on top of it.
         """
-        with zipfile.ZipFile(self.fs_zip_path, "r") as zip_ref:
-            for file in zip_ref.namelist():
-                normalized_path = os.path.join("/", file)  # Ensure paths start with '/'
-                try:
-                    # Try to decode as UTF-8
-                    self.vfs[normalized_path] = zip_ref.read(file).decode("utf-8")
-                except UnicodeDecodeError:
-                    # If decoding fails, store the raw binary data or skip the file
-                    print(f"Warning: Unable to decode {file}. Storing as binary.")
-                    self.vfs[normalized_path] = zip_ref.read(
-                        file
-                    )  # Store binary data without decoding
+        from overlay import Overlay
+
+        if self.host is not None:
+            self._image = Overlay(self.host.image)
+        else:
+            if self._image is not None:
+                self._image.close()
+            self._image = Overlay(load_image_from_config(self.config))
 
     def create_log_file(self):
         """
-        Initializes the log file. Creates an XML file with a root 'session' element.
-        Then logs the 'session_start' action.
+        Initializes the log file. Opens a streaming log writer (XML with
+        a root 'session' element or CSV, see the [log] config section).
+        Then logs the 'session_start' action with the time the session started.
         """
-        root = ET.Element("session")
-        self.log_tree = ET.ElementTree(root)
-        self.log_action("session_start")
+        if self.host is not None:
+            self._logger = self.host.logger
+        else:
+            log_options = self.config.get("log", {})
+            self._logger = open_session_log(
+                self.log_file,
+                log_options.get("format"),
+                log_options.get("flush_bytes", 8192),
+                log_options.get("flush_interval", 1.0),
+            )
+        self.log_action("session_start", timestamp=self.start)
 
-    def log_action(self, action, user=None):
+    def log_action(self, action, user=None, timestamp=None):
         """
         Logs an action in the log file.
 
@@ -79,77 +214,649 @@ class ShellEmulator:
         :type action: str
         :param user: The user who performed the action, defaults to self.username
         :type user: str, optional
+        :param timestamp: Time of the action (as from time.time()), defaults to now
+        :type timestamp: float, optional
         """
         if user is None:
             user = self.username
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        root = self.log_tree.getroot()
-        entry = ET.SubElement(root, "action")
-        ET.SubElement(entry, "user").text = user
-        ET.SubElement(entry, "timestamp").text = timestamp
-        ET.SubElement(entry, "command").text = action
+        self.logger.write(user, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), action)
 
     def save_log(self):
         """
-        Saves the log to the file specified in the configuration.
-        This method writes the XML log tree to the file specified in the
-        configuration. The log tree is an ElementTree object containing all
-        logged actions.
+        Finishes the log file specified in the configuration.
+        Records are already streamed to disk by the log writer; this
+        flushes the rest and closes the file (writing '</session>' for XML).
         :return: None
         """
-        self.log_tree.write(self.log_file)
+        if self.host is None:
+            self.logger.close()
+
+    def register_command(self, name, handler):
+        """
+        Adds a command to this shell, replacing a built-in one with the same name.
+
+        :param name: Name of the command
+        :type name: str
+        :param handler: Called as handler(shell, args), may return an exit status
+        :type handler: Callable[[ShellEmulator, list[str]], int or None]
+        """
+        if self.commands is COMMANDS:
+            self.commands = dict(COMMANDS)
+        self.commands[name] = handler
+
+    def load_plugins(self):
+        """
+        Imports the modules listed in [plugins] modules of the configuration
+        and calls their register(shell) function, which is expected to add
+        commands with register_command.
+        """
+        import importlib
+
+        for module_name in self.config.get("plugins", {}).get("modules", []):
+            importlib.import_module(module_name).register(self)
 
     def run_start_script(self):
         if os.path.exists(self.start_script) and self.start_script.endswith(".sh"):
             print(f"Running start script: {self.start_script}")
             with open(self.start_script, "r") as f:
-                commands = f.readlines()
-            for command in commands:
-                command = command.strip()
-                if command and not command.startswith("#"):  # Skip comments
-                    print(f"Executing command from script: {command}")
-                    self.execute(command)
+                for command in f:
+                    command = command.strip()
+                    if command and not command.startswith("#"):  # Skip comments
+                        print(f"Executing command from script: {command}")
+                        self.execute(command)
+
+    def run_batch(self, source=None):
+        """
+        Runs commands non-interactively: the start script first, then the
+        lines of source, read as a stream. Commands are not echoed and all
+        output goes through one large buffer. With batch_json each command
+        produces one JSON line with its command, status, duration (seconds)
+        and output instead of plain text.
+
+        :param source: Iterable of command lines, defaults to the batch
+            script (or stdin for '-')
+        :type source: Iterable[str], optional
+        """
+        if source is None:
+            source = sys.stdin if self.batch == "-" else open(self.batch, "r")
+        out = self._batch_writer()
+        stdout = sys.stdout
+        captured = None
+        if self.batch_json:
+            import json
+
+            captured = io.StringIO()
+        sys.stdout = captured if captured is not None else out
+        try:
+            scripts = [self._start_script_lines(), source]
+            for script in scripts:
+                for command in script:
+                    command = command.strip()
+                    if not command or command.startswith("#"):  # Skip comments
+                        continue
+                    started = time.perf_counter()
+                    try:
+                        status = self.execute(command)
+                    except SystemExit:
+                        # exit already closed the session
+                        status = None
+                    if captured is not None:
+                        record = {
+                            "command": command,
+                            "status": status or 0,
+                            "duration": round(time.perf_counter() - started, 6),
+                            "output": captured.getvalue(),
+                        }
+                        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                        captured.seek(0)
+                        captured.truncate()
+                    if status is None:
+                        return
+            self.close()
+        finally:
+            sys.stdout = stdout
+            out.flush()
+            if source is not sys.stdin and hasattr(source, "close"):
+                source.close()
+
+    def _start_script_lines(self):
+        if os.path.exists(self.start_script) and self.start_script.endswith(".sh"):
+            with open(self.start_script, "r") as f:
+                yield from f
+
+    @staticmethod
+    def _batch_writer():
+        try:
+            return open(sys.stdout.fileno(), "w", buffering=1 << 20, encoding="utf-8", closefd=False)
+        except (AttributeError, OSError, ValueError):
+            # stdout is not a real file (e.g. captured), write to it directly
+            return sys.stdout
 
     def prompt(self):
         return f"{self.username}@{self.computer_name}:{self.current_path}$ "
 
     def execute(self, command):
-        if command.startswith("cd "):
-            self.cd(command[3:])
-            self.hist.append(command)
-        elif command.startswith("ls"): # 1
-            if len(command) == 2:
-                self.ls()
+        """
+        Runs one command line: looks the command up in the registry, records
+        it in the history and the log. A trailing '> FILE' or '>> FILE'
+        (also without the space, see split_redirect) writes (or appends)
+        the output of the command to a file of the VFS.
+
+        :param command: The command line
+        :type command: str
+        :return: Exit status of the command
+        :rtype: int
+        """
+        if command.startswith("!") and len(command) > 1:
+            expanded = self.hist.expand(command)
+            if expanded is None:
+                print(f"{command}: event not found")
+                self.log_action(command)
+                return 1
+            command = expanded
+            print(command)
+        redirect = None
+        try:
+            line, redirect = split_redirect(command)
+            args = tokenize(line)
+        except ValueError as e:
+            print(f"Syntax error: {e}")
+            args = None
+        status = 2
+        if args:
+            handler = self.commands.get(args[0])
+            if handler is None:
+                print(f"Command not found: {command}")
+                status = COMMAND_NOT_FOUND
+            elif self.stats is None and redirect is None:
+                status = handler(self, args[1:]) or 0
+                self.hist.append(command)
             else:
-                self.ls_args(command[3:])
-            self.hist.append(command)
-        elif len(command) > 3 and command[2:] == "ls":
-            self.ls()
-        elif command == "exit":
-            self.exit_shell()
-            self.hist.append(command)
-        elif command == "whoami":
-            self.whoami()
-            self.hist.append(command)
-        elif command == "tree":
-            self.tree(self.current_path)
-            self.hist.append(command) 
-        elif command =="pwd":
-            self.pwd()
-            self.hist.append(command)
-        elif command == "history":
-            self.history()
-            self.hist.append(command)
-        elif command == "uptime":
-            self.uptime()
-            self.hist.append(command)
-        else:
-            print(f"Command not found: {command}")
+                started = time.perf_counter()
+                if redirect is None:
+                    status = handler(self, args[1:]) or 0
+                else:
+                    status = self._run_redirected(handler, args[1:], *redirect)
+                if self.stats is not None:
+                    self.stats.record(args[0], time.perf_counter() - started)
+                self.hist.append(command)
+        elif args is not None:
+            status = 0
         self.log_action(command)
+        if self.stats is not None and self.stats.dump_due():
+            self.log_action(self.stats.summary())
+        return status
 
-    def history(self):
-        for command in self.hist:
-            print(command)
+    def _run_redirected(self, handler, args, operator, target):
+        from contextlib import redirect_stdout
+
+        out = io.StringIO()
+        # Under the shell server only this thread's output may be redirected
+        redirect = getattr(sys.stdout, "redirect", redirect_stdout)
+        with redirect(out):
+            status = handler(self, args) or 0
+        try:
+            self.image.write(self._abspath(target), out.getvalue().encode("utf-8"), operator == ">>")
+        except OSError as e:
+            print(f"{target}: {e.strerror}")
+            return 1
+        return status
+
+    def _abspath(self, path):
+        """
+        Normalized absolute VFS path of a path relative to the current directory.
+
+        :rtype: str
+        """
+        return "/" + posixpath.normpath(posixpath.join(self.current_path, path)).lstrip("/")
+
+    @command("cd")
+    def _cmd_cd(self, args):
+        if len(args) > 1:
+            print("cd: too many arguments")
+            return 1
+        return self.cd(args[0] if args else "/")
+
+    @command("ls")
+    def _cmd_ls(self, args):
+        if not args:
+            return self.ls()
+        status = 0
+        for path in args:
+            status = self.ls_args(path) or status
+        return status
+
+    @command("tree")
+    def _cmd_tree(self, args):
+        return self.tree_args(args)
+
+    @command("exit")
+    def _cmd_exit(self, args):
+        self.exit_shell()
+
+    @command("whoami")
+    def _cmd_whoami(self, args):
+        self.whoami()
+
+    @command("pwd")
+    def _cmd_pwd(self, args):
+        self.pwd()
+
+    @command("history")
+    def _cmd_history(self, args):
+        """
+        history [-n] [N] prints the last N commands (all without N),
+        -n with their numbers; history -s TEXT finds commands containing TEXT.
+        """
+        try:
+            flags, rest = parse_flags(args, "ns:")
+        except ValueError as e:
+            print(f"history: {e}")
+            return 2
+        if "-s" in flags:
+            for number, line in self.hist.search(flags["-s"]):
+                print(f"{number:>5}  {line}")
+            return 0
+        if rest and not rest[0].isdigit():
+            print(f"history: {rest[0]}: numeric argument required")
+            return 2
+        self.history(int(rest[0]) if rest else None, "-n" in flags)
+
+    @command("uptime")
+    def _cmd_uptime(self, args):
+        self.uptime()
+
+    @command("cat")
+    def _cmd_cat(self, args):
+        if not args:
+            print("cat: missing file operand")
+            return 1
+        from content import copy_text
+
+        status = 0
+        for path in args:
+            member = self._member_path("cat", path)
+            if member is None:
+                status = 1
+                continue
+            with self.image.open(member) as stream:
+                if copy_text(stream, sys.stdout):
+                    # Keep the prompt on its own line
+                    sys.stdout.write("\n")
+        return status
+
+    @command("head")
+    def _cmd_head(self, args):
+        try:
+            flags, paths = parse_flags(args, "n:")
+        except ValueError as e:
+            print(f"head: {e}")
+            return 2
+        count = flags.get("-n", "10")
+        if not count.isdigit():
+            print(f"head: invalid number of lines: '{count}'")
+            return 2
+        if not paths:
+            print("head: missing file operand")
+            return 1
+        from content import text_lines
+
+        status = 0
+        for i, path in enumerate(paths):
+            member = self._member_path("head", path)
+            if member is None:
+                status = 1
+                continue
+            if len(paths) > 1:
+                if i:
+                    print()
+                print(f"==> {path} <==")
+            with self.image.open(member) as stream:
+                for n, line in enumerate(text_lines(stream)):
+                    if n == int(count):
+                        break
+                    sys.stdout.write(line if line.endswith("\n") else line + "\n")
+        return status
+
+    @command("wc")
+    def _cmd_wc(self, args):
+        try:
+            flags, paths = parse_flags(args, "lwc")
+        except ValueError as e:
+            print(f"wc: {e}")
+            return 2
+        if not paths:
+            print("wc: missing file operand")
+            return 1
+        from content import word_count
+
+        shown = [i for i, flag in enumerate(("-l", "-w", "-c")) if flag in flags] or [0, 1, 2]
+        totals = [0, 0, 0]
+        status = 0
+        for path in paths:
+            member = self._member_path("wc", path)
+            if member is None:
+                status = 1
+                continue
+            with self.image.open(member) as stream:
+                counts = word_count(stream)
+            totals = [a + b for a, b in zip(totals, counts)]
+            print(" ".join(f"{counts[i]:>7}" for i in shown) + f" {path}")
+        if len(paths) > 1:
+            print(" ".join(f"{totals[i]:>7}" for i in shown) + " total")
+        return status
+
+    @command("grep")
+    def _cmd_grep(self, args):
+        """
+        grep [-r] [-i] [-n] PATTERN [PATH...]; recursive searches are spread
+        over [content] workers processes. File names are printed as given;
+        files found under a directory as the directory as given plus their
+        path inside it (without a directory, -r searches '.' and prints
+        just the relative paths, like GNU grep).
+        """
+        try:
+            flags, rest = parse_flags(args, "rin")
+        except ValueError as e:
+            print(f"grep: {e}")
+            return 2
+        if not rest:
+            print("grep: missing pattern")
+            return 2
+        pattern, paths = rest[0], rest[1:]
+        recursive = "-r" in flags
+        # Printed before the relative paths of files found under each directory
+        prefixes = [path if path.endswith("/") else path + "/" for path in paths]
+        if not paths:
+            if not recursive:
+                print("grep: missing file operand")
+                return 2
+            paths, prefixes = ["."], [""]
+        import re
+
+        from content import grep_lines, grep_members, text_lines
+
+        re_flags = re.IGNORECASE if "-i" in flags else 0
+        try:
+            re.compile(pattern, re_flags)
+        except re.error as e:
+            print(f"grep: invalid pattern: {e}")
+            return 2
+        status = 1
+        # (VFS path, name to print) of every file to search
+        members = []
+        for path, prefix in zip(paths, prefixes):
+            node = self.fs.lookup(path, self.current_path)
+            if node is None:
+                print(f"grep: {path}: No such file or directory")
+                status = 2
+            elif not node.is_dir:
+                members.append((node.path, path))
+            elif recursive:
+                base = len(node.path)
+                members.extend(
+                    (child.path, prefix + child.path[base:])
+                    for _, child in self.fs.walk(node)
+                    if child is not None and not child.is_dir
+                )
+            else:
+                print(f"grep: {path}: Is a directory")
+        sources = []
+        # Files written in this session's overlay, not in the archive
+        written = set()
+        for member, _ in members:
+            try:
+                sources.append(os.path.join("/", self.image.member_name(member)))
+            except KeyError:
+                written.add(member)
+        show_names = recursive or len(members) > 1
+        matches = grep_members(self.vfs, sources, pattern, re_flags, self.grep_workers)
+        regex = re.compile(pattern, re_flags)
+        for member, shown in members:
+            if member in written:
+                with self.image.open(member) as stream:
+                    lines = list(grep_lines(text_lines(stream), regex))
+            else:
+                _, lines = next(matches)
+            for number, line in lines:
+                prefix = f"{shown}:" if show_names else ""
+                if "-n" in flags:
+                    prefix += f"{number}:"
+                print(prefix + line)
+                if status == 1:
+                    status = 0
+        return status
+
+    @command("find")
+    def _cmd_find(self, args):
+        """
+        find [PATH] [-name GLOB] [-path GLOB] [-type f|d] [-maxdepth N]
+        [-size [+-]N[cwbkMG]]; all predicates must match. -path is matched
+        against the path as it is printed (relative to PATH as given).
+        """
+        start = "."
+        if args and not args[0].startswith("-"):
+            start, args = args[0], args[1:]
+        predicates = {}
+        from find_index import parse_size
+
+        options = {"-name": "name", "-path": "path", "-type": "kind", "-maxdepth": "maxdepth", "-size": "size"}
+        for i in range(0, len(args), 2):
+            option = args[i]
+            if option not in options:
+                print(f"find: unknown predicate '{option}'")
+                return 2
+            if i + 1 == len(args):
+                print(f"find: missing argument to '{option}'")
+                return 2
+            value = args[i + 1]
+            if option == "-type" and value not in ("f", "d"):
+                print(f"find: unknown argument to -type: {value}")
+                return 2
+            if option == "-maxdepth":
+                if not value.isdigit():
+                    print(f"find: invalid argument '{value}' to -maxdepth")
+                    return 2
+                value = int(value)
+            if option == "-size":
+                try:
+                    value = parse_size(value)
+                except ValueError as e:
+                    print(f"find: {e}")
+                    return 2
+            predicates[options[option]] = value
+        node = self.fs.lookup(start, self.current_path)
+        if node is None:
+            print(f"find: '{start}': No such file or directory")
+            return 1
+        base = node.path
+        prefix = start if start.endswith("/") else start + "/"
+        out = sys.stdout
+        lines = []
+        for entry in self.image.find_index().query(base, shown=start, **predicates):
+            relative = entry[len(base):].rstrip("/")
+            lines.append(prefix + relative if relative else start)
+            if len(lines) >= 4096:
+                out.write("\n".join(lines) + "\n")
+                lines.clear()
+        if lines:
+            out.write("\n".join(lines) + "\n")
+        return 0
+
+    @command("echo")
+    def _cmd_echo(self, args):
+        print(" ".join(args))
+
+    @command("mkdir")
+    def _cmd_mkdir(self, args):
+        try:
+            flags, paths = parse_flags(args, "p")
+        except ValueError as e:
+            print(f"mkdir: {e}")
+            return 2
+        if not paths:
+            print("mkdir: missing operand")
+            return 1
+        status = 0
+        for path in paths:
+            try:
+                self.image.mkdir(self._abspath(path), "-p" in flags)
+            except OSError as e:
+                print(f"mkdir: cannot create directory '{path}': {e.strerror}")
+                status = 1
+        return status
+
+    @command("touch")
+    def _cmd_touch(self, args):
+        if not args:
+            print("touch: missing file operand")
+            return 1
+        status = 0
+        for path in args:
+            try:
+                self.image.touch(self._abspath(path))
+            except OSError as e:
+                print(f"touch: cannot touch '{path}': {e.strerror}")
+                status = 1
+        return status
+
+    @command("rm")
+    def _cmd_rm(self, args):
+        try:
+            flags, paths = parse_flags(args, "rf")
+        except ValueError as e:
+            print(f"rm: {e}")
+            return 2
+        if not paths and "-f" not in flags:
+            print("rm: missing operand")
+            return 1
+        status = 0
+        for path in paths:
+            try:
+                self.image.remove(self._abspath(path), "-r" in flags)
+            except FileNotFoundError as e:
+                if "-f" not in flags:
+                    print(f"rm: cannot remove '{path}': {e.strerror}")
+                    status = 1
+            except OSError as e:
+                print(f"rm: cannot remove '{path}': {e.strerror}")
+                status = 1
+        return status
+
+    @command("mv")
+    def _cmd_mv(self, args):
+        if len(args) < 2:
+            print("mv: missing destination file operand")
+            return 1
+        *sources, target = args
+        if len(sources) > 1:
+            node = self.fs.lookup(target, self.current_path)
+            if node is None or not node.is_dir:
+                print(f"mv: target '{target}' is not a directory")
+                return 1
+        status = 0
+        for source in sources:
+            try:
+                self.image.move(self._abspath(source), self._abspath(target))
+            except OSError as e:
+                print(f"mv: cannot move '{source}' to '{target}': {e.strerror}")
+                status = 1
+        return status
+
+    @command("commit")
+    def _cmd_commit(self, args):
+        """
+        commit ARCHIVE writes the VFS with this session's changes as a new
+        zip archive on the host file system.
+
+        With [vfs] commit_dir the archive is a relative path inside that
+        directory. Without it, sessions of a shell server cannot commit:
+        their users must not write anywhere on the host.
+        """
+        if len(args) != 1:
+            print("commit: usage: commit ARCHIVE")
+            return 2
+        target = self._commit_path(args[0])
+        if target is None:
+            return 1
+        try:
+            count = self.image.commit(target)
+        except OSError as e:
+            print(f"commit: {args[0]}: {e.strerror}")
+            return 1
+        print(f"Committed {count} entries to {args[0]}")
+
+    def _commit_path(self, name):
+        """
+        Host path the commit command writes an archive name to.
+
+        :return: The path, None (after printing why) if it is not allowed
+        :rtype: str or None
+        """
+        commit_dir = self.config.get("vfs", {}).get("commit_dir")
+        if commit_dir is None:
+            if self.host is not None:
+                print("commit: disabled for remote sessions ([vfs] commit_dir is not set)")
+                return None
+            return name
+        root = os.path.realpath(commit_dir)
+        target = os.path.realpath(os.path.join(root, name))
+        if os.path.isabs(name) or ".." in name.replace("\\", "/").split("/") or (
+            os.path.commonpath([root, target]) != root or target == root
+        ):
+            print(f"commit: {name}: must be a relative path inside [vfs] commit_dir")
+            return None
+        return target
+
+    def _member_path(self, name, path):
+        node = self.fs.lookup(path, self.current_path)
+        if node is None:
+            print(f"{name}: {path}: No such file or directory")
+            return None
+        if node.is_dir:
+            print(f"{name}: {path}: Is a directory")
+            return None
+        return node.path
+
+    @command("stats")
+    def _cmd_stats(self, args):
+        self.print_stats()
+
+    def print_stats(self):
+        """
+        Prints command latencies (with [stats] enabled), VFS cache counters,
+        the size of the log and the memory use of the process.
+        """
+        if self.stats is None:
+            print("latency: disabled ([stats] enabled = false)")
+        else:
+            print("\n".join(self.stats.report()))
+        # Every command reads contents through the store, so its counters
+        # cover cat, head, wc and grep (an eager image counts its preload)
+        print(
+            f"vfs cache: hits={self.vfs.hits} misses={self.vfs.misses} "
+            f"bytes_decompressed={self.vfs.bytes_decompressed}"
+        )
+        print(f"log: bytes_written={self.logger.bytes_written}")
+        from instrumentation import rss_bytes
+
+        current, peak = rss_bytes()
+        current = "n/a" if current is None else f"{current / 2 ** 20:.1f} MiB"
+        print(f"rss: current={current} peak={peak / 2 ** 20:.1f} MiB")
+
+    def history(self, count=None, numbered=False):
+        """
+        Prints the history, streaming entries that are no longer in memory
+        from the history file.
+
+        :param count: Print only the last count commands
+        :type count: int, optional
+        :param numbered: Prefix every command with its number (for !n)
+        :type numbered: bool
+        """
+        first = 1 if count is None else len(self.hist) - count + 1
+        for number, line in self.hist.entries(first):
+            print(f"{number:>5}  {line}" if numbered else line)
             
     def pwd(self):
         print(self.current_path)
@@ -159,7 +866,8 @@ class ShellEmulator:
         end = time.time() - self.start
         time_format = time.strftime("%H:%M:%S", time.gmtime(end))
         print(time_format)
-        print("1 user")
+        users = 1 if self.host is None else self.host.session_count()
+        print(f"{users} user" if users == 1 else f"{users} users")
         '''#22:20:33 up 620 days, 22:37,  1 user,  load average: 0.03, 0.10, 0.10
         #22:20:33 — Текущее системное время.
         #up 620 days, 22:37 — Продолжительность работы системы.
@@ -167,95 +875,128 @@ class ShellEmulator:
         #load average: 0.03, 0.10, 0.10 — load average: 0.03, 0.10, 0.10 системы за последние 1, 5 и 15 минут.
 '''
     def cd(self, path):
-        #print(self.vfs)    
         if path == "..":
             if self.current_path != '/':
-                # os.path.dirname - возвращает имя директории по указанному пути
-                self.current_path = os.path.dirname(self.current_path.rstrip('/'))
+                self.current_path = self.fs.lookup_dir("..", self.current_path).path
                 print(f"Перешли на уровень выше: '{self.current_path}'")
         else:
-            path_prefix = (
-            path
-            if path.endswith("/")
-            else "/" + path + "/"
-            )
-            if path_prefix in self.vfs and self.current_path + path + "/" in self.vfs:
-                self.current_path = self.current_path + path + "/"
+            node = self.fs.lookup_dir(path, self.current_path)
+            if node is not None:
+                self.current_path = node.path
             else:
                 print(f"No such directory: {path}")
+                return 1
 
     def ls(self):
-        contents = set()
-        path_prefix = (
-            self.current_path
-            if self.current_path.endswith("/")
-            else self.current_path + "/"
-        )
+        node = self.fs.lookup_dir(self.current_path)
+        # Print unique entries (files/directories) of the current directory
+        print("\n".join(self.fs.listdir(node)))
 
-        # Gather all files and directories that are within the current directory
-        for file in self.vfs:
-            if file.startswith(path_prefix):
-                sub_path = file[len(path_prefix) :].split("/")[
-                    0
-                ]  # Get the first directory level
-                contents.add(sub_path)
-
-        # Print unique entries (files/directories)
-        print("\n".join(sorted(contents)))
-
-
-    def cd_l(self):
-        if self.current_path != '/':
-                # os.path.dirname - возвращает имя директории по указанному пути
-                self.current_path = os.path.dirname(self.current_path.rstrip('/'))
-
-    def ls_args(self,path):
-            contents = set()
-            self.cd(path)
-            path_prefix = (
-                self.current_path
-                if self.current_path.endswith("/")
-                else self.current_path + "/"
-            )
-            for file in self.vfs:
-                if file.startswith(path_prefix):
-                    sub_path = file[len(path_prefix) :].split("/")[
-                        0
-                    ]  # Get the first directory level
-                    contents.add(sub_path)
-
-            # Print unique entries (files/directories)
-            self.cd_l()
-            print("\n".join(sorted(contents)))
-
-
-    def tree(self, path, indent=""):
-        # Ensure the current path ends with a '/'
-        path_prefix = path if path.endswith("/") else path + "/"
-        printed_dirs = set()
-
-        for file in sorted(self.vfs):
-            if file.startswith(path_prefix):
-                relative_path = file[len(path_prefix) :]
-                if "/" in relative_path:
-                    # This means it's a directory
-                    first_dir = relative_path.split("/")[0]
-                    if first_dir not in printed_dirs:
-                        print(f"{indent}{first_dir}/")
-                        printed_dirs.add(first_dir)
-                        # Recursively call tree for the subdirectory
-                        self.tree(os.path.join(path, first_dir), indent + "  ")
-                else:
-                    # It's a file, print it
-                    print(f"{indent}{relative_path}")
+    def ls_args(self, path):
+        node = self.fs.lookup_dir(path, self.current_path)
+        if node is None:
+            print(f"No such directory: {path}")
+            return 1
+        print("\n".join(self.fs.listdir(node)))
+
+    def tree_args(self, args):
+        """
+        Parses 'tree [-L depth] [-d] [path]' and prints the tree.
+
+        :param args: Arguments of the tree command
+        :type args: list[str]
+        :return: Exit status
+        :rtype: int
+        """
+        try:
+            flags, paths = parse_flags(args, "L:d")
+        except ValueError as e:
+            print(f"tree: {e}")
+            return 2
+        max_depth = None
+        if "-L" in flags:
+            depth = flags["-L"]
+            if not depth.isdigit() or int(depth) < 1:
+                print("tree: Invalid level, must be greater than 0.")
+                return 2
+            max_depth = int(depth)
+        if len(paths) > 1:
+            print("tree: too many arguments")
+            return 2
+        path = paths[0] if paths else self.current_path
+        node = self.fs.lookup_dir(path, self.current_path)
+        if node is None:
+            print(f"No such directory: {path}")
+            return 1
+        self.tree(node, max_depth, "-d" in flags)
+        return 0
+
+    def tree(self, node, max_depth=None, dirs_only=False, max_entries=None):
+        """
+        Prints a directory tree. The archive is walked once in sorted order
+        and the lines are written to stdout in large chunks.
+
+        :param node: Directory to print, a VFSNode or a path
+        :type node: VFSNode or str
+        :param max_depth: Number of levels to print, None for all
+        :type max_depth: int, optional
+        :param dirs_only: Print directories only
+        :type dirs_only: bool
+        :param max_entries: Stop after this many lines, defaults to the
+            [tree] max_entries config value
+        :type max_entries: int, optional
+        """
+        if isinstance(node, str):
+            node = self.fs.lookup_dir(node, self.current_path)
+            if node is None:
+                return
+        if max_entries is None:
+            max_entries = self.tree_max_entries
+        out = sys.stdout
+        lines = []
+        count = 0
+        for depth, child in self.fs.walk(node, max_depth, dirs_only):
+            if count == max_entries:
+                lines.append(f"... output truncated after {max_entries} entries")
+                break
+            count += 1
+            indent = "  " * depth
+            if child is None:
+                # The archive entry of the directory itself
+                lines.append(indent)
+            elif child.is_dir:
+                lines.append(f"{indent}{child.name}/")
+            else:
+                lines.append(f"{indent}{child.name}")
+            if len(lines) >= 4096:
+                out.write("\n".join(lines) + "\n")
+                lines.clear()
+        if lines:
+            out.write("\n".join(lines) + "\n")
 
     def whoami(self):
         print(self.username)
     
 
-    def exit_shell(self):
+    def close(self):
+        """
+        Ends the session: logs 'session_end', finishes the log and history
+        files and releases the VFS archive.
+        """
         self.log_action("session_end")
         self.save_log()
+        if self._hist is not None:
+            self._hist.close()
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.host is None:
+            if self._image is not None:
+                self._image.close()
+        else:
+            self.host.end_session(self)
+
+    def exit_shell(self):
+        self.close()
         print("Exiting...")
         exit()
 
@@ -268,17 +1009,43 @@ class ShellEmulator:
         manually exits the shell.
         """
         while True:
+            # Nothing stays buffered while waiting for the user
+            if self._logger is not None:
+                self._logger.flush()
             command = input(self.prompt())
             self.execute(command)
 
 
-if __name__ == "__main__":
-    import sys
+def parse_cli(argv):
+    """
+    Parses the command line. The common 'var28.py config.toml' is handled
+    without argparse, which with its dependencies (re, gettext) would take
+    a good part of the startup time.
+
+    :param argv: Arguments without the program name
+    :type argv: list[str]
+    :return: (config, batch, batch_json)
+    :rtype: tuple[str, str or None, bool or None]
+    """
+    if len(argv) == 1 and not argv[0].startswith("-"):
+        return argv[0], None, None
+    import argparse
 
-    if len(sys.argv) != 2:
-        print("Usage: python shell_emulator.py <config.toml>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Shell emulator over a zip VFS image")
+    parser.add_argument("config", help="path to config.toml")
+    parser.add_argument(
+        "--batch", metavar="SCRIPT", help="run commands from SCRIPT ('-' for stdin) non-interactively"
+    )
+    parser.add_argument(
+        "--json", action="store_true", default=None, help="write batch results as JSON lines"
+    )
+    cli_args = parser.parse_args(argv)
+    return cli_args.config, cli_args.batch, cli_args.json
 
-    config_path = sys.argv[1]
-    shell = ShellEmulator(config_path)
-    shell.run()
+
+if __name__ == "__main__":
+    shell = ShellEmulator(*parse_cli(sys.argv[1:]))
+    if shell.batch:
+        shell.run_batch()
+    else:
+        shell.run()
@@ -0,0 +1,307 @@
+import os
+
+from find_index import FindIndex
+from lazyzip import LazyZipStore
+
+_DONE = object()
+
+
+class VFSNode:
+    """
+    A single file or directory of the virtual file system.
+
+    Directories keep their children in a dict keyed by name, so looking up
+    or listing one directory never touches the rest of the archive.
+    """
+
+    __slots__ = ("name", "parent", "children", "explicit")
+
+    def __init__(self, name, parent=None, is_dir=False):
+        """
+        :param name: Name of the entry inside its parent directory
+        :type name: str
+        :param parent: Parent directory node, None for the root
+        :type parent: VFSNode, optional
+        :param is_dir: Whether the node is a directory
+        :type is_dir: bool
+        """
+        self.name = name
+        self.parent = parent
+        self.children = {} if is_dir else None
+        # True when the archive has its own entry for this directory ("a/"),
+        # False for directories that only exist as parents of other entries
+        self.explicit = False
+
+    @property
+    def is_dir(self):
+        return self.children is not None
+
+    @property
+    def path(self):
+        """
+        Absolute path of the node. Directories end with '/'.
+
+        :rtype: str
+        """
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        if not parts:
+            return "/"
+        path = "/" + "/".join(reversed(parts))
+        return path + "/" if self.is_dir else path
+
+    def sorted_children(self):
+        """
+        Children in the order a sorted list of full archive paths would give,
+        i.e. a directory 'a' sorts as 'a/'.
+
+        :rtype: list[VFSNode]
+        """
+        return sorted(
+            self.children.values(),
+            key=lambda child: child.name + "/" if child.is_dir else child.name,
+        )
+
+
+class VFSTree:
+    """
+    Directory tree built from the flat list of archive paths.
+    Missing parent directories are created implicitly.
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: Root directory to start from, e.g. one shared with
+            another tree (see overlay); a new empty root by default
+        :type root: VFSNode, optional
+        """
+        self.root = root if root is not None else VFSNode("", is_dir=True)
+
+    def add(self, path):
+        """
+        Adds an archive path to the tree.
+
+        :param path: Path of the entry, directories end with '/'
+        :type path: str
+        :return: The node created (or found) for the path
+        :rtype: VFSNode
+        """
+        is_dir = path.endswith("/")
+        parts = [part for part in path.split("/") if part]
+        node = self.root
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            child = node.children.get(part)
+            if child is None:
+                child = VFSNode(part, node, is_dir=is_dir or not last)
+                node.children[part] = child
+            elif not child.is_dir and not last:
+                # A file with the same name as a directory: the directory wins
+                child.children = {}
+            node = child
+        if is_dir:
+            node.explicit = True
+        return node
+
+    def lookup(self, path, cwd="/"):
+        """
+        Resolves a path to a node. Relative paths are resolved against cwd,
+        '.' and '..' components are supported.
+
+        :param path: Absolute or relative path
+        :type path: str
+        :param cwd: Current directory
+        :type cwd: str
+        :return: The node or None if the path does not exist
+        :rtype: VFSNode or None
+        """
+        parts = path.split("/") if path.startswith("/") else cwd.split("/") + path.split("/")
+        # '..' pops this stack rather than following parent links, which
+        # may lead out of a tree sharing nodes with another one
+        stack = [self.root]
+        for part in parts:
+            if not part or part == ".":
+                continue
+            node = stack[-1]
+            if not node.is_dir:
+                return None
+            if part == "..":
+                if len(stack) > 1:
+                    stack.pop()
+                continue
+            node = node.children.get(part)
+            if node is None:
+                return None
+            stack.append(node)
+        return stack[-1]
+
+    def lookup_dir(self, path, cwd="/"):
+        """
+        Same as lookup, but only returns directories.
+
+        :rtype: VFSNode or None
+        """
+        node = self.lookup(path, cwd)
+        if node is None or not node.is_dir:
+            return None
+        return node
+
+    def listdir(self, node):
+        """
+        Names of the entries of a directory, sorted.
+        An explicit archive entry for the directory itself is listed as ''.
+
+        :param node: Directory node
+        :type node: VFSNode
+        :rtype: list[str]
+        """
+        names = sorted(node.children)
+        if node.explicit:
+            names.insert(0, "")
+        return names
+
+    def walk(self, node, max_depth=None, dirs_only=False):
+        """
+        Walks a directory depth first in sorted path order, visiting every
+        entry once and without recursion.
+
+        Yields (depth, node) pairs, the children of the start node have
+        depth 0. The archive entry of an explicit directory itself is
+        yielded as (depth, None) before its children.
+
+        :param node: Directory to walk
+        :type node: VFSNode
+        :param max_depth: Number of levels to descend into, None for all
+        :type max_depth: int, optional
+        :param dirs_only: Skip files
+        :type dirs_only: bool
+        :rtype: Iterator[tuple[int, VFSNode or None]]
+        """
+        levels = [self._entries(node, dirs_only)]
+        while levels:
+            child = next(levels[-1], _DONE)
+            if child is _DONE:
+                levels.pop()
+                continue
+            depth = len(levels) - 1
+            yield depth, child
+            if child is not None and child.is_dir and (max_depth is None or depth + 1 < max_depth):
+                levels.append(self._entries(child, dirs_only))
+
+    @staticmethod
+    def _entries(node, dirs_only):
+        if node.explicit and not dirs_only:
+            yield None
+        for child in node.sorted_children():
+            if child.is_dir or not dirs_only:
+                yield child
+
+
+class VFSImage:
+    """
+    A loaded archive: the directory tree plus the path -> content store.
+    Nothing in it changes after loading, so one image can be shared by
+    any number of shell sessions.
+    """
+
+    def __init__(self, fs, vfs, zip_path):
+        """
+        :param fs: Directory tree of the archive
+        :type fs: VFSTree
+        :param vfs: Store every content read goes through
+        :type vfs: LazyZipStore
+        :param zip_path: Path to the zip archive
+        :type zip_path: str
+        """
+        self.fs = fs
+        self.vfs = vfs
+        self.zip_path = zip_path
+        self._member_names = None
+        self._find_index = None
+
+    def find_index(self):
+        """
+        Path indexes of the 'find' command, built on first use and then
+        shared by every session of the image.
+
+        :rtype: FindIndex
+        """
+        if self._find_index is None:
+            index = self.vfs.index
+            members = zip(index.names, index.sizes)
+            self._find_index = FindIndex((os.path.join("/", name), size) for name, size in members)
+        return self._find_index
+
+    def member_name(self, path):
+        """
+        Name of the archive member behind a VFS path.
+
+        :param path: Normalized path (starting with '/')
+        :type path: str
+        :raises KeyError: If there is no such member
+        :rtype: str
+        """
+        if self._member_names is None:
+            self._member_names = {os.path.join("/", name): name for name in self.vfs.index.names}
+        return self._member_names[path]
+
+    def member_size(self, path):
+        """
+        Uncompressed size of the member behind a VFS path.
+
+        :rtype: int
+        """
+        return self.vfs.size(path)
+
+    def open(self, path):
+        """
+        Opens a member for reading through the store: from its cache, or
+        decompressed chunk by chunk as it is read (see LazyZipStore.open).
+
+        :param path: Normalized path (starting with '/')
+        :type path: str
+        :raises KeyError: If there is no such member
+        :rtype: io.BufferedIOBase
+        """
+        return self.vfs.open(path)
+
+    def close(self):
+        self.vfs.close()
+
+
+def load_image(zip_path, lazy=False, cache_size=64 * 1024 * 1024, index_path=None,
+               small_file_size=4096):
+    """
+    Loads a zip archive as a VFSImage.
+
+    Eagerly, every member is decompressed into the store's cache (without
+    a size limit) while loading. Lazily, only the central directory (or its
+    index cache) is read and contents are decompressed on first access.
+    Either way contents are only decoded when a command reads them, and
+    with an index cache the small members it holds are served from it
+    without decompressing them.
+
+    :param zip_path: Path to the zip archive
+    :type zip_path: str
+    :param lazy: Decompress members on first access instead of while loading
+    :type lazy: bool
+    :param cache_size: LRU cache size of the lazy store in bytes
+    :type cache_size: int
+    :param index_path: Index cache file of the store (see vfs_index)
+    :type index_path: str, optional
+    :param small_file_size: Members cached with their contents in a new index cache
+    :type small_file_size: int
+    :rtype: VFSImage
+    """
+    fs = VFSTree()
+    if lazy:
+        vfs = LazyZipStore(zip_path, cache_size, index_path, small_file_size)
+    else:
+        vfs = LazyZipStore(zip_path, None, index_path, small_file_size)
+        vfs.preload()
+    for normalized_path in vfs:
+        fs.add(normalized_path)
+    return VFSImage(fs, vfs, zip_path)
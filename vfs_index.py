@@ -0,0 +1,226 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+from lazyzip import CentralDirectory, LazyZipStore, find_central_directory
+
+MAGIC = b"VFSIDX\x00\x01"
+# magic, archive size, archive mtime (ns), prepended data length,
+# central directory hash, entry count, archive path length,
+# names length, contents length, crc32 of everything after the header
+_HEADER = struct.Struct("<8sQqQ16sQQQQL")
+_ARRAYS = (
+    ("methods", "H"),
+    ("flags", "H"),
+    ("crcs", "L"),
+    ("compressed_sizes", "Q"),
+    ("sizes", "Q"),
+    ("offsets", "Q"),
+)
+
+
+def index_path_for(zip_path):
+    """
+    Default location of the index cache: a '.idx' file next to the archive.
+
+    :rtype: str
+    """
+    return zip_path + ".idx"
+
+
+def archive_fingerprint(zip_path, buf):
+    """
+    Identifies an archive by its path, size, mtime and a hash of its
+    central directory.
+
+    :param zip_path: Path to the archive
+    :type zip_path: str
+    :param buf: The whole archive (usually an mmap)
+    :type buf: mmap.mmap or bytes
+    :raises zipfile.BadZipFile: If the central directory cannot be found
+    :rtype: tuple[str, int, int, bytes]
+    """
+    st = os.stat(zip_path)
+    start, end, _, _ = find_central_directory(buf)
+    digest = hashlib.blake2b(buf[start:end], digest_size=16).digest()
+    return os.path.abspath(zip_path), st.st_size, st.st_mtime_ns, digest
+
+
+def _pad(n):
+    return -n % 8
+
+
+def write_index(path, index, fingerprint, small_contents=None):
+    """
+    Writes an index cache atomically (temporary file + rename).
+
+    :param path: Path of the cache file
+    :type path: str
+    :param index: Parsed central directory
+    :type index: CentralDirectory
+    :param fingerprint: Result of archive_fingerprint
+    :type fingerprint: tuple
+    :param small_contents: Contents of small members by member number
+    :type small_contents: dict[int, bytes], optional
+    :raises OSError: If the file cannot be written
+    """
+    small_contents = small_contents or {}
+    archive_path, size, mtime_ns, digest = fingerprint
+    raw_path = archive_path.encode("utf-8")
+    names = "\0".join(index.names).encode("utf-8")
+    starts = array("q", [-1]) * len(index)
+    contents = bytearray()
+    for i in sorted(small_contents):
+        starts[i] = len(contents)
+        contents += small_contents[i]
+    parts = [raw_path, b"\0" * _pad(len(raw_path))]
+    for attr, _ in _ARRAYS:
+        data = getattr(index, attr).tobytes()
+        parts += [data, b"\0" * _pad(len(data))]
+    data = starts.tobytes()
+    parts += [data, names, b"\0" * _pad(len(names)), contents]
+    body = b"".join(parts)
+    header = _HEADER.pack(
+        MAGIC, size, mtime_ns, index.concat, digest, len(index),
+        len(raw_path), len(names), len(contents), zlib.crc32(body),
+    )
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class IndexCache:
+    """
+    A loaded index cache. The file stays memory-mapped so cached small
+    file contents are served straight from it.
+    """
+
+    def __init__(self, index, starts, contents_offset, buf, f):
+        self.index = index
+        self._starts = starts
+        self._contents_offset = contents_offset
+        self._mmap = buf
+        self._file = f
+
+    def small_content(self, i):
+        """
+        Cached contents of member i, or None if it was not cached.
+
+        :rtype: bytes or None
+        """
+        start = self._starts[i]
+        if start < 0:
+            return None
+        start += self._contents_offset
+        return self._mmap[start:start + self.index.sizes[i]]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def load_index(path, fingerprint):
+    """
+    Loads an index cache if it exists, is intact and matches the archive.
+
+    :param path: Path of the cache file
+    :type path: str
+    :param fingerprint: Result of archive_fingerprint for the archive
+    :type fingerprint: tuple
+    :return: The loaded cache, or None if it is missing, stale or corrupt
+    :rtype: IndexCache or None
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        f.close()
+        return None
+    try:
+        cache = _read_index(buf, f, fingerprint)
+    except (struct.error, ValueError, UnicodeDecodeError):
+        cache = None
+    if cache is None:
+        buf.close()
+        f.close()
+    return cache
+
+
+def _read_index(buf, f, fingerprint):
+    archive_path, size, mtime_ns, digest = fingerprint
+    (magic, cached_size, cached_mtime, concat, cached_digest, count,
+     path_len, names_len, contents_len, crc) = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or (cached_size, cached_mtime, cached_digest) != (size, mtime_ns, digest):
+        return None
+    with memoryview(buf) as view, view[_HEADER.size:] as body:
+        if zlib.crc32(body) != crc:
+            return None
+    pos = _HEADER.size
+    if buf[pos:pos + path_len].decode("utf-8") != archive_path:
+        return None
+    pos += path_len + _pad(path_len)
+    index = CentralDirectory()
+    index.concat = concat
+    for attr, typecode in _ARRAYS + (("starts", "q"),):
+        values = array(typecode)
+        length = values.itemsize * count
+        values.frombytes(buf[pos:pos + length])
+        pos += length + _pad(length)
+        if attr == "starts":
+            starts = values
+        else:
+            setattr(index, attr, values)
+    names = buf[pos:pos + names_len].decode("utf-8")
+    index.names = names.split("\0") if count else []
+    pos += names_len + _pad(names_len)
+    if len(index.names) != count or pos + contents_len != len(buf):
+        return None
+    return IndexCache(index, starts, pos, buf, f)
+
+
+def warm(zip_path, index_path=None, small_file_size=4096):
+    """
+    Builds (or rebuilds, if stale) the index cache of an archive.
+
+    :param zip_path: Path to the archive
+    :type zip_path: str
+    :param index_path: Path of the cache file, defaults to index_path_for(zip_path)
+    :type index_path: str, optional
+    :param small_file_size: Members up to this size are cached with their contents
+    :type small_file_size: int
+    :return: True if the cache had to be built
+    :rtype: bool
+    """
+    store = LazyZipStore(zip_path, index_path=index_path or index_path_for(zip_path),
+                         small_file_size=small_file_size)
+    built = not store.index_cache_hit
+    store.close()
+    return built
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VFS index cache tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    warm_parser = subparsers.add_parser("warm", help="build index caches for zip images")
+    warm_parser.add_argument("images", nargs="+", help="zip archives")
+    warm_parser.add_argument(
+        "--small-file-size", type=int, default=4096,
+        help="cache contents of members up to this many bytes (0 to disable)",
+    )
+    cli_args = parser.parse_args()
+    for image in cli_args.images:
+        state = "built" if warm(image, small_file_size=cli_args.small_file_size) else "up to date"
+        print(f"{image}: {state}")
@@ -0,0 +1,184 @@
+import os
+import struct
+import time
+import zipfile
+import zlib
+
+from lazyzip import (
+    _CENTRAL_HEADER,
+    _CENTRAL_HEADER_SIG,
+    _EOCD,
+    _EOCD_SIG,
+    _FLAG_UTF8,
+    _LOCAL_HEADER,
+    _LOCAL_HEADER_SIG,
+    _ZIP64_EOCD,
+    _ZIP64_EOCD_SIG,
+    _ZIP64_LOCATOR,
+    _ZIP64_LOCATOR_SIG,
+)
+
+CHUNK_SIZE = 1 << 20
+_ZIP64_LIMIT = 0xFFFFFFFF
+_FLAG_DATA_DESCRIPTOR = 0x8
+_DATA_DESCRIPTOR_SIG = b"PK\x07\x08"
+# Unix directory drwxr-xr-x plus the MS-DOS directory bit
+_DIR_ATTR = (0o40755 << 16) | 0x10
+_FILE_ATTR = 0o100644 << 16
+
+
+def _dos_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class ZipWriter:
+    """
+    Writes a zip archive entry by entry. Members of another archive can be
+    copied across as they are, without decompressing and recompressing them.
+
+    The archive is written to '<path>.tmp' and moved into place by close(),
+    so a failed write never leaves a truncated archive behind.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Archive to create (an existing file is replaced)
+        :type path: str
+        """
+        self.path = path
+        self._tmp_path = path + ".tmp"
+        self._file = open(self._tmp_path, "wb")
+        # Central directory records, written by close()
+        self._records = []
+
+    def copy_member(self, source, info, name=None):
+        """
+        Copies a member of another archive without recompressing it.
+
+        :param source: The other archive opened in binary mode
+        :type source: BinaryIO
+        :param info: The member, as read by zipfile
+        :type info: zipfile.ZipInfo
+        :param name: New name of the member, the same name by default
+        :type name: str, optional
+        :raises zipfile.BadZipFile: If the member's local header is corrupt
+        """
+        source.seek(info.header_offset)
+        header = _LOCAL_HEADER.unpack(source.read(_LOCAL_HEADER.size))
+        if header[0] != _LOCAL_HEADER_SIG:
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+        source.seek(header[9] + header[10], os.SEEK_CUR)
+
+        def chunks():
+            remaining = info.compress_size
+            while remaining:
+                chunk = source.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+                remaining -= len(chunk)
+                yield chunk
+
+        self._write(
+            info.filename if name is None else name,
+            info.compress_type,
+            info.flag_bits & ~_FLAG_UTF8,
+            info.CRC,
+            info.compress_size,
+            info.file_size,
+            info.date_time,
+            info.external_attr,
+            chunks(),
+        )
+
+    def write_bytes(self, name, data, date_time=None):
+        """
+        Adds a file, deflated unless that does not make it smaller.
+
+        :type name: str
+        :type data: bytes
+        :param date_time: Modification time, now by default
+        :type date_time: tuple[int, int, int, int, int, int], optional
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        method = zipfile.ZIP_DEFLATED
+        if len(compressed) >= len(data):
+            compressed, method = data, zipfile.ZIP_STORED
+        self._write(
+            name, method, 0, zlib.crc32(data), len(compressed), len(data),
+            date_time or time.localtime()[:6], _FILE_ATTR, [compressed],
+        )
+
+    def write_dir(self, name, date_time=None):
+        """
+        Adds a directory entry.
+
+        :param name: Directory name ending with '/'
+        :type name: str
+        """
+        self._write(name, zipfile.ZIP_STORED, 0, 0, 0, 0, date_time or time.localtime()[:6], _DIR_ATTR, [])
+
+    def _write(self, name, method, flags, crc, csize, size, date_time, external_attr, chunks):
+        raw_name = name.encode("utf-8")
+        if not name.isascii():
+            flags |= _FLAG_UTF8
+        offset = self._file.tell()
+        dos_time, dos_date = _dos_time(max(date_time, (1980, 1, 1, 0, 0, 0)))
+        zip64 = csize >= _ZIP64_LIMIT or size >= _ZIP64_LIMIT
+        extra = struct.pack("<2H2Q", 1, 16, size, csize) if zip64 else b""
+        version = 45 if zip64 else 20
+        self._file.write(_LOCAL_HEADER.pack(
+            _LOCAL_HEADER_SIG, version, flags, method, dos_time, dos_date, crc,
+            _ZIP64_LIMIT if zip64 else csize, _ZIP64_LIMIT if zip64 else size,
+            len(raw_name), len(extra),
+        ))
+        self._file.write(raw_name + extra)
+        for chunk in chunks:
+            self._file.write(chunk)
+        if flags & _FLAG_DATA_DESCRIPTOR:
+            # Kept for members that had one, e.g. encrypted ones whose
+            # password check byte depends on this flag
+            sizes = struct.pack("<2Q" if zip64 else "<2L", csize, size)
+            self._file.write(_DATA_DESCRIPTOR_SIG + struct.pack("<L", crc) + sizes)
+        self._records.append(
+            (raw_name, version, flags, method, dos_time, dos_date, crc, csize, size, external_attr, offset)
+        )
+
+    def close(self):
+        """
+        Writes the central directory and moves the archive into place.
+        """
+        cd_offset = self._file.tell()
+        for raw_name, version, flags, method, dos_time, dos_date, crc, csize, size, attr, offset in self._records:
+            values = [v for v in (size, csize, offset) if v >= _ZIP64_LIMIT]
+            extra = struct.pack(f"<2H{len(values)}Q", 1, 8 * len(values), *values) if values else b""
+            if values:
+                version = 45
+            self._file.write(_CENTRAL_HEADER.pack(
+                _CENTRAL_HEADER_SIG, (3 << 8) | version, version, flags, method, dos_time, dos_date, crc,
+                min(csize, _ZIP64_LIMIT), min(size, _ZIP64_LIMIT),
+                len(raw_name), len(extra), 0, 0, 0, attr, min(offset, _ZIP64_LIMIT),
+            ))
+            self._file.write(raw_name + extra)
+        cd_end = self._file.tell()
+        count = len(self._records)
+        cd_size = cd_end - cd_offset
+        if count >= 0xFFFF or cd_offset >= _ZIP64_LIMIT or cd_size >= _ZIP64_LIMIT:
+            self._file.write(_ZIP64_EOCD.pack(
+                _ZIP64_EOCD_SIG, _ZIP64_EOCD.size - 12, 45, 45, 0, 0, count, count, cd_size, cd_offset,
+            ))
+            self._file.write(_ZIP64_LOCATOR.pack(_ZIP64_LOCATOR_SIG, 0, cd_end, 1))
+        self._file.write(_EOCD.pack(
+            _EOCD_SIG, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(cd_size, _ZIP64_LIMIT), min(cd_offset, _ZIP64_LIMIT), 0,
+        ))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discards a partly written archive.
+        """
+        self._file.close()
+        os.remove(self._tmp_path)